@@ -0,0 +1,238 @@
+import argparse
+import dataclasses
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+from shapely import MultiPolygon, Point, box
+
+from libs.coordinates import Coordinates, CoordinateSystem
+from libs.equirec_to_perspec import Equirectangular
+from libs.features import Cropper, Resizer, SquareCrop, PanoGeoCropper, PanoGeoSquareCropper, MixVPRBase, MixVPR
+from libs.geo import decompose_angles
+from models import Building
+from models.image import NdarrayImage, Layer, ImageMeta, ImageType, Direction
+
+OBSERVER = Coordinates(55.7404, 37.6252, CoordinateSystem.ELLIPSOID)
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    name: str
+    repeat: int
+    median: float
+    min: float
+    max: float
+    peak_memory: int
+
+
+@dataclasses.dataclass
+class BenchmarkConfig:
+    repeat: int = 5
+    warmup: int = 1
+    pano_width: int = 4096
+    batch_size: int = 8
+    device: str = 'cpu'
+    seed: int = 0
+    model: bool = True
+
+
+def measure(name: str, function: Callable[[], object], repeat: int, warmup: int = 1) -> BenchmarkResult:
+    """
+    Wall time is measured without tracing, peak memory of python and numpy allocations is measured
+    in a separate traced run, torch tensors are not visible to tracemalloc
+    """
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return BenchmarkResult(name, repeat, statistics.median(timings), min(timings), max(timings), peak_memory)
+
+
+def synthetic_image(rng: np.random.Generator, height: int, width: int, image_type: ImageType) -> NdarrayImage:
+    return NdarrayImage(
+        image=Layer(content=rng.integers(0, 256, (height, width, 3), dtype=np.uint8)),
+        meta=ImageMeta(
+            primary_id='benchmark',
+            height=height,
+            width=width,
+            type=image_type,
+            coordinates=OBSERVER,
+            direction=Direction(degree=90),
+        ),
+    )
+
+
+def synthetic_buildings(observer_point: Point, count: int = 15, distance: float = 40) -> List[Building]:
+    """Squares around the observer, like a result of select_closest_geo_objects_to_point"""
+    buildings = []
+    for index, angle in enumerate(np.linspace(0, 2 * np.pi, count, endpoint=False)):
+        x, y = observer_point.x + distance * np.cos(angle), observer_point.y + distance * np.sin(angle)
+        building = Building(id=index + 1, group_id=1)
+        building.set_geometry_shape(MultiPolygon([box(x - 8, y - 8, x + 8, y + 8)]))
+        buildings.append(building)
+    return buildings
+
+
+class SyntheticPanoGeoCropper(PanoGeoCropper):
+    def __init__(self, buildings: List[Building], **kwargs):
+        super().__init__(session=None, **kwargs)
+        self.buildings = buildings
+
+    def closest_buildings(self, observer_point: Point) -> List[Building]:
+        return self.buildings
+
+
+class SyntheticPanoGeoSquareCropper(SyntheticPanoGeoCropper, PanoGeoSquareCropper):
+    pass
+
+
+class UntrainedMixVPR(MixVPR):
+    """Same architecture with random weights, so the benchmark does not need the checkpoint"""
+
+    def __init__(self, *args, **kwargs):
+        import ml_models.mixvpr.interface as mixvpr_interface
+
+        MixVPRBase.__init__(self, *args, **kwargs)
+        self.model = mixvpr_interface.get_model(pretrained=False).to(self.device).eval()
+
+
+def pipeline_benchmarks(config: BenchmarkConfig) -> Dict[str, Callable[[], object]]:
+    rng = np.random.default_rng(config.seed)
+    pano = synthetic_image(rng, config.pano_width // 2, config.pano_width, ImageType.PANO)
+    pano_pixels_per_degree = config.pano_width / 360 / 2
+    flat = synthetic_image(rng, 2000, int(pano_pixels_per_degree * 60), ImageType.FLAT)
+    square = synthetic_image(rng, MixVPRBase.INPUT_IMAGE_HEIGHT, MixVPRBase.INPUT_IMAGE_WIDTH, ImageType.FLAT)
+    described = deepcopy(square)
+    described.meta.descriptor = rng.standard_normal(MixVPRBase.DESCRIPTOR_SIZE).astype(np.float32)
+    described.meta.descriptor_image = Layer(content=square.image.content.copy())
+
+    observer_point = OBSERVER.point(CoordinateSystem.PROJECTION)
+    buildings = synthetic_buildings(observer_point)
+    equirectangular = Equirectangular(pano.image.content)
+    latitudes = OBSERVER.latitude + rng.uniform(-0.01, 0.01, 100)
+    longitudes = OBSERVER.longitude + rng.uniform(-0.01, 0.01, 100)
+
+    benchmarks = {
+        'cropper': lambda: list(Cropper(320, 320)(flat)),
+        'resizer': lambda: list(Resizer(MixVPRBase.INPUT_IMAGE_WIDTH, MixVPRBase.INPUT_IMAGE_HEIGHT)(flat)),
+        'square_crop': lambda: list(SquareCrop()(flat)),
+        'pano_geo_cropper': lambda: list(SyntheticPanoGeoCropper(buildings)(pano)),
+        'pano_geo_crop_square_resize': lambda: list(
+            Resizer(MixVPRBase.INPUT_IMAGE_WIDTH, MixVPRBase.INPUT_IMAGE_HEIGHT)(
+                SquareCrop()(SyntheticPanoGeoCropper(buildings)(pano)))),
+        'pano_geo_square_cropper': lambda: list(
+            SyntheticPanoGeoSquareCropper(buildings, size=MixVPRBase.INPUT_IMAGE_WIDTH)(pano)),
+        'equirectangular_get_perspective': lambda: equirectangular.GetPerspective(
+            60, 30, 10, 2000, pano_pixels_per_degree * 60),
+        'decompose_angles': lambda: decompose_angles(buildings, observer_point),
+        'coordinates_convert_x100': lambda: [
+            Coordinates.convert(latitude, longitude, CoordinateSystem.ELLIPSOID, CoordinateSystem.PROJECTION)
+            for latitude, longitude in zip(latitudes, longitudes)
+        ],
+        'ndarray_image_crop': lambda: described.crop(0, 160, 0, 160),
+        'ndarray_image_resize': lambda: described.resize(160, 160),
+        'image_meta_deepcopy': lambda: deepcopy(described.meta),
+        'image_meta_copy_deep': lambda: described.meta.copy(update={'recognised_building_id': 1}, deep=True),
+        'image_meta_derive': lambda: described.meta.derive(recognised_building_id=1),
+    }
+    if config.model:
+        extractor = UntrainedMixVPR(batch_size=config.batch_size, device=config.device)
+        batch = [deepcopy(square) for _ in range(config.batch_size)]
+        benchmarks[f'mixvpr_descriptor_b{config.batch_size}'] = lambda: extractor.descriptor(iter(batch))
+    return benchmarks
+
+
+def run_benchmarks(config: BenchmarkConfig, names: Optional[List[str]] = None) -> List[BenchmarkResult]:
+    results = []
+    for name, function in pipeline_benchmarks(config).items():
+        if names and name not in names:
+            continue
+        result = measure(name, function, config.repeat, config.warmup)
+        logger.info(f"{name}: median {result.median * 1e3:.2f} ms, min {result.min * 1e3:.2f} ms, "
+                    f"peak {result.peak_memory / 2 ** 20:.1f} MiB")
+        results.append(result)
+    return results
+
+
+def regressions(results: List[BenchmarkResult], baseline: dict, threshold: float,
+                memory_threshold: float) -> List[str]:
+    """Compares medians and memory peaks with a result file written by a previous run on the same machine"""
+    baseline_results = {result['name']: result for result in baseline['results']}
+    found = []
+    for result in results:
+        if result.name not in baseline_results:
+            continue
+        reference = baseline_results[result.name]
+        if result.median > reference['median'] * (1 + threshold):
+            found.append(f"{result.name}: median {result.median * 1e3:.2f} ms, "
+                         f"baseline {reference['median'] * 1e3:.2f} ms")
+        if result.peak_memory > reference['peak_memory'] * (1 + memory_threshold):
+            found.append(f"{result.name}: peak {result.peak_memory / 2 ** 20:.1f} MiB, "
+                         f"baseline {reference['peak_memory'] / 2 ** 20:.1f} MiB")
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times image pipeline stages on synthetic inputs")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--pano-width', type=int, default=4096)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-model', action='store_true', help="do not benchmark MixVPR forward pass")
+    parser.add_argument('--only', nargs='*', help="benchmark names to run")
+    parser.add_argument('--output', default='benchmark_result.json')
+    parser.add_argument('--baseline', help="result file to compare with, exits with 1 on regression")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed relative slowdown of median")
+    parser.add_argument('--memory-threshold', type=float, default=0.2, help="allowed relative growth of peak")
+    arguments = parser.parse_args()
+
+    benchmark_config = BenchmarkConfig(
+        repeat=arguments.repeat,
+        warmup=arguments.warmup,
+        pano_width=arguments.pano_width,
+        batch_size=arguments.batch_size,
+        device=arguments.device,
+        seed=arguments.seed,
+        model=not arguments.skip_model,
+    )
+    benchmark_results = run_benchmarks(benchmark_config, arguments.only)
+    with open(arguments.output, 'w', encoding='utf8') as output_file:
+        json.dump({
+            'config': dataclasses.asdict(benchmark_config),
+            'machine': {'python': platform.python_version(), 'processor': platform.processor(),
+                        'platform': platform.platform()},
+            'results': [dataclasses.asdict(result) for result in benchmark_results],
+        }, output_file, indent=2)
+    logger.info(f"Results written to {arguments.output}")
+
+    if arguments.baseline:
+        with open(arguments.baseline, 'r', encoding='utf8') as baseline_file:
+            benchmark_baseline = json.load(baseline_file)
+        if benchmark_baseline['config'] != dataclasses.asdict(benchmark_config):
+            logger.warning(f"Baseline was measured with {benchmark_baseline['config']}")
+        found_regressions = regressions(benchmark_results, benchmark_baseline,
+                                        arguments.threshold, arguments.memory_threshold)
+        for regression in found_regressions:
+            logger.error(f"Regression {regression}")
+        if found_regressions:
+            sys.exit(1)
+        logger.info(f"No regressions against {arguments.baseline}")
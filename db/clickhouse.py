@@ -1,15 +1,16 @@
 import json
+from os import environ
 
 import clickhouse_connect
 from shapely import Point
 
 from models.logs import HTTPMethod
-from services.logs import create_request_log, create_recognition_log
+from services.logs_clickhouse import create_request_log, create_recognition_log
 
 
 def GetClickhouseClient():
     return clickhouse_connect.get_client(
-        host='clickhouse',
+        host=environ.get('CLICKHOUSE_HOST', 'clickhouse'),
         username='default',
         # password='clickhouse',
         database='logs'
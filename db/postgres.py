@@ -1,11 +1,20 @@
 from os import environ
 
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-DATABASE_URL = f"postgresql://{environ.get('DB_USER')}:{environ.get('DB_PASSWORD')}@{environ.get('DB_HOST')}:{environ.get('DB_PORT')}/{environ.get('DB_DATABASE')}"
+DATABASE_CREDENTIALS = f"{environ.get('DB_USER')}:{environ.get('DB_PASSWORD')}@{environ.get('DB_HOST')}:{environ.get('DB_PORT')}/{environ.get('DB_DATABASE')}"
+DATABASE_URL = f"postgresql://{DATABASE_CREDENTIALS}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DATABASE_CREDENTIALS}"
 
 ENGINE = create_engine(DATABASE_URL, echo=False)
+ASYNC_ENGINE = create_async_engine(ASYNC_DATABASE_URL, echo=False)
 
 
 def GetSQLModelSession() -> Session:
     return Session(ENGINE)
+
+
+def GetAsyncSQLModelSession() -> AsyncSession:
+    return AsyncSession(ASYNC_ENGINE, expire_on_commit=False)
@@ -1,7 +1,11 @@
 from os import environ
 
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 
 
 def GetQdrantClient():
     return QdrantClient(host=environ.get('VECTOR_DB_HOST'), grpc_port=6334, prefer_grpc=True)
+
+
+def GetAsyncQdrantClient():
+    return AsyncQdrantClient(host=environ.get('VECTOR_DB_HOST'), grpc_port=6334, prefer_grpc=True)
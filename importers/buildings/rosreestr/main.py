@@ -7,6 +7,7 @@ from db.postgres import GetSQLModelSession
 from models import BuildingGroup, Building
 from resources.areas.main import MOSCOW_GARDEN_RING
 from services.language import create_text_content
+from tools.cache import invalidate_building_cache
 
 MOSCOW_PATH = "resources/buildings/rosreestr/moscow.gpkg"
 
@@ -62,3 +63,4 @@ def update_buildings_table():
 
 if __name__ == '__main__':
     update_buildings_table()
+    invalidate_building_cache()
@@ -6,6 +6,7 @@ from models.geo import Building
 from models.link import BuildingMetroLink
 from services.geo import select_closest_metro_stations
 from sqlmodel import delete
+from tools.cache import invalidate_building_cache
 
 
 def update_building_to_metro():
@@ -28,3 +29,4 @@ def update_building_to_metro():
 
 if __name__ == '__main__':
     update_building_to_metro()
+    invalidate_building_cache()
@@ -6,6 +6,7 @@ from sqlmodel import select
 from db.postgres import GetSQLModelSession
 from models.geo import MetroLine, MetroStation
 from services.language import create_text_content
+from tools.cache import invalidate_building_cache
 
 METRO_DATA_PATH = "resources/metro/data.json"
 
@@ -50,3 +51,4 @@ def update_metro_tables():
 
 if __name__ == '__main__':
     update_metro_tables()
+    invalidate_building_cache()
@@ -0,0 +1,120 @@
+import argparse
+import datetime
+from typing import Optional
+
+from geoalchemy2.shape import from_shape
+from loguru import logger
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from tqdm import tqdm
+
+from db.postgres import GetSQLModelSession
+from libs.coordinates import Coordinates, MAIN_COORDINATE_SYSTEM
+from libs.readers import pano_fingerprints, read_pano_meta, pano_source_to_coordinate_system, \
+    image_source_to_pano_source
+from libs.s3 import BUCKET
+from libs.utils import chunks, pool_executor
+from models.image import ImageSource
+from models.pano import Pano, PanoMeta, PanoSpec, PanoManifest, PanoSource
+from services.pano import select_pano_manifests, update_pano_manifest, delete_pano_manifests
+
+
+def manifest_from_meta(pano_id: str, meta: dict, source: ImageSource, fingerprint: str) -> PanoManifest:
+    coordinates = Coordinates(
+        latitude=meta['coordinates']['latitude'],
+        longitude=meta['coordinates']['longitude'],
+        system=pano_source_to_coordinate_system[source],
+    )
+    return PanoManifest(
+        pano_id=pano_id,
+        source=image_source_to_pano_source[source],
+        coordinates=from_shape(coordinates.point(MAIN_COORDINATE_SYSTEM)),
+        direction=meta['direction'],
+        datetime=datetime.datetime.fromisoformat(meta['datetime']) if meta.get('datetime') else None,
+        zooms=sorted(pano_size['zoom'] for pano_size in meta['panos']),
+        fingerprint=fingerprint,
+    )
+
+
+def read_pano_meta_or_none(pano_id: str, source: ImageSource, bucket: str) -> Optional[dict]:
+    try:
+        return read_pano_meta(pano_id, source, bucket)
+    except Exception as e:
+        logger.warning(f'meta.json of pano "{pano_id}" can not be read: {e}')
+        return None
+
+
+def update_manifest_from_s3(source: ImageSource, bucket: str = BUCKET, workers: int = 16, chunk_size: int = 1000):
+    """Reads meta.json only of panos that are new or whose objects changed since the previous update"""
+    pano_source = image_source_to_pano_source[source]
+    fingerprints = pano_fingerprints(bucket, source)
+    with GetSQLModelSession() as session:
+        manifests = select_pano_manifests(session, pano_source)
+        changed = [pano_id for pano_id, fingerprint in fingerprints.items()
+                   if pano_id not in manifests or manifests[pano_id].fingerprint != fingerprint]
+        removed = [pano_id for pano_id in manifests if pano_id not in fingerprints]
+        logger.info(f"{len(fingerprints)} panos in {bucket}, {len(changed)} new or changed, {len(removed)} removed")
+
+        for chunk in chunks(changed, chunk_size):
+            metas = pool_executor(
+                items=chunk,
+                processor_fn=read_pano_meta_or_none,
+                processor_args=[source, bucket],
+                tqdm_desc="Reading metas",
+                max_workers=workers,
+                executor_type="thread",
+            )
+            for pano_id, meta in zip(chunk, metas):
+                if meta is not None:
+                    update_pano_manifest(session, manifest_from_meta(pano_id, meta, source, fingerprints[pano_id]),
+                                         manifests.get(pano_id))
+            session.commit()
+
+        for chunk in chunks(removed, chunk_size):
+            delete_pano_manifests(session, pano_source, chunk)
+        session.commit()
+
+
+def update_manifest_from_specs(source: PanoSource = PanoSource.GOOGLE):
+    """
+    Adds panos described by the miner PanoSpec table, their coordinates are already in MAIN_COORDINATE_SYSTEM.
+    Rows read from S3 are kept as they describe downloaded files
+    """
+    with GetSQLModelSession() as session:
+        manifests = select_pano_manifests(session, source)
+        statement = select(Pano) \
+            .join(PanoMeta, PanoMeta.id == Pano.meta_id) \
+            .where(PanoMeta.source == source) \
+            .where(Pano.spec_id.is_not(None)) \
+            .options(selectinload(Pano.meta), selectinload(Pano.spec).selectinload(PanoSpec.sizes))
+        updated = 0
+        for pano in tqdm(session.exec(statement).all(), desc="Reading specs"):
+            existing = manifests.get(pano.meta.source_image_id)
+            if existing is not None and existing.fingerprint is not None:
+                continue
+            update_pano_manifest(session, PanoManifest(
+                pano_id=pano.meta.source_image_id,
+                source=source,
+                coordinates=pano.spec.coordinates,
+                direction=pano.spec.direction,
+                datetime=pano.spec.datetime,
+                zooms=sorted(pano_size.zoom for pano_size in pano.spec.sizes),
+            ), existing)
+            updated += 1
+        session.commit()
+        logger.info(f"{updated} manifest rows updated from specs")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Updates spatial manifest of panos used for area selection")
+    parser.add_argument('--from', dest='origin', choices=['s3', 'specs'], default='s3')
+    parser.add_argument('--source', choices=[source.value for source in image_source_to_pano_source],
+                        default=ImageSource.GOOGLE.value)
+    parser.add_argument('--bucket', default=BUCKET)
+    parser.add_argument('--workers', type=int, default=16)
+    arguments = parser.parse_args()
+
+    if arguments.origin == 's3':
+        update_manifest_from_s3(ImageSource(arguments.source), arguments.bucket, arguments.workers)
+    else:
+        update_manifest_from_specs(image_source_to_pano_source[ImageSource(arguments.source)])
@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
+
+Item = TypeVar('Item')
+Result = TypeVar('Result')
+
+
+class MicroBatcher(Generic[Item, Result]):
+    """
+    Merges items submitted by concurrent coroutines into batches of at most max_batch_size items.
+    Collection of a batch ends max_wait seconds after its first item arrives. Batches are processed one at a time
+    in a dedicated thread, so items submitted while a batch is processed are merged into the next one.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Item]], List[Result]], max_batch_size: int = 8,
+                 max_wait: float = 0.01):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._getter: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._getter is not None:
+            self._getter.cancel()
+            self._getter = None
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError(f"{type(self).__name__} is closed"))
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, item: Item) -> Result:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _get(self, timeout: Optional[float] = None) -> Optional[Tuple[Item, asyncio.Future]]:
+        # Pending get is kept between calls instead of being cancelled, so no item is lost on timeout
+        if self._getter is None:
+            self._getter = asyncio.ensure_future(self._queue.get())
+        done, _ = await asyncio.wait({self._getter}, timeout=timeout)
+        if not done:
+            return None
+        entry, self._getter = self._getter.result(), None
+        return entry
+
+    async def _collect(self) -> List[Tuple[Item, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            entry = await self._get(timeout=max(deadline - loop.time(), 0))
+            if entry is None:
+                break
+            batch.append(entry)
+        return [(item, future) for item, future in batch if not future.cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self._executor, self.process_batch, [item for item, _ in batch])
+            except (Exception,) as exception:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exception)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class LRUCache:
+    """Thread safe size bounded cache, entries older than ttl seconds are treated as missing"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if key in found or key in missing:
+                    continue
+                item = self._items.get(key)
+                if item is None or (self.ttl is not None and now - item[0] > self.ttl):
+                    self._items.pop(key, None)
+                    missing.append(key)
+                    continue
+                self._items.move_to_end(key)
+                found[key] = item[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        found, _ = self.get_many([key])
+        return found.get(key)
+
+    def put_many(self, items: Dict[Hashable, Any]):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in items.items():
+                self._items[key] = (now, value)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def put(self, key: Hashable, value: Any):
+        self.put_many({key: value})
+
+    def invalidate(self, keys: Optional[Iterable[Hashable]] = None):
+        with self._lock:
+            if keys is None:
+                self._items.clear()
+                return
+            for key in keys:
+                self._items.pop(key, None)
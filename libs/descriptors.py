@@ -0,0 +1,45 @@
+import base64
+from enum import Enum
+from typing import List, Union
+
+import numpy as np
+
+OCTET_STREAM = 'application/octet-stream'
+
+
+class DescriptorDType(str, Enum):
+    FLOAT32 = 'float32'
+    FLOAT16 = 'float16'
+
+
+class DescriptorWireFormat(str, Enum):
+    JSON = 'json'
+    BASE64 = 'base64'
+    BINARY = 'binary'
+
+
+descriptor_dtype_to_numpy = {
+    DescriptorDType.FLOAT32: np.dtype('<f4'),
+    DescriptorDType.FLOAT16: np.dtype('<f2'),
+}
+
+
+def encode_descriptor(descriptor: Union[np.ndarray, List[float]],
+                      dtype: DescriptorDType = DescriptorDType.FLOAT32) -> bytes:
+    return np.asarray(descriptor, dtype=descriptor_dtype_to_numpy[dtype]).tobytes()
+
+
+def decode_descriptor(buffer: bytes, dtype: DescriptorDType = DescriptorDType.FLOAT32) -> np.ndarray:
+    numpy_dtype = descriptor_dtype_to_numpy[dtype]
+    if len(buffer) == 0 or len(buffer) % numpy_dtype.itemsize != 0:
+        raise ValueError(f"Buffer of {len(buffer)} bytes is not a {dtype.value} descriptor")
+    return np.frombuffer(buffer, dtype=numpy_dtype).astype(np.float32)
+
+
+def encode_descriptor_b64(descriptor: Union[np.ndarray, List[float]],
+                          dtype: DescriptorDType = DescriptorDType.FLOAT32) -> str:
+    return base64.b64encode(encode_descriptor(descriptor, dtype)).decode('ascii')
+
+
+def decode_descriptor_b64(data: str, dtype: DescriptorDType = DescriptorDType.FLOAT32) -> np.ndarray:
+    return decode_descriptor(base64.b64decode(data, validate=True), dtype)
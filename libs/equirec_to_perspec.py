@@ -38,9 +38,10 @@ class Equirectangular:
         # self._img[:, :w/8, :] = cp[:, 7*w/8:, :]
         # self._img[:, w/8:, :] = cp[:, :7*w/8, :]
 
-    def GetPerspective(self, FOV, THETA, PHI, height, width):
+    def RemapGrid(self, FOV, THETA, PHI, height, width):
         #
         # THETA is left/right angle, PHI is up/down angle, both in degree
+        # Returns pixel coordinates in the panorama for every pixel of the perspective view
         #
 
         f = 0.5 * width * 1 / np.tan(0.5 * FOV / 180.0 * np.pi)
@@ -68,6 +69,14 @@ class Equirectangular:
         xyz = xyz @ R.T
         lonlat = xyz2lonlat(xyz)
         XY = lonlat2XY(lonlat, shape=self._img.shape).astype(np.float32)
-        persp = cv2.remap(self._img, XY[..., 0], XY[..., 1], cv2.INTER_CUBIC, borderMode=cv2.BORDER_WRAP)
+        return XY[..., 0], XY[..., 1]
 
-        return persp
+    def Remap(self, map_x, map_y, interpolation=cv2.INTER_CUBIC):
+        return cv2.remap(self._img, map_x, map_y, interpolation, borderMode=cv2.BORDER_WRAP)
+
+    def GetPerspective(self, FOV, THETA, PHI, height, width, interpolation=cv2.INTER_CUBIC):
+        #
+        # THETA is left/right angle, PHI is up/down angle, both in degree
+        #
+
+        return self.Remap(*self.RemapGrid(FOV, THETA, PHI, height, width), interpolation)
@@ -1,15 +1,17 @@
 import itertools
-from copy import deepcopy
-from typing import List, Union, Iterator
+from os import environ
+from typing import List, Union, Iterator, Tuple
 
 import numpy as np
 import torch
+from shapely import Point
 from sqlmodel import Session
 
 import ml_models.mixvpr.interface as mixvpr_interface
 from libs.coordinates import CoordinateSystem
 from libs.equirec_to_perspec import Equirectangular
-from libs.geo import decompose_angles
+from libs.cache import LRUCache
+from libs.geo import decompose_angles, BuildingShape
 from models import Building
 from models.image import NdarrayImage, Layer, ImageType
 from services.geo import select_closest_geo_objects_to_point
@@ -78,16 +80,19 @@ class SquareCrop(FeatureGenerator):
 class DescriptorExtractor(FeatureGenerator):
     name = 'descriptor'
 
-    def __init__(self, batch_size: int = 1, device: str = 'cpu'):
+    def __init__(self, batch_size: int = 1, device: str = 'cpu', keep_descriptor_image: bool = False):
         self.batch_size = batch_size
         self.device = device
+        self.keep_descriptor_image = keep_descriptor_image
 
     def transform(self, images: Iterator[NdarrayImage]) -> Iterator[NdarrayImage]:
+        """With keep_descriptor_image the input layer is referenced in meta.descriptor_image, it is not copied"""
         while batch_images := list(itertools.islice(images, self.batch_size)):
             descriptors = self.descriptor(iter(batch_images))
             for image, descriptor in zip(batch_images, descriptors):
                 image.meta.descriptor = descriptor
-                image.meta.descriptor_image = deepcopy(image.image)
+                if self.keep_descriptor_image:
+                    image.meta.descriptor_image = image.image
                 yield image
 
     def descriptor(self, images: Iterator[NdarrayImage]) -> np.array:
@@ -103,23 +108,20 @@ class DescriptorExtractor(FeatureGenerator):
         raise NotImplementedError
 
 
-class MixVPR(DescriptorExtractor):
+class MixVPRBase(DescriptorExtractor):
     DESCRIPTOR_SIZE = 4096
     INPUT_IMAGE_HEIGHT = 320
     INPUT_IMAGE_WIDTH = 320
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.model = mixvpr_interface.get_loaded_model(self.device).to(self.device)
+    def batch(self, images: Iterator[NdarrayImage]) -> np.ndarray:
+        return np.fromiter((np.moveaxis(image.image.content, [2], [0]) for image in images),
+                           dtype=(np.float32, (3, self.INPUT_IMAGE_HEIGHT, self.INPUT_IMAGE_WIDTH)))
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
 
     def descriptor(self, images: Iterator[NdarrayImage]) -> np.ndarray:
-        # for image in images:
-        #     assert image.image.content.shape == (320, 320, 3)
-        batch = torch.tensor(
-            np.fromiter((np.moveaxis(image.image.content, [2], [0]) for image in images),
-                        dtype=(np.float32, (3, 320, 320)))).to(self.device)
-        res = self.model(batch).to("cpu").detach().numpy()
-        return res
+        return self.forward(self.batch(images))
 
     def descriptor_size(self):
         return self.DESCRIPTOR_SIZE
@@ -131,13 +133,59 @@ class MixVPR(DescriptorExtractor):
         return self.INPUT_IMAGE_WIDTH
 
 
+class MixVPR(MixVPRBase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = mixvpr_interface.get_loaded_model(self.device).to(self.device).eval()
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(torch.from_numpy(batch).to(self.device)).to("cpu").numpy()
+
+
+class TorchScriptMixVPR(MixVPRBase):
+    """Runs graph exported by ml_models/mixvpr/export.py, path can be overridden with MIXVPR_TORCHSCRIPT_PATH"""
+    MODEL_PATH = environ.get('MIXVPR_TORCHSCRIPT_PATH', mixvpr_interface.TORCHSCRIPT_PATH)
+
+    def __init__(self, *args, model_path: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = torch.jit.load(model_path or self.MODEL_PATH, map_location=self.device).eval()
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(torch.from_numpy(batch).to(self.device)).to("cpu").numpy()
+
+
+class OnnxMixVPR(MixVPRBase):
+    """Runs graph exported by ml_models/mixvpr/export.py with ONNX Runtime, see MIXVPR_ONNX_PATH"""
+    MODEL_PATH = environ.get('MIXVPR_ONNX_PATH', mixvpr_interface.ONNX_PATH)
+
+    def __init__(self, *args, model_path: str = None, threads: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if self.device.startswith('cuda') else \
+            ['CPUExecutionProvider']
+        self.session = onnxruntime.InferenceSession(model_path or self.MODEL_PATH, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
 class PanoGeoCropper(FeatureGenerator):
     name = 'pano_cropper'
     filter_buildings_indices = []
+    PITCH = 10
+    HEIGHT = 2000
 
     def __init__(self, session: Session, angle_threshold: int = 30, padding: int = 0,
-                 buildings: Union[int, List[int]] = None):
+                 buildings: Union[int, List[int]] = None, shape_cache_size: int = 100000):
         self.session = session
+        self.shape_cache = LRUCache(shape_cache_size)
         if isinstance(buildings, List):
             assert all(map(lambda x: isinstance(x, int), buildings))
             self.filter_buildings_indices = buildings
@@ -150,44 +198,84 @@ class PanoGeoCropper(FeatureGenerator):
         self.padding = padding
         self.angle_threshold = angle_threshold
 
+    def closest_buildings(self, observer_point: Point) -> List[Building]:
+        return select_closest_geo_objects_to_point(self.session, Building, observer_point, 15)
+
+    def building_shapes(self, observer_point: Point) -> List[BuildingShape]:
+        """Neighbouring panos share buildings, so their geometries are parsed once per cropper"""
+        buildings = self.closest_buildings(observer_point)
+        shapes, missing = self.shape_cache.get_many([building.id for building in buildings])
+        if missing:
+            missing = set(missing)
+            parsed = {building.id: BuildingShape.from_building(building)
+                      for building in buildings if building.id in missing}
+            self.shape_cache.put_many(parsed)
+            shapes.update(parsed)
+        return [shapes[building.id] for building in buildings]
+
+    def views(self, image: NdarrayImage) -> Iterator[Tuple[int, float, float]]:
+        """Building id, horizontal field of view and heading of perspective views of the pano buildings, in degrees"""
+        observer_point = image.meta.coordinates.point(CoordinateSystem.PROJECTION)
+        angles = decompose_angles(self.building_shapes(observer_point), observer_point)
+        for start, end, index, avg_distance in angles:
+            if not index:
+                continue
+
+            if self.filter_buildings_indices and index not in self.filter_buildings_indices:
+                continue
+
+            if start > end or end - start < self.angle_threshold:
+                # TODO process split angle case
+                continue
+
+            end += self.padding
+            start -= self.padding
+            fov = end - start
+            shift = 360 - image.meta.direction.degree
+            yield index, fov, -shift + start - 180 + fov / 2
+
+    def perspective_width(self, image: NdarrayImage, fov: float) -> float:
+        pixels_per_fov_degree = (image.width / 360) / 2
+        return pixels_per_fov_degree * fov
+
+    def render(self, equ: Equirectangular, image: NdarrayImage, fov: float, heading: float) -> np.ndarray:
+        # height_k = 45 / avg_distance
+        # height = min(4000, 2000 * height_k)
+        return equ.GetPerspective(fov, heading, self.PITCH, self.HEIGHT, self.perspective_width(image, fov))
+
     def transform(self, images: Iterator[NdarrayImage]) -> Iterator[NdarrayImage]:
         for image in images:
-            observer_point = image.meta.coordinates.point(CoordinateSystem.PROJECTION)
-            closest_buildings = select_closest_geo_objects_to_point(self.session, Building, observer_point, 15)
-            angles = decompose_angles(closest_buildings, observer_point)
             equ = Equirectangular(image.image.content)
-            for start, end, index, avg_distance in angles:
-                if not index:
-                    continue
-
-                if self.filter_buildings_indices and index not in self.filter_buildings_indices:
-                    continue
-
-                if start > end or end - start < self.angle_threshold:
-                    # TODO process split angle case
-                    continue
-
-                end += self.padding
-                start -= self.padding
-                fov = end - start
-                shift = 360 - image.meta.direction.degree
-                pixels_per_fov_degree = (image.width / 360) / 2
-                # height_k = 45 / avg_distance
-                # height = min(4000, 2000 * height_k)
-                img = equ.GetPerspective(fov, -shift + start - 180 + fov / 2, 10, 2000, pixels_per_fov_degree * fov)
+            for index, fov, heading in self.views(image):
                 ndarray_image = NdarrayImage(
-                    image=Layer(content=img),
-                    meta=image.meta.copy(
-                        update={
-                            'type': ImageType.FLAT,
-                            'recognised_building_id': index
-                        },
-                        deep=True
+                    image=Layer(content=self.render(equ, image, fov, heading)),
+                    meta=image.meta.derive(
+                        type=ImageType.FLAT,
+                        recognised_building_id=index,
                     )
                 )
                 yield ndarray_image
 
 
+class PanoGeoSquareCropper(PanoGeoCropper):
+    """
+    PanoGeoCropper, SquareCrop and Resizer to size x size fused into a single remap. The center square
+    of a perspective view is a view along the same axis with a narrower field of view, so only the pixels
+    of the model input are rendered
+    """
+    name = 'pano_square_cropper'
+
+    def __init__(self, session: Session, size: int, **kwargs):
+        super().__init__(session, **kwargs)
+        self.size = size
+
+    def render(self, equ: Equirectangular, image: NdarrayImage, fov: float, heading: float) -> np.ndarray:
+        width = self.perspective_width(image, fov)
+        side = min(width, self.HEIGHT)
+        square_fov = 2 * np.degrees(np.arctan(side / width * np.tan(np.radians(fov) / 2)))
+        return equ.GetPerspective(square_fov, heading, self.PITCH, self.size, self.size)
+
+
 class FeaturePipeline(FeatureGenerator):
     def __init__(self, feature_generators: Iterator[FeatureGenerator]):
         self.feature_generators = feature_generators
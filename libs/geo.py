@@ -1,15 +1,37 @@
+import dataclasses
 import math
 from statistics import mean
+from typing import Any
 
 import numpy as np
 from shapely import LineString, distance
 from shapely.geometry import Point
 from shapely.ops import nearest_points
+from shapely.prepared import prep
 
 from libs.utils import rle_encode
 from models import Building
 
 
+@dataclasses.dataclass(frozen=True)
+class BuildingShape:
+    """Building geometry parsed once, intersections with rays are tested against the prepared geometry"""
+    id: int
+    shape: Any
+    prepared: Any
+
+    @classmethod
+    def from_building(cls, building: Building) -> 'BuildingShape':
+        shape = building.geometry_shape
+        return cls(id=building.id, shape=shape, prepared=prep(shape))
+
+    def intersects(self, other) -> bool:
+        return self.prepared.intersects(other)
+
+    def intersection(self, other):
+        return self.shape.intersection(other)
+
+
 def decompose_angles(buildings: Building, observer_point: Point, iterations: int = 360 * 4, ray_length: float = 10000):
     angle_map = []
     for i in np.linspace((1 / 2) * math.pi, -(3 / 2) * math.pi, iterations) + 2 * math.pi / iterations / 2:
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+from os import environ
+from typing import Dict, List, Optional
+
+import numpy as np
+from geoalchemy2.shape import to_shape
+from shapely import Point
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from libs.descriptors import DescriptorDType, descriptor_dtype_to_numpy
+from models.release import Release, ReleaseItem, VectorDistance
+from services.release import decode_release_item_descriptor
+
+LOCAL_INDEX_DIRECTORY = environ.get('LOCAL_INDEX_DIRECTORY', 'data/local_index')
+EARTH_RADIUS = 6371008.8
+
+
+class LocalIndex:
+    """
+    Exact search over a release stored as memory-mapped npy files, see build_local_index.
+    Rows are scanned in blocks of block_size with a single GEMM per block, so memory stays bounded
+    for float16 matrices larger than RAM. With use_faiss the descriptors are copied into faiss IndexFlatL2,
+    or IndexFlatIP for Dot releases. Cosine releases are stored normalized, so L2 gives the order of Qdrant.
+    """
+
+    def __init__(self, directory: str, block_size: int = 16384, use_faiss: bool = False):
+        self.directory = directory
+        self.block_size = block_size
+        self.distance = read_local_index_distance(directory)
+        self.descriptors = np.load(os.path.join(directory, 'descriptors.npy'), mmap_mode='r')
+        self.norms = np.load(os.path.join(directory, 'norms.npy'))
+        self.ids = np.load(os.path.join(directory, 'ids.npy'))
+        self.building_ids = np.load(os.path.join(directory, 'building_ids.npy'))
+        self.locations = np.radians(np.load(os.path.join(directory, 'locations.npy')))
+        with open(os.path.join(directory, 'image_urls.json'), 'r', encoding='utf8') as input_file:
+            self.image_urls: List[str] = json.load(input_file)
+        self.faiss_index = self.create_faiss_index() if use_faiss else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def create_faiss_index(self):
+        import faiss
+
+        index_type = faiss.IndexFlatIP if self.distance == VectorDistance.DOT else faiss.IndexFlatL2
+        faiss_index = index_type(self.descriptors.shape[1])
+        for start in range(0, len(self), self.block_size):
+            faiss_index.add(np.ascontiguousarray(self.descriptors[start:start + self.block_size], dtype=np.float32))
+        return faiss_index
+
+    def rows_within(self, point: Point, radius: float) -> np.ndarray:
+        """Point is (latitude, longitude) in degrees, radius is in meters"""
+        latitude, longitude = np.radians(point.x), np.radians(point.y)
+        haversine = np.sin((self.locations[:, 0] - latitude) / 2) ** 2 + \
+            np.cos(latitude) * np.cos(self.locations[:, 0]) * np.sin((self.locations[:, 1] - longitude) / 2) ** 2
+        return np.flatnonzero(2 * EARTH_RADIUS * np.arcsin(np.sqrt(haversine)) <= radius)
+
+    def search(self, queries: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> List[np.ndarray]:
+        """Returns row numbers of k closest descriptors for every query, searches only given rows if specified"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if rows is None and self.faiss_index is not None:
+            _, found = self.faiss_index.search(queries, k)
+            return [query_found[query_found >= 0] for query_found in found]
+
+        size = len(self) if rows is None else len(rows)
+        k = min(k, size)
+        if k == 0:
+            return [np.empty(0, dtype=np.int64) for _ in queries]
+        best_distances = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, size, self.block_size):
+            if rows is None:
+                block_rows = np.arange(start, min(start + self.block_size, size))
+                block = self.descriptors[start:start + self.block_size]
+            else:
+                block_rows = rows[start:start + self.block_size]
+                block = self.descriptors[block_rows]
+            distances = self.norms[block_rows] - 2 * (queries @ block.astype(np.float32).T)
+            distances = np.concatenate([best_distances, distances], axis=1)
+            candidates = np.concatenate([best_rows, np.broadcast_to(block_rows, (len(queries), len(block_rows)))],
+                                        axis=1)
+            block_k = min(k, distances.shape[1])
+            top = np.argpartition(distances, block_k - 1, axis=1)[:, :block_k]
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best_rows = np.take_along_axis(candidates, top, axis=1)
+
+        order = np.argsort(best_distances, axis=1)
+        return list(np.take_along_axis(best_rows, order, axis=1))
+
+
+def local_index_descriptor(descriptor: np.ndarray, distance: VectorDistance) -> np.ndarray:
+    """Qdrant normalizes vectors of Cosine collections on upload, L2 order of normalized vectors is the cosine one"""
+    if distance == VectorDistance.COSINE:
+        norm = np.linalg.norm(descriptor)
+        return descriptor / norm if norm > 0 else descriptor
+    return descriptor
+
+
+def local_index_norm(descriptor: np.ndarray, distance: VectorDistance) -> float:
+    """Without norms the L2 expansion in LocalIndex.search orders rows by descending dot product"""
+    if distance == VectorDistance.DOT:
+        return 0.0
+    descriptor = descriptor.astype(np.float32)
+    return float(np.dot(descriptor, descriptor))
+
+
+def read_local_index_distance(directory: str) -> VectorDistance:
+    path = os.path.join(directory, 'index.json')
+    if not os.path.exists(path):
+        raise ValueError(f'Local index "{directory}" has no index.json, it should be rebuilt with build_local_index')
+    with open(path, 'r', encoding='utf8') as input_file:
+        return VectorDistance(json.load(input_file)['distance'])
+
+
+def write_local_index_distance(directory: str, distance: VectorDistance):
+    with open(os.path.join(directory, 'index.json'), 'w', encoding='utf8') as output_file:
+        json.dump({'distance': distance.value}, output_file)
+
+
+def build_local_index(session: Session, release_name: str, directory: str,
+                      dtype: DescriptorDType = DescriptorDType.FLOAT16, chunk_size: int = 10000) -> str:
+    statement = select(ReleaseItem.id, ReleaseItem.building_id, ReleaseItem.image_url, ReleaseItem.location,
+                       ReleaseItem.descriptor, ReleaseItem.descriptor_bytes, Release.descriptor_dtype) \
+        .join(Release, Release.id == ReleaseItem.release_id) \
+        .where(Release.name == release_name) \
+        .order_by(ReleaseItem.id)
+    size = session.exec(select(func.count(ReleaseItem.id))
+                        .join(Release, Release.id == ReleaseItem.release_id)
+                        .where(Release.name == release_name)).one()
+    if size == 0:
+        raise ValueError(f'Release "{release_name}" has no items')
+    distance = session.exec(select(Release).where(Release.name == release_name)).one().vector_index_config.distance
+
+    os.makedirs(directory, exist_ok=True)
+    descriptors = None
+    norms = np.empty(size, dtype=np.float32)
+    ids = np.empty(size, dtype=np.int64)
+    building_ids = np.empty(size, dtype=np.int64)
+    locations = np.empty((size, 2), dtype=np.float64)
+    image_urls = []
+
+    result = session.execute(statement.execution_options(stream_results=True)).yield_per(chunk_size)
+    for row_number, (item_id, building_id, image_url, location, descriptor, descriptor_bytes, release_dtype) \
+            in enumerate(result):
+        descriptor = local_index_descriptor(decode_release_item_descriptor(descriptor, descriptor_bytes, release_dtype),
+                                            distance)
+        if descriptors is None:
+            descriptors = np.lib.format.open_memmap(os.path.join(directory, 'descriptors.npy'), mode='w+',
+                                                    dtype=descriptor_dtype_to_numpy[dtype],
+                                                    shape=(size, len(descriptor)))
+        descriptors[row_number] = descriptor
+        norms[row_number] = local_index_norm(descriptors[row_number], distance)
+        ids[row_number], building_ids[row_number] = item_id, building_id
+        point = to_shape(location)
+        locations[row_number] = point.x, point.y
+        image_urls.append(image_url)
+
+    descriptors.flush()
+    np.save(os.path.join(directory, 'norms.npy'), norms)
+    np.save(os.path.join(directory, 'ids.npy'), ids)
+    np.save(os.path.join(directory, 'building_ids.npy'), building_ids)
+    np.save(os.path.join(directory, 'locations.npy'), locations)
+    with open(os.path.join(directory, 'image_urls.json'), 'w', encoding='utf8') as output_file:
+        json.dump(image_urls, output_file)
+    write_local_index_distance(directory, distance)
+    return directory
+
+
+def local_index_directory(release_name: str) -> str:
+    return os.path.join(LOCAL_INDEX_DIRECTORY, release_name)
+
+
+LOCAL_INDEXES: Dict[str, LocalIndex] = {}
+LOCAL_INDEXES_LOCK = threading.Lock()
+
+
+def GetLocalIndex(release_name: str) -> LocalIndex:
+    with LOCAL_INDEXES_LOCK:
+        if release_name not in LOCAL_INDEXES:
+            LOCAL_INDEXES[release_name] = LocalIndex(
+                local_index_directory(release_name),
+                use_faiss=environ.get('LOCAL_INDEX_FAISS', 'false').lower() in ('1', 'true', 'yes'),
+            )
+        return LOCAL_INDEXES[release_name]
@@ -0,0 +1,175 @@
+import dataclasses
+import queue
+import threading
+import time
+from os import environ
+from typing import List, Union
+
+from loguru import logger
+
+from db.clickhouse import GetClickhouseClient
+from db.postgres import GetSQLModelSession
+from libs.metrics import stage
+from services.logs import RequestLog, RecognitionLog, create_requests, create_recognitions
+from services.logs_clickhouse import create_request_logs, create_recognition_logs
+
+LogRecord = Union[RequestLog, RecognitionLog]
+
+
+@dataclasses.dataclass
+class LogSinkStats:
+    enqueued: int = 0
+    dropped: int = 0
+    written: int = 0
+    failed: int = 0
+    batches: int = 0
+
+
+class LogSink:
+    def put(self, record: LogRecord) -> bool:
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BufferedLogSink(LogSink):
+    """
+    Collects log records in a bounded queue which is drained by a background thread.
+    Batch is written when batch_size records are collected or flush_interval seconds have passed.
+    Put is called from async handlers, so it never waits: when the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, max_queue_size: int = 10000, batch_size: int = 256, flush_interval: float = 1.0):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = LogSinkStats()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def put(self, record: LogRecord) -> bool:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._count(dropped=1)
+            return False
+        self._count(enqueued=1)
+        return True
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name=f'{type(self).__name__}Worker', daemon=True)
+        self._worker.start()
+
+    def close(self):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        while batch := self._drain():
+            self._flush(batch)
+
+    def write(self, request_logs: List[RequestLog], recognition_logs: List[RecognitionLog]):
+        raise NotImplementedError
+
+    def _count(self, **increments):
+        with self._stats_lock:
+            for name, value in increments.items():
+                setattr(self.stats, name, getattr(self.stats, name) + value)
+
+    def _drain(self) -> List[LogRecord]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _collect(self) -> List[LogRecord]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: List[LogRecord]):
+        if not batch:
+            return
+        request_logs = [record for record in batch if isinstance(record, RequestLog)]
+        recognition_logs = [record for record in batch if isinstance(record, RecognitionLog)]
+        try:
+            with stage('log_write', sink=type(self).__name__):
+                self.write(request_logs, recognition_logs)
+        except (Exception,) as exception:
+            self._count(failed=len(batch), batches=1)
+            logger.error(f"{type(self).__name__} failed to write {len(batch)} records: {exception}")
+        else:
+            self._count(written=len(batch), batches=1)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush(self._collect())
+        while batch := self._drain():
+            self._flush(batch)
+
+
+class PostgresLogSink(BufferedLogSink):
+    def write(self, request_logs: List[RequestLog], recognition_logs: List[RecognitionLog]):
+        with GetSQLModelSession() as session:
+            create_requests(session, request_logs)
+            create_recognitions(session, recognition_logs)
+            session.commit()
+
+
+class ClickhouseLogSink(BufferedLogSink):
+    def __init__(self, max_queue_size: int = 100000, batch_size: int = 10000, flush_interval: float = 5.0):
+        super().__init__(max_queue_size, batch_size, flush_interval)
+        self.client = None
+
+    def write(self, request_logs: List[RequestLog], recognition_logs: List[RecognitionLog]):
+        if self.client is None:
+            self.client = GetClickhouseClient()
+        create_request_logs(self.client, request_logs)
+        create_recognition_logs(self.client, recognition_logs)
+
+    def close(self):
+        super().close()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+LOG_SINKS = {
+    'postgres': PostgresLogSink,
+    'clickhouse': ClickhouseLogSink,
+}
+
+
+LOG_SINK_SETTINGS = {
+    'max_queue_size': ('LOG_SINK_QUEUE_SIZE', int),
+    'batch_size': ('LOG_SINK_BATCH_SIZE', int),
+    'flush_interval': ('LOG_SINK_FLUSH_INTERVAL', float),
+}
+
+
+def GetLogSink() -> LogSink:
+    sink_type = LOG_SINKS[environ.get('LOG_SINK', 'postgres')]
+    settings = {
+        name: parse(environ[variable])
+        for name, (variable, parse) in LOG_SINK_SETTINGS.items() if variable in environ
+    }
+    return sink_type(**settings)
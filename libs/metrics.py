@@ -0,0 +1,87 @@
+import time
+from contextlib import contextmanager
+
+from aioprometheus import Counter, Gauge, Histogram
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+STAGE_SECONDS = Histogram(
+    'stage_seconds',
+    'Duration of request processing stages',
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    'request_seconds',
+    'Duration of routed requests by endpoint',
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    'requests_total',
+    'Routed requests by endpoint, release name and status code',
+)
+BATCH_SIZE = Histogram(
+    'batch_size',
+    'Number of queries processed together',
+    buckets=BATCH_SIZE_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total',
+    'Cache lookups by cache and result',
+)
+CACHE_SIZE = Gauge(
+    'cache_size',
+    'Number of cached entries',
+)
+DB_POOL = Gauge(
+    'db_pool_connections',
+    'SQLAlchemy connection pool usage by engine and state',
+)
+THREAD_LIMITER = Gauge(
+    'thread_limiter_tokens',
+    'AnyIO default thread limiter tokens by state',
+)
+LOG_SINK_RECORDS = Gauge(
+    'log_sink_records',
+    'Log sink queue size and record counters by state',
+)
+
+
+@contextmanager
+def stage(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe({'stage': name, **labels}, time.perf_counter() - start)
+
+
+def observe_cache(name: str, cache):
+    CACHE_LOOKUPS.set({'cache': name, 'result': 'hit'}, cache.hits)
+    CACHE_LOOKUPS.set({'cache': name, 'result': 'miss'}, cache.misses)
+    CACHE_SIZE.set({'cache': name}, len(cache))
+
+
+def observe_pool(name: str, engine):
+    pool = engine.pool
+    for state, value in (('size', pool.size()), ('checked_out', pool.checkedout()), ('overflow', pool.overflow())):
+        DB_POOL.set({'engine': name, 'state': state}, value)
+
+
+def observe_thread_limiter():
+    from anyio.to_thread import current_default_thread_limiter
+
+    limiter = current_default_thread_limiter()
+    THREAD_LIMITER.set({'state': 'borrowed'}, limiter.borrowed_tokens)
+    THREAD_LIMITER.set({'state': 'total'}, limiter.total_tokens)
+
+
+def observe_log_sink(sink):
+    name = type(sink).__name__
+    queue = getattr(sink, 'queue', None)
+    if queue is not None:
+        LOG_SINK_RECORDS.set({'sink': name, 'state': 'queued'}, queue.qsize())
+    stats = getattr(sink, 'stats', None)
+    if stats is not None:
+        for state in ('enqueued', 'dropped', 'written', 'failed'):
+            LOG_SINK_RECORDS.set({'sink': name, 'state': state}, getattr(stats, state))
@@ -0,0 +1,55 @@
+import struct
+from io import BytesIO
+from typing import Callable, Iterable, Sequence
+
+from sqlmodel import Session
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+
+
+def int4(value: int) -> bytes:
+    return struct.pack('!i', value)
+
+
+def int8(value: int) -> bytes:
+    return struct.pack('!q', value)
+
+
+def text(value: str) -> bytes:
+    return value.encode('utf8')
+
+
+def raw(value: bytes) -> bytes:
+    """bytea, or geometry given as (E)WKB which is the binary input format of PostGIS"""
+    return bytes(value)
+
+
+def binary_copy_buffer(rows: Iterable[Sequence], encoders: Sequence[Callable[[object], bytes]]) -> BytesIO:
+    buffer = BytesIO()
+    buffer.write(COPY_HEADER)
+    field_count = struct.pack('!h', len(encoders))
+    for row in rows:
+        buffer.write(field_count)
+        for value, encoder in zip(row, encoders):
+            if value is None:
+                buffer.write(NULL_FIELD)
+                continue
+            data = encoder(value)
+            buffer.write(struct.pack('!i', len(data)))
+            buffer.write(data)
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(session: Session, table: str, columns: Sequence[str], encoders: Sequence[Callable[[object], bytes]],
+              rows: Iterable[Sequence]):
+    """Streams rows with COPY FROM STDIN (FORMAT binary) inside the session transaction, psycopg2 only"""
+    buffer = binary_copy_buffer(rows, encoders)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN (FORMAT binary)", buffer)
+    finally:
+        cursor.close()
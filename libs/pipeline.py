@@ -0,0 +1,197 @@
+import dataclasses
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+END = object()
+
+
+@dataclasses.dataclass
+class Stage:
+    """
+    Step of StagePipeline run by workers threads. Function gets an item, or a list of up to batch_size items
+    collected within max_wait seconds, and returns an output, None to drop the item,
+    or an iterable of outputs when flatten is set
+    """
+    name: str
+    function: Callable
+    workers: int = 1
+    batch_size: Optional[int] = None
+    max_wait: float = 0.5
+    flatten: bool = False
+    queue_size: Optional[int] = None
+
+
+@dataclasses.dataclass
+class StageStats:
+    received: int = 0
+    emitted: int = 0
+    busy: float = 0
+
+    def utilization(self, workers: int, wall_time: float) -> float:
+        return self.busy / (workers * wall_time) if wall_time else 0
+
+
+class StagePipeline:
+    """
+    Runs stages concurrently, stages are connected with bounded queues, so a slow stage blocks producers
+    instead of accumulating items and throughput is limited by the slowest stage.
+    The first exception stops all stages and is raised to the consumer.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 16, poll_interval: float = 0.1):
+        self.stages = stages
+        self.poll_interval = poll_interval
+        self.queues = [queue.Queue(maxsize=stage.queue_size or queue_size) for stage in stages] + \
+                      [queue.Queue(maxsize=queue_size)]
+        self.stats = {stage.name: StageStats() for stage in stages}
+        self.stopped = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.finished_workers = [0] * len(stages)
+        self.lock = threading.Lock()
+        self.started_at = None
+
+    def put(self, target: queue.Queue, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                target.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, source: queue.Queue, timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.stopped.is_set():
+            wait = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return source.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return END
+
+    def fail(self, error: BaseException):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stopped.set()
+
+    def feed(self, items: Iterable):
+        try:
+            for item in items:
+                if not self.put(self.queues[0], item):
+                    return
+            self.put(self.queues[0], END)
+        except BaseException as error:
+            self.fail(error)
+
+    def next_input(self, index: int):
+        stage, source = self.stages[index], self.queues[index]
+        item = self.get(source)
+        if stage.batch_size is None or item is END:
+            return item
+        batch = [item]
+        deadline = time.monotonic() + stage.max_wait
+        while len(batch) < stage.batch_size:
+            try:
+                item = self.get(source, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is END:
+                # other workers of the stage and the stage itself should see the end after this batch
+                self.put(source, END)
+                break
+            batch.append(item)
+        return batch
+
+    def work(self, index: int):
+        stage, target, stats = self.stages[index], self.queues[index + 1], self.stats[self.stages[index].name]
+        try:
+            while (item := self.next_input(index)) is not END:
+                start = time.perf_counter()
+                output = stage.function(item)
+                outputs = [] if output is None else list(output) if stage.flatten else [output]
+                with self.lock:
+                    stats.received += len(item) if stage.batch_size is not None else 1
+                    stats.emitted += len(outputs)
+                    stats.busy += time.perf_counter() - start
+                for output in outputs:
+                    if not self.put(target, output):
+                        return
+            self.put(self.queues[index], END)
+            with self.lock:
+                self.finished_workers[index] += 1
+                last = self.finished_workers[index] == stage.workers
+            if last:
+                self.put(target, END)
+        except BaseException as error:
+            logger.exception(f'Stage "{stage.name}" failed')
+            self.fail(error)
+
+    def __call__(self, items: Iterable) -> Iterator:
+        self.started_at = time.perf_counter()
+        threads = [threading.Thread(target=self.feed, args=(items,), name='pipeline_feed', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=self.work, args=(index,), name=f'pipeline_{stage.name}_{worker}', daemon=True)
+                for worker in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            while (output := self.get(self.queues[-1])) is not END:
+                yield output
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def log_stats(self):
+        wall_time = time.perf_counter() - self.started_at if self.started_at else 0
+        for stage in self.stages:
+            stats = self.stats[stage.name]
+            logger.info(f'Stage "{stage.name}": {stats.received} in, {stats.emitted} out, '
+                        f'{stats.busy:.1f}s busy, {stats.utilization(stage.workers, wall_time):.0%} utilization '
+                        f'of {stage.workers} workers')
+
+
+@dataclasses.dataclass
+class SharedArrays:
+    """Arrays copied into one shared memory block, only the block name and layout are pickled between processes"""
+    name: Optional[str]
+    layout: List[Tuple[tuple, str, int]]
+
+    @classmethod
+    def create(cls, arrays: List[np.ndarray]) -> 'SharedArrays':
+        size = sum(array.nbytes for array in arrays)
+        if size == 0:
+            return cls(name=None, layout=[(array.shape, array.dtype.str, 0) for array in arrays])
+        block = shared_memory.SharedMemory(create=True, size=size)
+        layout, offset = [], 0
+        for array in arrays:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=offset)[...] = array
+            layout.append((array.shape, array.dtype.str, offset))
+            offset += array.nbytes
+        block.close()
+        return cls(name=block.name, layout=layout)
+
+    def take(self) -> List[np.ndarray]:
+        """Copies arrays out and releases the block, can be called once"""
+        if self.name is None:
+            return [np.empty(shape, dtype=dtype) for shape, dtype, _ in self.layout]
+        block = shared_memory.SharedMemory(name=self.name)
+        try:
+            return [np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset).copy()
+                    for shape, dtype, offset in self.layout]
+        finally:
+            block.close()
+            block.unlink()
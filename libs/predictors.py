@@ -1,11 +1,22 @@
+import asyncio
 import dataclasses
-from typing import List
+from typing import List, Union, Dict, Optional
 
-from qdrant_client import QdrantClient
+import numpy as np
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.http.models import ScoredPoint, Filter, SearchParams
+from shapely import Point
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from libs.local_index import LocalIndex, GetLocalIndex
+from libs.metrics import stage
+from libs.projection import Projection, rerank
 from models import ReleaseItem
-from services.release import search_vector_release_item
+from models.release import VectorDistance
+from services.release import search_vector_release_items, release_item_from_payload, payload_is_complete, \
+    select_release_items_by_ids, async_search_vector_release_items, async_select_release_items_by_ids, \
+    geo_radius_filter, select_release_item_descriptors, async_select_release_item_descriptors
 
 
 @dataclasses.dataclass
@@ -18,21 +29,274 @@ class Prediction:
 
 
 class PredictorBase:
-    def __init__(self, qdrant_client: QdrantClient, release_name: str, limit: int = 15):
+    """
+    When geo_radius is set, queries with a point are searched among release items within geo_radius meters,
+    queries with no release items that close are searched over the whole release
+    """
+
+    with_payload = False
+
+    def __init__(self, qdrant_client: Optional[Union[QdrantClient, AsyncQdrantClient]], release_name: str,
+                 limit: int = 15, geo_radius: Optional[float] = None, search_params: Optional[SearchParams] = None):
         self.release_name = release_name
         self.qdrant_client = qdrant_client
         self.limit = limit
+        self.geo_radius = geo_radius
+        self.search_params = search_params
+
+    def predict(self, session: Session, vector: List[float], point: Optional[Point] = None) -> Prediction:
+        return self.predict_batch(session, [vector], [point])[0]
 
-    def predict(self, session: Session, vector: List[float]) -> Prediction:
+    def predict_batch(self, session: Session, vectors: List[List[float]],
+                      points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
         raise NotImplementedError
 
+    async def async_predict(self, session: AsyncSession, vector: List[float],
+                            point: Optional[Point] = None) -> Prediction:
+        return (await self.async_predict_batch(session, [vector], [point]))[0]
+
+    async def async_predict_batch(self, session: AsyncSession, vectors: List[List[float]],
+                                  points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        raise NotImplementedError
+
+    def query_filters(self, points: Optional[List[Optional[Point]]]) -> Optional[List[Optional[Filter]]]:
+        if self.geo_radius is None or points is None or all(point is None for point in points):
+            return None
+        return [None if point is None else geo_radius_filter(point, self.geo_radius) for point in points]
+
+    @staticmethod
+    def unmatched_indices(batch_closest: List[List[ScoredPoint]],
+                          query_filters: Optional[List[Optional[Filter]]]) -> List[int]:
+        if query_filters is None:
+            return []
+        return [index for index, (n_closest, query_filter) in enumerate(zip(batch_closest, query_filters))
+                if query_filter is not None and not n_closest]
+
+    def search(self, vectors: List[List[float]], points: Optional[List[Optional[Point]]]) -> List[List[ScoredPoint]]:
+        query_filters = self.query_filters(points)
+        with stage('vector_search'):
+            batch_closest = search_vector_release_items(
+                client=self.qdrant_client,
+                collection_name=self.release_name,
+                vectors=vectors,
+                limit=self.limit,
+                with_payload=self.with_payload,
+                query_filters=query_filters,
+                params=self.search_params,
+            )
+        unmatched = self.unmatched_indices(batch_closest, query_filters)
+        if unmatched:
+            with stage('vector_search_fallback'):
+                fallback = search_vector_release_items(
+                    client=self.qdrant_client,
+                    collection_name=self.release_name,
+                    vectors=[vectors[index] for index in unmatched],
+                    limit=self.limit,
+                    with_payload=self.with_payload,
+                    params=self.search_params,
+                )
+            for index, n_closest in zip(unmatched, fallback):
+                batch_closest[index] = n_closest
+        return batch_closest
+
+    async def async_search(self, vectors: List[List[float]],
+                           points: Optional[List[Optional[Point]]]) -> List[List[ScoredPoint]]:
+        query_filters = self.query_filters(points)
+        with stage('vector_search'):
+            batch_closest = await async_search_vector_release_items(
+                client=self.qdrant_client,
+                collection_name=self.release_name,
+                vectors=vectors,
+                limit=self.limit,
+                with_payload=self.with_payload,
+                query_filters=query_filters,
+                params=self.search_params,
+            )
+        unmatched = self.unmatched_indices(batch_closest, query_filters)
+        if unmatched:
+            with stage('vector_search_fallback'):
+                fallback = await async_search_vector_release_items(
+                    client=self.qdrant_client,
+                    collection_name=self.release_name,
+                    vectors=[vectors[index] for index in unmatched],
+                    limit=self.limit,
+                    with_payload=self.with_payload,
+                    params=self.search_params,
+                )
+            for index, n_closest in zip(unmatched, fallback):
+                batch_closest[index] = n_closest
+        return batch_closest
+
 
 class PredictByClosestDescriptor(PredictorBase):
-    def predict(self, session: Session, vector: List[float]) -> Prediction:
-        n_closest = search_vector_release_item(
-            client=self.qdrant_client,
-            collection_name=self.release_name,
-            vector=vector,
-            limit=self.limit
+    def predict_batch(self, session: Session, vectors: List[List[float]],
+                      points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        batch_closest = self.search(vectors, points)
+        with stage('release_item_fetch'):
+            fetched = select_release_items_by_ids(
+                session=session,
+                ids=[scored_point.id for n_closest in batch_closest for scored_point in n_closest],
+            )
+        return self.predictions_from_fetched(batch_closest, fetched)
+
+    async def async_predict_batch(self, session: AsyncSession, vectors: List[List[float]],
+                                  points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        batch_closest = await self.async_search(vectors, points)
+        with stage('release_item_fetch'):
+            fetched = await async_select_release_items_by_ids(
+                session=session,
+                ids=[scored_point.id for n_closest in batch_closest for scored_point in n_closest],
+            )
+        return self.predictions_from_fetched(batch_closest, fetched)
+
+    @staticmethod
+    def predictions_from_fetched(batch_closest: List[List[ScoredPoint]],
+                                 fetched: Dict[int, ReleaseItem]) -> List[Prediction]:
+        return [
+            Prediction(closest=[fetched[scored_point.id] for scored_point in n_closest if scored_point.id in fetched])
+            for n_closest in batch_closest
+        ]
+
+
+class PredictByPayload(PredictorBase):
+    """Builds release items from Qdrant payloads, Postgres is queried only for points with incomplete payload"""
+
+    with_payload = True
+
+    def predict_batch(self, session: Session, vectors: List[List[float]],
+                      points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        return self.predict_batch_from_payload(session, self.search(vectors, points))
+
+    async def async_predict_batch(self, session: AsyncSession, vectors: List[List[float]],
+                                  points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        return await self.async_predict_batch_from_payload(session, await self.async_search(vectors, points))
+
+    def predict_batch_from_payload(self, session: Session, batch_closest: List[List[ScoredPoint]]) -> List[Prediction]:
+        with stage('release_item_fetch'):
+            fetched = select_release_items_by_ids(session, self.incomplete_payload_ids(batch_closest))
+        return self.predictions_from_payload(batch_closest, fetched)
+
+    async def async_predict_batch_from_payload(self, session: AsyncSession,
+                                               batch_closest: List[List[ScoredPoint]]) -> List[Prediction]:
+        with stage('release_item_fetch'):
+            fetched = await async_select_release_items_by_ids(session, self.incomplete_payload_ids(batch_closest))
+        return self.predictions_from_payload(batch_closest, fetched)
+
+    @staticmethod
+    def incomplete_payload_ids(batch_closest: List[List[ScoredPoint]]) -> List[int]:
+        return [scored_point.id for n_closest in batch_closest for scored_point in n_closest
+                if not payload_is_complete(scored_point)]
+
+    @staticmethod
+    def predictions_from_payload(batch_closest: List[List[ScoredPoint]],
+                                 fetched: Dict[int, ReleaseItem]) -> List[Prediction]:
+        predictions = []
+        for n_closest in batch_closest:
+            closest = []
+            for scored_point in n_closest:
+                if payload_is_complete(scored_point):
+                    closest.append(release_item_from_payload(scored_point))
+                elif scored_point.id in fetched:
+                    closest.append(fetched[scored_point.id])
+            predictions.append(Prediction(closest=closest))
+        return predictions
+
+
+class PredictByLocalIndex(PredictorBase):
+    """Searches a memory-mapped copy of the release in process, neither Qdrant nor Postgres is queried"""
+
+    def __init__(self, qdrant_client: Optional[Union[QdrantClient, AsyncQdrantClient]], release_name: str,
+                 limit: int = 15, geo_radius: Optional[float] = None, search_params: Optional[SearchParams] = None,
+                 local_index: Optional[LocalIndex] = None):
+        super().__init__(qdrant_client, release_name, limit, geo_radius, search_params)
+        self.local_index = GetLocalIndex(release_name) if local_index is None else local_index
+
+    def search_rows(self, vectors: List[List[float]], points: Optional[List[Optional[Point]]]) -> List[np.ndarray]:
+        queries = np.asarray(vectors, dtype=np.float32)
+        batch_rows = [None] * len(queries)
+        unfiltered = []
+        for index, point in enumerate(points or [None] * len(queries)):
+            rows = None if self.geo_radius is None or point is None else \
+                self.local_index.rows_within(point, self.geo_radius)
+            if rows is None or len(rows) == 0:
+                unfiltered.append(index)
+                continue
+            batch_rows[index] = self.local_index.search(queries[index:index + 1], self.limit, rows)[0]
+        if unfiltered:
+            for index, rows in zip(unfiltered, self.local_index.search(queries[unfiltered], self.limit)):
+                batch_rows[index] = rows
+        return batch_rows
+
+    def release_item(self, row: int) -> ReleaseItem:
+        return ReleaseItem(
+            id=int(self.local_index.ids[row]),
+            building_id=int(self.local_index.building_ids[row]),
+            image_url=self.local_index.image_urls[row],
         )
-        return Prediction(closest=[session.get(ReleaseItem, scored_point.id) for scored_point in n_closest])
+
+    def predict_batch(self, session: Optional[Session], vectors: List[List[float]],
+                      points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        with stage('local_search'):
+            batch_rows = self.search_rows(vectors, points)
+        return [Prediction(closest=[self.release_item(row) for row in rows]) for rows in batch_rows]
+
+    async def async_predict_batch(self, session: Optional[AsyncSession], vectors: List[List[float]],
+                                  points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        return await asyncio.to_thread(self.predict_batch, None, vectors, points)
+
+
+class PredictByProjection(PredictorBase):
+    """
+    Projects query descriptors and passes them to the wrapped predictor, which should search the projected collection.
+    With rerank_limit the wrapped predictor returns rerank_limit candidates, which are ordered by exact distance
+    of the release between full descriptors stored in Postgres.
+    """
+
+    def __init__(self, predictor: PredictorBase, projection: Projection, release_name: str,
+                 rerank_limit: Optional[int] = None, distance: VectorDistance = VectorDistance.EUCLID):
+        super().__init__(predictor.qdrant_client, release_name, predictor.limit, predictor.geo_radius,
+                         predictor.search_params)
+        self.predictor = predictor
+        self.projection = projection
+        self.rerank_limit = rerank_limit
+        self.distance = distance
+        if rerank_limit is not None:
+            self.predictor.limit = max(rerank_limit, self.limit)
+
+    def predict_batch(self, session: Session, vectors: List[List[float]],
+                      points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        predictions = self.predictor.predict_batch(session, self.projection.transform(vectors).tolist(), points)
+        if self.rerank_limit is None:
+            return predictions
+        with stage('rerank_fetch'):
+            descriptors = select_release_item_descriptors(session, self.candidate_ids(predictions))
+        with stage('rerank'):
+            return self.reranked(vectors, predictions, descriptors)
+
+    async def async_predict_batch(self, session: AsyncSession, vectors: List[List[float]],
+                                  points: Optional[List[Optional[Point]]] = None) -> List[Prediction]:
+        predictions = await self.predictor.async_predict_batch(session, self.projection.transform(vectors).tolist(),
+                                                               points)
+        if self.rerank_limit is None:
+            return predictions
+        with stage('rerank_fetch'):
+            descriptors = await async_select_release_item_descriptors(session, self.candidate_ids(predictions))
+        with stage('rerank'):
+            return self.reranked(vectors, predictions, descriptors)
+
+    @staticmethod
+    def candidate_ids(predictions: List[Prediction]) -> List[int]:
+        return list({release_item.id for prediction in predictions for release_item in prediction.closest})
+
+    def reranked(self, vectors: List[List[float]], predictions: List[Prediction],
+                 descriptors: Dict[int, np.ndarray]) -> List[Prediction]:
+        reranked = []
+        for vector, prediction in zip(vectors, predictions):
+            closest = [release_item for release_item in prediction.closest if release_item.id in descriptors]
+            if closest:
+                order = rerank(np.asarray(vector, dtype=np.float32),
+                               np.asarray([descriptors[release_item.id] for release_item in closest], dtype=np.float32),
+                               self.distance)
+                closest = [closest[index] for index in order[:self.limit]]
+            reranked.append(Prediction(closest=closest))
+        return reranked
@@ -0,0 +1,96 @@
+import dataclasses
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+
+from models.release import VectorDistance
+
+
+@dataclasses.dataclass
+class Projection:
+    """
+    Linear projection x -> normalize((x - mean) @ components.T) fitted with PCA.
+    With whitening every component is divided by the square root of its variance.
+    """
+    mean: np.ndarray
+    components: np.ndarray
+    whiten: bool = False
+
+    @property
+    def input_size(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def output_size(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, descriptors: np.ndarray, output_size: int, whiten: bool = False, eps: float = 1e-6) -> 'Projection':
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        if output_size > min(descriptors.shape):
+            raise ValueError(f"Can not fit {output_size} components on {descriptors.shape} sample")
+        mean = descriptors.mean(axis=0)
+        centered = descriptors - mean
+        covariance = (centered.T @ centered).astype(np.float64) / max(len(descriptors) - 1, 1)
+        variances, vectors = np.linalg.eigh(covariance)
+        top = np.argsort(variances)[::-1][:output_size]
+        components = vectors[:, top].T
+        if whiten:
+            components = components / np.sqrt(variances[top] + eps)[:, None]
+        return cls(mean=mean, components=components.astype(np.float32), whiten=whiten)
+
+    def transform(self, descriptors: Union[np.ndarray, List[List[float]]]) -> np.ndarray:
+        projected = (np.asarray(descriptors, dtype=np.float32) - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected / np.maximum(norms, np.finfo(np.float32).eps)
+
+    def mean_bytes(self) -> bytes:
+        return self.mean.astype('<f4').tobytes()
+
+    def components_bytes(self) -> bytes:
+        return self.components.astype('<f4').tobytes()
+
+    @classmethod
+    def from_bytes(cls, mean: bytes, components: bytes, input_size: int, output_size: int,
+                   whiten: bool) -> 'Projection':
+        return cls(
+            mean=np.frombuffer(mean, dtype='<f4').astype(np.float32),
+            components=np.frombuffer(components, dtype='<f4').astype(np.float32).reshape(output_size, input_size),
+            whiten=whiten,
+        )
+
+
+def top_k(database: np.ndarray, queries: np.ndarray, k: int, exclude_self: bool = False) -> np.ndarray:
+    distances = (database ** 2).sum(axis=1)[None, :] - 2 * queries @ database.T
+    if exclude_self:
+        distances[np.arange(len(queries)), np.arange(len(queries))] = np.inf
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(np.take_along_axis(distances, top, axis=1), axis=1), axis=1)
+
+
+def measure_recall(projection: Projection, descriptors: np.ndarray, queries_size: int = 1000,
+                   k_values: Iterable[int] = (1, 5, 10, 50)) -> Dict[int, float]:
+    """
+    Share of sample descriptors whose exact nearest neighbour among full descriptors
+    is found within k nearest neighbours among projected descriptors, first queries_size rows are used as queries
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    queries_size = min(queries_size, len(descriptors))
+    k_values = [k for k in k_values if k < len(descriptors)]
+    if not k_values:
+        return {}
+    exact = top_k(descriptors, descriptors[:queries_size], 1, exclude_self=True)[:, 0]
+    projected = projection.transform(descriptors)
+    approximate = top_k(projected, projected[:queries_size], max(k_values), exclude_self=True)
+    return {k: float((approximate[:, :k] == exact[:, None]).any(axis=1).mean()) for k in k_values}
+
+
+def rerank(query: np.ndarray, candidates: np.ndarray, distance: VectorDistance = VectorDistance.EUCLID) -> np.ndarray:
+    """Orders candidate descriptors by exact distance to the query, in the same way as Qdrant does for the distance"""
+    if distance == VectorDistance.EUCLID:
+        return np.argsort(((candidates - query) ** 2).sum(axis=1), kind='stable')
+    similarities = candidates @ query
+    if distance == VectorDistance.COSINE:
+        eps = np.finfo(np.float32).eps
+        similarities = similarities / np.maximum(np.linalg.norm(candidates, axis=1) * np.linalg.norm(query), eps)
+    return np.argsort(-similarities, kind='stable')
@@ -1,8 +1,10 @@
 import datetime
 import glob
+import hashlib
 import json
+from collections import defaultdict
 from enum import Enum
-from typing import List
+from typing import Dict, List
 
 import numpy as np
 
@@ -10,6 +12,7 @@ from libs.coordinates import CoordinateSystem, Coordinates
 from libs.s3 import BUCKET, list_objects, get_json
 from libs.utils import rle2mask, path_join
 from models.image import PathImage, Direction, ImageMeta, Layer, ImageSource, S3Resource, ImageType
+from models.pano import PanoSource
 
 
 class PanoDir(Enum):
@@ -24,25 +27,41 @@ pano_source_to_coordinate_system = {
     ImageSource.GOOGLE: CoordinateSystem.ELLIPSOID
 }
 
+image_source_to_pano_source = {
+    ImageSource.GOOGLE: PanoSource.GOOGLE
+}
 
-def pano_ids(bucket: str = BUCKET, sources=None):
+
+def source_prefixes(sources=None) -> List[str]:
     if sources is None:
-        sources = pano_source_to_dir.values()
+        return [pano_dir.value for pano_dir in pano_source_to_dir.values()]
     elif isinstance(sources, ImageSource):
-        sources = [pano_source_to_dir[sources].value]
+        return [pano_source_to_dir[sources].value]
     elif isinstance(sources, PanoDir):
-        sources = [sources.value]
+        return [sources.value]
     elif isinstance(sources, str):
-        sources = [sources]
+        return [sources]
     elif isinstance(sources, List):
         if not all(map(lambda x: isinstance(x, ImageSource), sources)):
             raise Exception("Incorrect type in sources, should be ImageSource or List[ImageSource]")
-    result = []
-    for prefix in sources:
-        objects = list_objects(bucket, prefix)
-        ids = list(
-            filter(lambda x: x != '', set(obj["Key"].removeprefix(f"{prefix}/").split("/")[0] for obj in objects)))
-        result.extend(ids)
+        return [pano_source_to_dir[source].value for source in sources]
+
+
+def pano_ids(bucket: str = BUCKET, sources=None):
+    return list(pano_fingerprints(bucket, sources))
+
+
+def pano_fingerprints(bucket: str = BUCKET, sources=None) -> Dict[str, str]:
+    """Pano ids with a hash of keys and ETags of their objects, it changes when any pano file is replaced"""
+    result = {}
+    for prefix in source_prefixes(sources):
+        pano_objects = defaultdict(list)
+        for obj in list_objects(bucket, prefix):
+            pano_id = obj["Key"].removeprefix(f"{prefix}/").split("/")[0]
+            if pano_id != '':
+                pano_objects[pano_id].append(f'{obj["Key"]}:{obj.get("ETag", "")}')
+        for pano_id, keys in pano_objects.items():
+            result[pano_id] = hashlib.md5('\n'.join(sorted(keys)).encode()).hexdigest()
     return result
 
 
@@ -77,11 +96,14 @@ def google_street_view_local(subpath: str = "") -> List[PathImage]:
     return images
 
 
+def read_pano_meta(pano_id: str, source: ImageSource, bucket: str = BUCKET) -> dict:
+    return get_json(bucket, path_join(pano_source_to_dir[source].value, pano_id, "meta.json"))
+
+
 def path_pano_from_s3(pano_id: str, source: ImageSource, zoom: int, bucket: str = BUCKET,
                       preload_content: bool = False) -> PathImage:
     base = path_join(pano_source_to_dir[source].value, pano_id)
-    meta_path = path_join(base, "meta.json")
-    meta_raw = get_json(bucket, meta_path)
+    meta_raw = read_pano_meta(pano_id, source, bucket)
     meta = parse_meta(meta_raw, source, zoom)
     pano_path = path_join(base, f"{meta.width}x{meta.height}.jpg")
     s3_resource = S3Resource(path=pano_path, bucket=BUCKET)
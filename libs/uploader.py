@@ -0,0 +1,129 @@
+import dataclasses
+import io
+import queue
+import threading
+import time
+import zlib
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from libs import s3
+
+END = object()
+
+
+class UploadSampling(str, Enum):
+    ALL = 'all'
+    EVERY_NTH = 'every_nth'
+    NONE = 'none'
+
+
+@dataclasses.dataclass
+class UploaderConfig:
+    sampling: UploadSampling = UploadSampling.ALL
+    every: int = 10
+    # the longest side of uploaded images, None uploads images in full size
+    thumbnail_size: Optional[int] = 320
+    quality: int = 85
+    workers: int = 8
+    queue_size: int = 256
+    retries: int = 3
+    retry_delay: float = 1
+
+
+class ImageUploader:
+    """
+    Uploads images to S3 from background threads, submit only puts an image into a bounded queue
+    and blocks when uploads fall behind by queue_size images. Paths depend only on keys,
+    so urls are known before the upload and stay the same across runs. Sampling is decided by a hash of the key.
+    Failed uploads are retried and then logged, their urls are kept.
+    """
+
+    def __init__(self, bucket: str, prefix: str, config: UploaderConfig = UploaderConfig(), extension: str = 'jpeg'):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.config = config
+        self.extension = extension
+        self.queue = queue.Queue(maxsize=config.queue_size)
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.failed = 0
+        self.threads = [] if config.sampling == UploadSampling.NONE else [
+            threading.Thread(target=self.work, name=f'uploader_{worker}', daemon=True)
+            for worker in range(config.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def path(self, key: str) -> str:
+        return f'{self.prefix}/{key}.{self.extension}'
+
+    def url(self, key: str) -> str:
+        return f'https://storage.yandexcloud.net/{self.bucket}/{self.path(key)}'
+
+    def sampled(self, key: str) -> bool:
+        if self.config.sampling == UploadSampling.ALL:
+            return True
+        if self.config.sampling == UploadSampling.EVERY_NTH:
+            return zlib.crc32(key.encode('utf8')) % self.config.every == 0
+        return False
+
+    def submit(self, key: str, content: np.ndarray) -> Optional[str]:
+        """Returns url of the image or None when it is not sampled, content should not be modified afterwards"""
+        if not self.sampled(key):
+            return None
+        self.queue.put((key, content))
+        return self.url(key)
+
+    def encode(self, content: np.ndarray) -> io.BytesIO:
+        image = Image.fromarray(content)
+        if self.config.thumbnail_size is not None:
+            image.thumbnail((self.config.thumbnail_size, self.config.thumbnail_size))
+        buffer = io.BytesIO()
+        image.save(buffer, self.extension, quality=self.config.quality)
+        buffer.seek(0)
+        return buffer
+
+    def upload(self, key: str, content: np.ndarray) -> bool:
+        buffer = self.encode(content)
+        for attempt in range(self.config.retries + 1):
+            try:
+                s3.put_object(self.bucket, self.path(key), buffer)
+                return True
+            except Exception as e:
+                if attempt == self.config.retries:
+                    logger.warning(f'Image "{self.path(key)}" is not uploaded: {e}')
+                    return False
+                time.sleep(self.config.retry_delay * 2 ** attempt)
+                buffer.seek(0)
+
+    def work(self):
+        while (task := self.queue.get()) is not END:
+            try:
+                uploaded = self.upload(*task)
+            except Exception as e:
+                logger.warning(f'Image "{self.path(task[0])}" is not encoded: {e}')
+                uploaded = False
+            with self.lock:
+                if uploaded:
+                    self.uploaded += 1
+                else:
+                    self.failed += 1
+
+    def close(self):
+        """Waits for queued uploads"""
+        for _ in self.threads:
+            self.queue.put(END)
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"{self.uploaded} images uploaded to {self.bucket}/{self.prefix}, {self.failed} failed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
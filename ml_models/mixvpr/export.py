@@ -0,0 +1,90 @@
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from ml_models.mixvpr.interface import get_loaded_model, ONNX_PATH, TORCHSCRIPT_PATH
+
+SHAPE = (3, 320, 320)
+
+
+def example_batch(batch_size: int) -> np.ndarray:
+    # Descriptors are extracted from raw 0..255 pixel values, see MixVPRBase.batch
+    return np.random.default_rng(0).uniform(0, 255, (batch_size, *SHAPE)).astype(np.float32)
+
+
+def export_onnx(model: torch.nn.Module, output: str, quantize: bool) -> str:
+    torch.onnx.export(
+        model,
+        torch.from_numpy(example_batch(1)),
+        output,
+        input_names=['images'],
+        output_names=['descriptors'],
+        dynamic_axes={'images': {0: 'batch'}, 'descriptors': {0: 'batch'}},
+        opset_version=17,
+    )
+    if not quantize:
+        return output
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_output = output.replace('.onnx', '.int8.onnx')
+    quantize_dynamic(output, quantized_output, weight_type=QuantType.QInt8)
+    return quantized_output
+
+
+def export_torchscript(model: torch.nn.Module, output: str, quantize: bool) -> str:
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        output = output.replace('.pt', '.int8.pt')
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.from_numpy(example_batch(1)))
+    torch.jit.freeze(traced).save(output)
+    return output
+
+
+def exported_outputs(output_format: str, path: str, batch: np.ndarray) -> np.ndarray:
+    if output_format == 'onnx':
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return session.run(None, {session.get_inputs()[0].name: batch})[0]
+    with torch.no_grad():
+        return torch.jit.load(path, map_location='cpu')(torch.from_numpy(batch)).numpy()
+
+
+def parity(model: torch.nn.Module, output_format: str, path: str, batch_size: int) -> dict:
+    """Compares exported graph with eager model in eval mode on the same batch"""
+    batch = example_batch(batch_size)
+    with torch.no_grad():
+        expected = model(torch.from_numpy(batch)).numpy()
+    actual = exported_outputs(output_format, path, batch)
+    cosine = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    return {
+        'max_abs_diff': float(np.abs(expected - actual).max()),
+        'min_cosine': float(cosine.min()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exports MixVPR to ONNX or TorchScript and checks parity")
+    parser.add_argument('--format', choices=['onnx', 'torchscript'], default='onnx')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--quantize', action='store_true', help="dynamic int8 quantization of linear layers")
+    parser.add_argument('--parity-batch-size', type=int, default=4)
+    parser.add_argument('--min-cosine', type=float, default=None,
+                        help="fail when cosine similarity to eager output is lower, 0.9999 or 0.99 if quantized")
+    arguments = parser.parse_args()
+
+    eager_model = get_loaded_model('cpu').eval()
+    if arguments.format == 'onnx':
+        exported = export_onnx(eager_model, arguments.output or ONNX_PATH, arguments.quantize)
+    else:
+        exported = export_torchscript(eager_model, arguments.output or TORCHSCRIPT_PATH, arguments.quantize)
+
+    report = parity(eager_model, arguments.format, exported, arguments.parity_batch_size)
+    print(f"Exported {exported}, parity with eager model: {report}")
+    min_cosine = arguments.min_cosine or (0.99 if arguments.quantize else 0.9999)
+    if report['min_cosine'] < min_cosine:
+        print(f"Parity check failed: min cosine {report['min_cosine']:.6f} < {min_cosine}")
+        sys.exit(1)
@@ -2,23 +2,30 @@ import torch
 
 from .model import VPRModel
 
+STATE_PATH = 'ml_models/mixvpr/states/resnet50_MixVPR_4096_channels(1024)_rows(4).ckpt'
+ONNX_PATH = 'ml_models/mixvpr/states/mixvpr.onnx'
+TORCHSCRIPT_PATH = 'ml_models/mixvpr/states/mixvpr.pt'
 
-def get_loaded_model(device):
+
+def get_model(pretrained: bool = False):
     # Note that images must be resized to 320x320
-    model = VPRModel(backbone_arch='resnet50',
-                     layers_to_crop=[4],
-                     agg_arch='MixVPR',
-                     agg_config={'in_channels': 1024,
-                                 'in_h': 20,
-                                 'in_w': 20,
-                                 'out_channels': 1024,
-                                 'mix_depth': 4,
-                                 'mlp_ratio': 1,
-                                 'out_rows': 4},
-                     )
+    return VPRModel(backbone_arch='resnet50',
+                    pretrained=pretrained,
+                    layers_to_crop=[4],
+                    agg_arch='MixVPR',
+                    agg_config={'in_channels': 1024,
+                                'in_h': 20,
+                                'in_w': 20,
+                                'out_channels': 1024,
+                                'mix_depth': 4,
+                                'mlp_ratio': 1,
+                                'out_rows': 4},
+                    )
 
-    state_dict = torch.load(
-        'ml_models/mixvpr/states/resnet50_MixVPR_4096_channels(1024)_rows(4).ckpt',
-        map_location=torch.device(device))
+
+def get_loaded_model(device):
+    # backbone weights are overwritten by the state, so ImageNet weights are not downloaded
+    model = get_model(pretrained=False)
+    state_dict = torch.load(STATE_PATH, map_location=torch.device(device))
     model.load_state_dict(state_dict)
     return model
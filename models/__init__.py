@@ -2,6 +2,6 @@ from models.geo import Building, MetroLine, MetroStation, BuildingGroup
 from models.language import Translation, TextContent
 from models.link import RecognitionReleaseItemLink, BuildingMetroLink
 from models.logs import Request, Recognition
-from models.release import Release, ReleaseItem
+from models.release import Release, ReleaseItem, ReleaseProjection, ReleasePano
 from models.pano import Pano, PanoMeta
-from models.pano import Pano, PanoMeta, PanoSpec, PanoSize
+from models.pano import Pano, PanoMeta, PanoSpec, PanoSize, PanoManifest
@@ -1,6 +1,5 @@
 import datetime as dt
 import time
-from copy import deepcopy
 from enum import Enum
 from io import BytesIO
 from typing import Optional, Callable
@@ -133,6 +132,13 @@ class ImageMeta(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
+    def derive(self, **update) -> 'ImageMeta':
+        """
+        Shallow copy with own transformations and tags lists. Layers, descriptor and coordinates are shared,
+        they are replaced instead of being modified in place
+        """
+        return self.copy(update={'transformations': list(self.transformations), 'tags': list(self.tags), **update})
+
 
 class PathImage(BaseModel):
     resource: BaseResource
@@ -146,7 +152,7 @@ class PathImage(BaseModel):
             img = Image.open(self.resource.path)
         else:
             raise Exception("unknown ResourceType value")
-        return NdarrayImage(image=Layer(content=np.array(img.convert("RGB"))), meta=deepcopy(self.meta))
+        return NdarrayImage(image=Layer(content=np.array(img.convert("RGB"))), meta=self.meta.derive())
 
     def save(self, base_resource: BaseResource):
         pass
@@ -173,7 +179,7 @@ class NdarrayImage(BaseModel):
         self.check_layer_dimensions()
 
     def __modify_layers(self, f: Callable[[Layer], Layer]):
-        new_meta = deepcopy(self.meta)
+        new_meta = self.meta.derive()
         if new_meta.annotations:
             new_meta.annotations = f(self.meta.annotations)
         return NdarrayImage(
@@ -3,8 +3,8 @@ from enum import Enum as PythonEnum
 from typing import Optional, List, Any
 
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, UniqueConstraint
-from sqlmodel import Field, Relationship, SQLModel
+from sqlalchemy import Column, UniqueConstraint, Integer
+from sqlmodel import Field, Relationship, SQLModel, ARRAY
 
 from models.base import BaseSQLModel, BaseSQLEnum
 from models.common import CoordinatesSerializable
@@ -91,3 +91,37 @@ class PanoSpec(PanoSpecBase, BaseSQLModel, table=True):
 class PanoSpecRead(PanoMetaBase):
     coordinates: CoordinatesSerializable = None
     panos: List["PanoSizeRead"] = None
+
+
+class PanoManifest(BaseSQLModel, table=True):
+    """
+    Downloaded panos with their coordinates in MAIN_COORDINATE_SYSTEM, used to select panos of an area
+    without reading every meta.json, see importers/panos/manifest.py
+    """
+    __table_args__ = (
+        UniqueConstraint("pano_id", "source", name="unique_manifest_pano_id_for_source"),
+    )
+    pano_id: str = Field(nullable=False)
+    source: PanoSource = Field(
+        sa_column=Column(
+            BaseSQLEnum(PanoSource),
+            nullable=False,
+        )
+    )
+    coordinates: Any = Field(
+        sa_column=Column(
+            Geometry('POINT'),
+            nullable=False,
+        )
+    )
+    direction: float = Field(nullable=False)
+    datetime: Optional[dt] = Field(nullable=True, default=None)
+    zooms: List[int] = Field(
+        default_factory=list,
+        sa_column=Column(
+            ARRAY(Integer),
+            nullable=False,
+        ),
+    )
+    fingerprint: Optional[str] = Field(nullable=True, default=None)
+    updated_at: dt = Field(default_factory=dt.utcnow, nullable=False)
@@ -1,17 +1,82 @@
+from datetime import datetime
+from enum import Enum
 from typing import Optional, Any, List
 
 from geoalchemy2 import Geometry
+from pydantic import BaseModel
+from sqlalchemy import LargeBinary, UniqueConstraint, String
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import Field, ARRAY, Column, Float, Relationship
 
-from models.base import BaseSQLModel
+from libs.descriptors import DescriptorDType
+from models.base import BaseSQLModel, BaseSQLEnum
 from models.link import RecognitionReleaseItemLink
 
 
+class VectorDistance(str, Enum):
+    EUCLID = 'Euclid'
+    COSINE = 'Cosine'
+    DOT = 'Dot'
+
+
+class VectorQuantization(str, Enum):
+    NONE = 'none'
+    SCALAR = 'scalar'
+    PRODUCT = 'product'
+
+
+class VectorIndexConfig(BaseModel):
+    """Qdrant collection and search settings of a release, unset values fall back to Qdrant defaults"""
+    distance: VectorDistance = VectorDistance.EUCLID
+    hnsw_m: Optional[int] = None
+    hnsw_ef_construct: Optional[int] = None
+    search_ef: Optional[int] = None
+    quantization: VectorQuantization = VectorQuantization.NONE
+    scalar_quantile: Optional[float] = None
+    product_compression: str = 'x16'
+    quantization_always_ram: bool = True
+    rescore: bool = True
+    oversampling: Optional[float] = None
+    on_disk: bool = False
+
+
+class ReleasePanoStatus(str, Enum):
+    RELEASED = 'released'
+    FILTERED = 'filtered'
+
+
 class Release(BaseSQLModel, table=True):
     name: str = Field(nullable=False, unique=True)
+    base_release_id: Optional[int] = Field(foreign_key='release.id', nullable=True, default=None)
+    # dtype of ReleaseItem.descriptor_bytes, releases without it store float8 arrays in ReleaseItem.descriptor
+    descriptor_dtype: Optional[DescriptorDType] = Field(
+        default=None,
+        sa_column=Column(
+            String,
+            nullable=True,
+        ),
+    )
+    index_config: dict = Field(
+        default_factory=dict,
+        sa_column=Column(
+            JSONB,
+            nullable=False,
+            server_default='{}',
+        ),
+    )
     items: List['ReleaseItem'] = Relationship(
         back_populates='release'
     )
+    projections: List['ReleaseProjection'] = Relationship(
+        back_populates='release'
+    )
+    panos: List['ReleasePano'] = Relationship(
+        back_populates='release'
+    )
+
+    @property
+    def vector_index_config(self) -> VectorIndexConfig:
+        return VectorIndexConfig.parse_obj(self.index_config or {})
 
 
 class ReleaseItem(BaseSQLModel, table=True):
@@ -20,6 +85,7 @@ class ReleaseItem(BaseSQLModel, table=True):
         back_populates='items',
     )
     building_id: Optional[int] = Field(foreign_key='building.id', nullable=False)
+    pano_id: Optional[str] = Field(nullable=True, default=None, index=True)
     image_url: Optional[str] = Field(nullable=False)
     location: Any = Field(
         sa_column=Column(
@@ -27,11 +93,74 @@ class ReleaseItem(BaseSQLModel, table=True):
             nullable=False,
         ),
     )
-    descriptor: List[float] = Field(
+    descriptor: Optional[List[float]] = Field(
+        default=None,
         sa_column=Column(
             ARRAY(Float),
-            nullable=False,
+            nullable=True,
+        ),
+    )
+    descriptor_bytes: Optional[bytes] = Field(
+        default=None,
+        sa_column=Column(
+            LargeBinary,
+            nullable=True,
         ),
     )
     recognitions: List['Recognition'] = Relationship(back_populates="release_items",
                                                      link_model=RecognitionReleaseItemLink)
+
+
+class ReleaseProjection(BaseSQLModel, table=True):
+    __table_args__ = (UniqueConstraint('release_id', 'version'),)
+
+    release_id: Optional[int] = Field(foreign_key='release.id', nullable=False)
+    release: Optional[Release] = Relationship(
+        back_populates='projections',
+    )
+    version: int = Field(nullable=False)
+    collection_name: str = Field(nullable=False, unique=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    input_size: int = Field(nullable=False)
+    output_size: int = Field(nullable=False)
+    whiten: bool = Field(nullable=False)
+    sample_size: int = Field(nullable=False)
+    mean: bytes = Field(
+        sa_column=Column(
+            LargeBinary,
+            nullable=False,
+        ),
+    )
+    components: bytes = Field(
+        sa_column=Column(
+            LargeBinary,
+            nullable=False,
+        ),
+    )
+    recall: dict = Field(
+        default_factory=dict,
+        sa_column=Column(
+            JSONB,
+            nullable=False,
+            server_default='{}',
+        ),
+    )
+
+
+class ReleasePano(BaseSQLModel, table=True):
+    """Pano processed by a release build, used to resume failed builds and to find unchanged panos of a base release"""
+    __table_args__ = (UniqueConstraint('release_id', 'pano_id'),)
+
+    release_id: Optional[int] = Field(foreign_key='release.id', nullable=False)
+    release: Optional[Release] = Relationship(
+        back_populates='panos',
+    )
+    pano_id: str = Field(nullable=False)
+    fingerprint: str = Field(nullable=False)
+    status: ReleasePanoStatus = Field(
+        sa_column=Column(
+            BaseSQLEnum(ReleasePanoStatus),
+            nullable=False,
+        ),
+    )
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
@@ -0,0 +1,24 @@
+import argparse
+
+from loguru import logger
+
+from db.postgres import GetSQLModelSession
+from libs.descriptors import DescriptorDType
+from libs.local_index import build_local_index, local_index_directory
+
+
+def export_local_index(release_name: str, directory: str = None, dtype: DescriptorDType = DescriptorDType.FLOAT16):
+    if directory is None:
+        directory = local_index_directory(release_name)
+    with GetSQLModelSession() as session:
+        build_local_index(session, release_name, directory, dtype)
+    logger.info(f"Local index of release {release_name} exported to {directory}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exports release from Postgres to memory-mapped local index")
+    parser.add_argument('release_name')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--dtype', type=DescriptorDType, default=DescriptorDType.FLOAT16)
+    arguments = parser.parse_args()
+    export_local_index(arguments.release_name, arguments.directory, arguments.dtype)
@@ -1,24 +1,35 @@
 import dataclasses
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import Iterator
+from typing import Dict, List, Optional
 
 from loguru import logger
+from qdrant_client import QdrantClient
+from sqlmodel import Session
 from tqdm import tqdm
 
 from db.postgres import GetSQLModelSession
 from db.qdrant import GetQdrantClient
-from libs.features import Resizer, PanoGeoCropper, DescriptorExtractor, MixVPR, SquareCrop
+from libs.descriptors import DescriptorDType
+from libs.features import DescriptorExtractor, MixVPR
+from libs.pipeline import Stage, StagePipeline
 from libs.filter import AreaPathImageFilter
-from libs.readers import path_pano_from_s3, pano_ids
+from libs.readers import path_pano_from_s3, pano_fingerprints, image_source_to_pano_source
 from libs.s3 import DEBUG_BUCKET
-from libs.utils import generate_release_name, generate_hex_uuid, pool_executor, chunks
+from libs.uploader import ImageUploader, UploaderConfig
+from libs.utils import generate_release_name, chunks
 from models import Release
+from models.release import VectorIndexConfig, ReleasePanoStatus, ReleaseItem, ReleasePano
+from releasers.projection import ProjectionConfig, project_release
 from models.geo import Area
-from models.image import PathImage, ImageSource, S3Resource, FILE_EXTENSION
+from models.image import PathImage, NdarrayImage, ImageSource, FILE_EXTENSION
+from releasers.workers import create_crop_pool, crop_pano, crops_from_shared
 from resources.areas.main import ZAMOSKVORECHE
 from services.release import create_release, create_vector_release, create_release_item, \
-    export_release_items
+    export_release_items, select_release, create_release_pano, select_release_pano_fingerprints, \
+    select_unchanged_release_panos, copy_release_items, allocate_release_item_ids, insert_release_items, \
+    delete_release_panos, delete_vector_release_items
+from services.pano import select_area_pano_ids, select_pano_manifest_fingerprints
 
 
 @dataclass
@@ -38,6 +49,28 @@ class DescriptorConfig:
     device: str = 'cpu'
 
 
+@dataclass
+class PipelineConfig:
+    """Worker counts and batch sizes of release pipeline stages, see Releaser.pipeline"""
+    meta_workers: int = 16
+    crop_processes: int = 4
+    # render model inputs with PanoGeoSquareCropper instead of cropping and resizing full perspective views
+    fused_crop: bool = True
+    inference_panos: int = 4
+    write_panos: int = 64
+    queue_size: int = 16
+
+
+@dataclass
+class PanoTask:
+    pano_id: str
+    fingerprint: str
+    path_image: Optional[PathImage] = None
+    in_area: bool = True
+    crops: List[NdarrayImage] = dataclasses.field(default_factory=list)
+    image_urls: List[str] = dataclasses.field(default_factory=list)
+
+
 @dataclasses.dataclass
 class ReleaseConfig:
     area: Area
@@ -46,122 +79,231 @@ class ReleaseConfig:
     remote: RemoteConfig
     zoom: int
     name: str = dataclasses.field(default_factory=generate_release_name)
+    index: VectorIndexConfig = dataclasses.field(default_factory=VectorIndexConfig)
+    projection: Optional[ProjectionConfig] = None
+    resume: bool = False
+    base_release: Optional[str] = None
+    pipeline: PipelineConfig = dataclasses.field(default_factory=PipelineConfig)
+    uploader: UploaderConfig = dataclasses.field(default_factory=UploaderConfig)
+    use_manifest: bool = True
+    # None stores descriptors as float8 arrays inserted through the ORM instead of COPY
+    descriptor_dtype: Optional[DescriptorDType] = DescriptorDType.FLOAT32
 
     class Config:
         arbitrary_types_allowed = True
 
 
 class Releaser:
+    """
+    Builds a release with a staged pipeline, every written pano is stored as ReleasePano together with its items.
+    With resume an existing release named config.name continues from panos that are not processed yet.
+    With base_release panos whose objects are unchanged are copied from the base release without inference,
+    the base release should be built for the same area, source and zoom.
+    """
+
     def __init__(self, config: ReleaseConfig):
         self.config = config
         self.descriptor_extractor = self.config.descriptor_config.extractor(
-            batch_size=self.config.descriptor_config.batch_size
+            batch_size=self.config.descriptor_config.batch_size,
+            device=self.config.descriptor_config.device,
         )
         with GetSQLModelSession() as session:
-            db_release = create_release(session=session, name=self.config.name)
             qdrant_client = GetQdrantClient()
-            create_vector_release(
-                client=qdrant_client,
-                collection_name=db_release.name,
-                vector_size=self.descriptor_extractor.descriptor_size()
-            )
+            self.qdrant_client = qdrant_client
+            db_release = select_release(session, self.config.name) if self.config.resume else None
+            if db_release is None:
+                base_release = None
+                if self.config.base_release is not None:
+                    base_release = select_release(session, self.config.base_release)
+                    if base_release is None:
+                        raise Exception(f'Base release "{self.config.base_release}" does not exist')
+                db_release = create_release(session=session, name=self.config.name, index_config=self.config.index,
+                                            base_release=base_release, descriptor_dtype=self.config.descriptor_dtype)
+                create_vector_release(
+                    client=qdrant_client,
+                    collection_name=db_release.name,
+                    vector_size=self.descriptor_extractor.descriptor_size(),
+                    index_config=self.config.index,
+                )
+            else:
+                logger.info(f'Resuming release "{db_release.name}"')
             self.release_name = db_release.name
 
-            pano_ids_from_source = pano_ids(sources=self.config.source)
-
-            for chunk in tqdm(list(chunks(pano_ids_from_source, 1024)), desc="Parsing chunks"):
-                # for chunk in tqdm(chunks(pano_ids_from_source, 1024), desc="Parsing chunks"):
-                path_images = pool_executor(
-                    items=chunk,
-                    processor_fn=path_pano_from_s3,
-                    processor_args=[self.config.source, self.config.zoom],
-                    processor_kwargs={"preload_content": False},
-                    tqdm_desc="Downloading panos",
-                    max_workers=10,
-                    executor_type="thread",
-                )
+            fingerprints = pano_fingerprints(sources=self.config.source)
+            processed = select_release_pano_fingerprints(session, db_release.id)
+            if db_release.base_release_id is not None:
+                self.copy_unchanged_panos(session, qdrant_client, db_release, fingerprints, processed)
+                processed = select_release_pano_fingerprints(session, db_release.id)
+            pending_pano_ids = [pano_id for pano_id in fingerprints if pano_id not in processed]
+            if self.config.use_manifest:
+                pending_pano_ids = self.select_area_panos(session, fingerprints, pending_pano_ids)
+            logger.info(f"{len(processed)} panos are already processed, {len(pending_pano_ids)} are pending")
 
-                area_filter = AreaPathImageFilter(self.config.area)
-                filtered_path_images = []
-                for path_image in tqdm(path_images, desc="Filtering panos"):
-                    if area_filter.filter(path_image):
-                        filtered_path_images.append(path_image)
-
-                if not self.config.remote.active:
-                    chunked_filtered_path_images = chunks(filtered_path_images, 64)
-                    _ = pool_executor(
-                        items=list(chunked_filtered_path_images),
-                        processor_fn=generate_release_items,
-                        processor_args=[config, db_release.id],
-                        processor_kwargs=dict(),
-                        tqdm_desc="Releasing panos",
-                        max_workers=8,
-                        executor_type="process",
-                    )
-                else:
-                    raise Exception("Distributed generation is not implemented yet")
-                    # ray.init()
-                    # actors = [RemoteRealeaseItemGenerator.remote(self.config) for _ in range(5)]
-                    # pool = ActorPool(actors)
-                    # results = list(
-                    #     pool.map_unordered(
-                    #         fn=lambda actor, value: actor.release.remote(value),
-                    #         values=path_images_in_selected_area
-                    #     )
-                    # )
+            if self.config.remote.active:
+                raise Exception("Distributed generation is not implemented yet")
+            self.release_id = db_release.id
+            self.area_filter = AreaPathImageFilter(self.config.area)
+            self.write_session = GetSQLModelSession()
+            self.uploader = ImageUploader(DEBUG_BUCKET, f'releases/{self.release_name}', self.config.uploader,
+                                          FILE_EXTENSION)
+            self.crop_pool = create_crop_pool(self.config.pipeline.crop_processes,
+                                              self.descriptor_extractor.input_image_width(),
+                                              self.descriptor_extractor.input_image_height(),
+                                              self.config.pipeline.fused_crop)
+            pipeline = self.pipeline()
+            tasks = (PanoTask(pano_id, fingerprints[pano_id]) for pano_id in pending_pano_ids)
+            try:
+                for _ in tqdm(pipeline(tasks), total=len(pending_pano_ids), desc="Releasing panos"):
+                    pass
+            finally:
+                pipeline.log_stats()
+                self.crop_pool.shutdown(cancel_futures=True)
+                self.uploader.close()
+                self.write_session.close()
+
+            if self.config.projection is not None:
+                project_release(session, qdrant_client, db_release, self.config.projection, self.config.index)
             # end_timetamp = time.time()
             # logger.info(f"Exporting release {self.release_name} has started...")
             # export_release(qdrant_client, db_release)
             # logger.info(f"Release {self.release_name} is ready!\nWithin {start_timetamp - end_timetamp} seconds")
 
+    def pipeline(self) -> StagePipeline:
+        """
+        list -> fetch meta -> area filter -> fetch pano and geo crop -> inference -> debug upload -> write.
+        Panos are downloaded and cropped by persistent crop processes, crops come back through shared memory
+        and are batched by the single in-process model across panos. Debug images are only queued
+        to the background uploader
+        """
+        pipeline_config = self.config.pipeline
+        return StagePipeline([
+            Stage('fetch_meta', self.fetch_meta, workers=pipeline_config.meta_workers),
+            Stage('area_filter', self.filter_area),
+            Stage('crop', self.crop, workers=pipeline_config.crop_processes),
+            Stage('inference', self.infer, batch_size=pipeline_config.inference_panos, flatten=True),
+            Stage('debug_upload', self.upload_debug_images),
+            Stage('write', self.write, batch_size=pipeline_config.write_panos, max_wait=5, flatten=True),
+        ], queue_size=pipeline_config.queue_size)
 
-def generate_release_items(path_images: Iterator[PathImage], config: ReleaseConfig, db_release_id):
-    with GetSQLModelSession() as session:
-        geo_cropper = PanoGeoCropper(session)
-        descriptor_extractor = config.descriptor_config.extractor(
-            batch_size=config.descriptor_config.batch_size
-        )
-        square_cropper = SquareCrop()
-        resizer = Resizer(descriptor_extractor.input_image_width(), descriptor_extractor.input_image_height())
-        release = session.get(Release, db_release_id)
-
-        release_items = []
-        for processed_image in \
-                descriptor_extractor(
-                    resizer(
-                        square_cropper(
-                            geo_cropper(
-                                (path_image.open() for path_image in path_images))))):
-            if any(x is None for x in [processed_image.meta.descriptor,
-                                       processed_image.meta.coordinates,
-                                       processed_image.meta.recognised_building_id]):
-                logger.info("Empty descriptor or coordinates or recognised_building_id got")
-                continue
-
-            debug_image = S3Resource(
-                path=f'releases/{config.name}/{generate_hex_uuid()}.{FILE_EXTENSION}',
-                bucket=DEBUG_BUCKET,
-            )
-
-            processed_image.image.debug(debug_image, FILE_EXTENSION)
-
-            release_item = create_release_item(
+    def fetch_meta(self, task: PanoTask) -> PanoTask:
+        task.path_image = path_pano_from_s3(task.pano_id, self.config.source, self.config.zoom, preload_content=False)
+        return task
+
+    def filter_area(self, task: PanoTask) -> PanoTask:
+        task.in_area = self.area_filter.filter(task.path_image)
+        return task
+
+    def crop(self, task: PanoTask) -> PanoTask:
+        if task.in_area:
+            task.crops = crops_from_shared(*self.crop_pool.submit(crop_pano, task.path_image).result())
+        return task
+
+    def infer(self, tasks: List[PanoTask]) -> List[PanoTask]:
+        crops = [crop for task in tasks for crop in task.crops]
+        if crops:
+            for _ in self.descriptor_extractor(iter(crops)):
+                pass
+        return tasks
+
+    def upload_debug_images(self, task: PanoTask) -> PanoTask:
+        """Every item gets the url of its key, the image is uploaded only when the key is sampled"""
+        task.image_urls = []
+        for index, crop in enumerate(task.crops):
+            key = f'{task.pano_id}/{index}'
+            self.uploader.submit(key, crop.image.content)
+            task.image_urls.append(self.uploader.url(key))
+        return task
+
+    def write(self, tasks: List[PanoTask]) -> List[PanoTask]:
+        """Items and progress of the batch are committed together, see save_panos"""
+        session = self.write_session
+        release = session.get(Release, self.release_id)
+        crops = []
+        for task in tasks:
+            for crop, image_url in zip(task.crops, task.image_urls):
+                if any(x is None for x in [crop.meta.descriptor, crop.meta.coordinates,
+                                           crop.meta.recognised_building_id]):
+                    logger.info("Empty descriptor or coordinates or recognised_building_id got")
+                    continue
+                crops.append((task.pano_id, crop, image_url))
+        release_items = [
+            create_release_item(
                 release=release,
-                descriptor=processed_image.meta.descriptor.tolist(),
-                coordinates=processed_image.meta.coordinates,
-                building_id=processed_image.meta.recognised_building_id,
-                image_url=debug_image.url,
-            )
-            release_items.append(release_item)
-
-        session.add_all(release_items)
-        session.commit()
+                descriptor=crop.meta.descriptor,
+                coordinates=crop.meta.coordinates,
+                building_id=crop.meta.recognised_building_id,
+                image_url=image_url,
+                pano_id=pano_id,
+                item_id=item_id,
+            ) for item_id, (pano_id, crop, image_url) in zip(allocate_release_item_ids(session, len(crops)), crops)
+        ]
+        if release_items:
+            insert_release_items(session, release, release_items)
+        self.save_panos(session, self.qdrant_client, release, release_items, [
+            create_release_pano(
+                self.release_id, task.pano_id, task.fingerprint,
+                ReleasePanoStatus.RELEASED if task.in_area else ReleasePanoStatus.FILTERED,
+            ) for task in tasks
+        ])
+        return tasks
 
-        qdrant_client = GetQdrantClient()
+    def select_area_panos(self, session: Session, fingerprints: Dict[str, str], pano_ids: List[str]) -> List[str]:
+        """
+        Keeps panos inside the area according to PanoManifest, panos missing in the manifest
+        or changed since it was updated are kept too and checked by the area filter stage
+        """
+        pano_source = image_source_to_pano_source[self.config.source]
+        manifest_fingerprints = select_pano_manifest_fingerprints(session, pano_source)
+        area_pano_ids = set(select_area_pano_ids(session, pano_source, self.config.area))
+        selected = [
+            pano_id for pano_id in pano_ids
+            if pano_id in area_pano_ids or pano_id not in manifest_fingerprints or
+            manifest_fingerprints[pano_id] not in (None, fingerprints[pano_id])
+        ]
+        logger.info(f"{len(pano_ids) - len(selected)} panos are outside the area according to the manifest")
+        return selected
 
-        export_release_items(qdrant_client, release, release_items)
+    @staticmethod
+    def copy_unchanged_panos(session: Session, qdrant_client: QdrantClient, db_release: Release,
+                             fingerprints: Dict[str, str], processed: Dict[str, str], chunk_size: int = 1024):
+        unchanged_panos = [
+            release_pano for release_pano in
+            select_unchanged_release_panos(session, db_release.base_release_id, fingerprints)
+            if release_pano.pano_id not in processed
+        ]
+        base_release = session.get(Release, db_release.base_release_id)
+        for chunk in tqdm(list(chunks(unchanged_panos, chunk_size)), desc="Copying unchanged panos"):
+            release_items = copy_release_items(session, db_release, base_release,
+                                               [release_pano.pano_id for release_pano in chunk])
+            Releaser.save_panos(session, qdrant_client, db_release, release_items, [
+                create_release_pano(db_release.id, release_pano.pano_id, release_pano.fingerprint, release_pano.status)
+                for release_pano in chunk
+            ])
 
-        print("BATCH EXPORTED")
+    @staticmethod
+    def save_panos(session: Session, qdrant_client: QdrantClient, release: Release, release_items: List[ReleaseItem],
+                   release_panos: List[ReleasePano]):
+        """
+        Postgres is the source of truth: inserted items and processed panos are committed before Qdrant points
+        are upserted, so the collection never has points without rows. When the upsert fails, the panos are deleted
+        again and are processed anew on resume. Points lost by a crash between the commit and the upsert
+        are restored by releasers/reindex.py
+        """
+        release_id, collection_name = release.id, release.name
+        pano_ids = [release_pano.pano_id for release_pano in release_panos]
+        item_ids = [release_item.id for release_item in release_items]
+        session.add_all(release_panos)
+        session.commit()
+        if not release_items:
+            return
+        try:
+            export_release_items(qdrant_client, release, release_items)
+        except Exception:
+            session.rollback()
+            delete_release_panos(session, release_id, pano_ids)
+            session.commit()
+            delete_vector_release_items(qdrant_client, collection_name, item_ids)
+            raise
 
 
 if __name__ == '__main__':
@@ -179,5 +321,6 @@ if __name__ == '__main__':
             num_workers=1,
         ),
         zoom=3,
+        # name=..., resume=True continues a failed build, base_release=... rebuilds only new or changed panos
     )
     Releaser(my_config)
@@ -0,0 +1,74 @@
+import argparse
+import dataclasses
+
+import numpy as np
+from loguru import logger
+from qdrant_client import QdrantClient
+from sqlmodel import Session, select
+
+from db.postgres import GetSQLModelSession
+from db.qdrant import GetQdrantClient
+from libs.projection import Projection, measure_recall
+from models.release import Release, ReleaseItem, ReleaseProjection, VectorIndexConfig
+from services.release import sample_release_descriptors, release_item_descriptor, next_release_projection_version, \
+    projection_collection_name, create_vector_release, export_release_items, create_release_projection
+
+
+@dataclasses.dataclass
+class ProjectionConfig:
+    output_size: int = 512
+    whiten: bool = False
+    sample_size: int = 20000
+    recall_queries: int = 1000
+    export_chunk_size: int = 1024
+
+
+def project_release(session: Session, qdrant_client: QdrantClient, release: Release, config: ProjectionConfig,
+                    index_config: VectorIndexConfig = None) -> ReleaseProjection:
+    """
+    Fits PCA on a sample of release descriptors and exports projected descriptors to a new collection.
+    Projection row is created after the export, so the server never picks up a partially filled collection.
+    """
+    sample = np.asarray(sample_release_descriptors(session, release, config.sample_size), dtype=np.float32)
+    projection = Projection.fit(sample, config.output_size, config.whiten)
+    recall = measure_recall(projection, sample, config.recall_queries)
+    logger.info(f"Projection of release {release.name} to {config.output_size} dimensions, recall@k: {recall}")
+
+    version = next_release_projection_version(session, release)
+    collection_name = projection_collection_name(release, version, projection.output_size)
+    create_vector_release(
+        client=qdrant_client,
+        collection_name=collection_name,
+        vector_size=projection.output_size,
+        index_config=release.vector_index_config if index_config is None else index_config,
+    )
+
+    statement = select(ReleaseItem) \
+        .where(ReleaseItem.release_id == release.id) \
+        .order_by(ReleaseItem.id) \
+        .execution_options(yield_per=config.export_chunk_size)
+    for release_items in session.exec(statement).partitions(config.export_chunk_size):
+        vectors = projection.transform([release_item_descriptor(item, release.descriptor_dtype)
+                                        for item in release_items]).tolist()
+        export_release_items(qdrant_client, release, release_items, collection_name=collection_name, vectors=vectors)
+        session.expunge_all()
+
+    return create_release_projection(session, release, version, projection, len(sample), recall)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fits PCA projection of release descriptors")
+    parser.add_argument('release_name')
+    parser.add_argument('--output-size', type=int, default=ProjectionConfig.output_size)
+    parser.add_argument('--whiten', action='store_true')
+    parser.add_argument('--sample-size', type=int, default=ProjectionConfig.sample_size)
+    arguments = parser.parse_args()
+    with GetSQLModelSession() as db_session:
+        db_release = db_session.exec(select(Release).where(Release.name == arguments.release_name)).one()
+        project_release(
+            session=db_session,
+            qdrant_client=GetQdrantClient(),
+            release=db_release,
+            config=ProjectionConfig(output_size=arguments.output_size, whiten=arguments.whiten,
+                                    sample_size=arguments.sample_size),
+        )
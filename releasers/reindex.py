@@ -0,0 +1,116 @@
+import argparse
+import dataclasses
+import itertools
+import time
+from typing import Iterator
+
+from loguru import logger
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+from sqlmodel import Session, select
+
+from db.postgres import GetSQLModelSession
+from db.qdrant import GetQdrantClient
+from models.release import Release, ReleaseItem, VectorIndexConfig
+from services.release import create_vector_release, decode_release_item_descriptor, release_item_point, \
+    set_vector_release_indexing, wait_vector_release, select_release
+
+
+@dataclasses.dataclass
+class ReindexConfig:
+    chunk_size: int = 10000
+    batch_size: int = 256
+    parallel: int = 4
+    disable_indexing: bool = True
+
+
+def stream_release_points(session: Session, release: Release, chunk_size: int) -> Iterator[PointStruct]:
+    """Items are read with a server-side cursor, only chunk_size rows are held in memory"""
+    statement = select(ReleaseItem.id, ReleaseItem.descriptor, ReleaseItem.descriptor_bytes, ReleaseItem.location,
+                       ReleaseItem.building_id, ReleaseItem.image_url) \
+        .where(ReleaseItem.release_id == release.id) \
+        .order_by(ReleaseItem.id)
+    result = session.execute(statement.execution_options(stream_results=True)).yield_per(chunk_size)
+    for item_id, descriptor, descriptor_bytes, location, building_id, image_url in result:
+        vector = decode_release_item_descriptor(descriptor, descriptor_bytes, release.descriptor_dtype).tolist()
+        yield release_item_point(item_id, vector, location, building_id, image_url)
+
+
+def reindex_release(session: Session, qdrant_client: QdrantClient, release: Release, collection_name: str = None,
+                    index_config: VectorIndexConfig = None, config: ReindexConfig = ReindexConfig()) -> int:
+    """
+    Rebuilds Qdrant collection of a release from Postgres, an existing collection with the same name is replaced.
+    Batches are uploaded by parallel workers without waiting for each of them, the only wait is at the end
+    when the index is built. Index config of the release is used unless another one is given, e.g. for a migration
+    """
+    if collection_name is None:
+        collection_name = release.name
+    points = stream_release_points(session, release, config.chunk_size)
+    first_point = next(points, None)
+    if first_point is None:
+        raise ValueError(f'Release "{release.name}" has no items')
+
+    if any(collection.name == collection_name for collection in qdrant_client.get_collections().collections):
+        logger.info(f'Collection "{collection_name}" is replaced')
+        qdrant_client.delete_collection(collection_name)
+    create_vector_release(
+        client=qdrant_client,
+        collection_name=collection_name,
+        vector_size=len(first_point.vector),
+        index_config=release.vector_index_config if index_config is None else index_config,
+    )
+    if config.disable_indexing:
+        set_vector_release_indexing(qdrant_client, collection_name, enabled=False)
+
+    start = time.perf_counter()
+    uploaded = 0
+
+    def counted(stream: Iterator[PointStruct]) -> Iterator[PointStruct]:
+        nonlocal uploaded
+        for point in stream:
+            uploaded += 1
+            yield point
+
+    qdrant_client.upload_points(
+        collection_name=collection_name,
+        points=counted(itertools.chain([first_point], points)),
+        batch_size=config.batch_size,
+        parallel=config.parallel,
+    )
+    logger.info(f"{uploaded} points of release {release.name} uploaded in {time.perf_counter() - start:.1f}s")
+
+    if config.disable_indexing:
+        set_vector_release_indexing(qdrant_client, collection_name, enabled=True)
+    count = wait_vector_release(qdrant_client, collection_name)
+    logger.info(f'Collection "{collection_name}" is ready with {count} points '
+                f'in {time.perf_counter() - start:.1f}s')
+    if count != uploaded:
+        raise Exception(f'Collection "{collection_name}" has {count} points, {uploaded} were uploaded')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuilds Qdrant collection of a release from Postgres")
+    parser.add_argument('release_name')
+    parser.add_argument('--collection', default=None, help="Target collection, release name by default")
+    parser.add_argument('--chunk-size', type=int, default=ReindexConfig.chunk_size)
+    parser.add_argument('--batch-size', type=int, default=ReindexConfig.batch_size)
+    parser.add_argument('--parallel', type=int, default=ReindexConfig.parallel)
+    parser.add_argument('--keep-indexing', action='store_true', help="Do not disable indexing during the load")
+    arguments = parser.parse_args()
+    with GetSQLModelSession() as db_session:
+        db_release = select_release(db_session, arguments.release_name)
+        if db_release is None:
+            raise Exception(f'Release "{arguments.release_name}" does not exist')
+        reindex_release(
+            session=db_session,
+            qdrant_client=GetQdrantClient(),
+            release=db_release,
+            collection_name=arguments.collection,
+            config=ReindexConfig(
+                chunk_size=arguments.chunk_size,
+                batch_size=arguments.batch_size,
+                parallel=arguments.parallel,
+                disable_indexing=not arguments.keep_indexing,
+            ),
+        )
@@ -0,0 +1,55 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from db.postgres import GetSQLModelSession
+from libs.features import PanoGeoCropper, PanoGeoSquareCropper, SquareCrop, Resizer
+from libs.pipeline import SharedArrays
+from models.image import ImageMeta, NdarrayImage, Layer, PathImage
+
+CROP_WORKER: Optional['CropWorker'] = None
+
+
+class CropWorker:
+    """
+    State of a crop process: database session, cropper with its building geometry cache and resizers.
+    Square model inputs are rendered directly by PanoGeoSquareCropper when fused is set
+    """
+
+    def __init__(self, input_width: int, input_height: int, fused: bool = True):
+        self.session = GetSQLModelSession()
+        if fused and input_width == input_height:
+            self.croppers = [PanoGeoSquareCropper(self.session, input_width)]
+        else:
+            self.croppers = [PanoGeoCropper(self.session), SquareCrop(), Resizer(input_width, input_height)]
+
+    def crop(self, path_image: PathImage) -> Tuple[SharedArrays, List[ImageMeta]]:
+        crops = path_image.open()
+        for cropper in self.croppers:
+            crops = cropper(crops)
+        crops = list(crops)
+        return SharedArrays.create([crop.image.content for crop in crops]), [crop.meta for crop in crops]
+
+
+def init_crop_worker(input_width: int, input_height: int, fused: bool):
+    global CROP_WORKER
+    CROP_WORKER = CropWorker(input_width, input_height, fused)
+
+
+def crop_pano(path_image: PathImage) -> Tuple[SharedArrays, List[ImageMeta]]:
+    return CROP_WORKER.crop(path_image)
+
+
+def create_crop_pool(processes: int, input_width: int, input_height: int, fused: bool = True) -> ProcessPoolExecutor:
+    """Spawned processes do not inherit connections of the parent engine or torch threads"""
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_crop_worker,
+        initargs=(input_width, input_height, fused),
+    )
+
+
+def crops_from_shared(shared_arrays: SharedArrays, metas: List[ImageMeta]) -> List[NdarrayImage]:
+    return [NdarrayImage(image=Layer(content=content), meta=meta)
+            for content, meta in zip(shared_arrays.take(), metas)]
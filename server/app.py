@@ -1,47 +1,271 @@
+import binascii
 import datetime
+import hashlib
+import secrets
+import threading
 import time
 import uuid
-from typing import List, Optional, Callable
-
-from fastapi import FastAPI, HTTPException, status, Request, Response, APIRouter
+from os import environ
+from typing import List, Optional, Callable, Tuple
+
+import numpy as np
+from aioprometheus import REGISTRY
+from aioprometheus.renderer import render
+from fastapi import FastAPI, HTTPException, status, Request, Response, APIRouter, Depends, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from fastapi.routing import APIRoute
 from fastapi.templating import Jinja2Templates
 from loguru import logger
-from pydantic import BaseModel
-
-from db.postgres import GetSQLModelSession
-from db.qdrant import GetQdrantClient
+from PIL import UnidentifiedImageError
+from pydantic import BaseModel, PrivateAttr, ValidationError, conlist
+from shapely import Point
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.datastructures import Headers
+
+from db.postgres import GetSQLModelSession, GetAsyncSQLModelSession, ASYNC_ENGINE, ENGINE
+from db.qdrant import GetAsyncQdrantClient
 from libs.coordinates import Coordinates, CoordinateSystem
-from libs.predictors import PredictByClosestDescriptor
-from models.geo import BuildingReadWithGroup, Building
+from libs.descriptors import DescriptorDType, OCTET_STREAM, decode_descriptor, decode_descriptor_b64
+from libs.log_sinks import GetLogSink
+from libs.metrics import stage, REQUESTS, REQUEST_SECONDS, BATCH_SIZE, observe_cache, observe_pool, \
+    observe_thread_limiter, observe_log_sink
+from libs.local_index import GetLocalIndex
+from libs.cache import LRUCache
+from libs.predictors import PredictByPayload, PredictorBase, Prediction, PredictByLocalIndex, PredictByProjection
+from libs.projection import Projection
+from models.geo import BuildingReadWithGroup
 from models.logs import HTTPMethod
-from services.geo import select_geo_object_by_id, selected_geo_object_exists
-from services.logs import create_request, create_recognition, last_recognition, get_request
-from services.release import release_exists
+from services.logs import last_recognition, get_request, RequestLog, RecognitionLog
+from models.release import Release
+from services.release import async_select_release, search_params, async_select_release_projection, \
+    projection_from_release_projection, async_vector_release_size
+from server.building_cache import BuildingResponseCache
+from server.inference import GetImageDescriptorService
 
 IP = "0.0.0.0"
 PORT = 8080
 
-QDRANT_CLIENT = GetQdrantClient()
+ASYNC_QDRANT_CLIENT = GetAsyncQdrantClient()
+LOG_SINK = GetLogSink()
 DEFAULT_RELEASE_NAME = "sharp_hofstadter"
+PREDICTOR = PredictByPayload
+GEO_FILTER_RADIUS = float(environ.get('GEO_FILTER_RADIUS', 1000)) or None
+LOCAL_INDEX_RELEASES = set(filter(None, environ.get('LOCAL_INDEX_RELEASES', '').split(',')))
+USE_PROJECTIONS = environ.get('USE_PROJECTIONS', 'true').lower() in ('1', 'true', 'yes')
+MAX_BATCH_SIZE = int(environ.get('MAX_BATCH_SIZE', 256))
+PROJECTION_RERANK_LIMIT = int(environ.get('PROJECTION_RERANK_LIMIT', 0)) or None
+RELEASE_PROJECTIONS = LRUCache(max_size=64, ttl=300)
+RELEASE_VECTOR_SIZES = LRUCache(max_size=64)
+BUILDING_CACHE = BuildingResponseCache(
+    max_size=int(environ.get('BUILDING_CACHE_SIZE', 20000)),
+    ttl=float(environ['BUILDING_CACHE_TTL']) if 'BUILDING_CACHE_TTL' in environ else 3600.0,
+)
+ADMIN_TOKEN = environ.get('ADMIN_TOKEN')
+# /recognize/image needs torch and onnxruntime, the server image has them only when built with dev group
+IMAGE_RECOGNITION = environ.get('IMAGE_RECOGNITION', 'false').lower() in ('1', 'true', 'yes')
+IMAGE_DESCRIPTOR_SERVICE = GetImageDescriptorService()
+JSON_CONTENT_TYPE = 'application/json'
 
 
-class RecognizeData(BaseModel):
-    descriptor: List[float]
+class RecognizeQuery(BaseModel):
+    descriptor: Optional[List[float]] = None
+    descriptor_b64: Optional[str] = None
+    descriptor_dtype: DescriptorDType = DescriptorDType.FLOAT32
     coordinates: Optional[Coordinates] = None
     direction: float = None
+    _descriptor_array: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def point(self) -> Optional[Point]:
+        return None if self.coordinates is None else self.coordinates.point(CoordinateSystem.ELLIPSOID)
+
+    def set_descriptor_array(self, descriptor: np.ndarray):
+        self._descriptor_array = descriptor
+
+    def descriptor_array(self) -> np.ndarray:
+        if self._descriptor_array is None:
+            try:
+                if self.descriptor_b64 is not None:
+                    self._descriptor_array = decode_descriptor_b64(self.descriptor_b64, self.descriptor_dtype)
+                elif self.descriptor is not None:
+                    self._descriptor_array = np.asarray(self.descriptor, dtype=np.float32)
+                else:
+                    raise ValueError("Either descriptor or descriptor_b64 should be specified")
+            except (ValueError, binascii.Error) as exception:
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exception))
+        return self._descriptor_array
+
+
+class RecognizeData(RecognizeQuery):
     release_name: str = None
 
 
+class RecognizeBatchData(BaseModel):
+    # length is checked before queries are validated, so oversized batches are rejected early
+    queries: conlist(RecognizeQuery, max_items=MAX_BATCH_SIZE)
+    release_name: str = None
+
+
+def recognize_metadata_from_headers(headers: Headers) -> RecognizeData:
+    fields = {
+        'descriptor_dtype': headers.get('x-descriptor-dtype', DescriptorDType.FLOAT32.value),
+        'direction': headers.get('x-direction'),
+        'release_name': headers.get('x-release-name'),
+    }
+    if 'x-latitude' in headers and 'x-longitude' in headers:
+        fields['coordinates'] = {
+            'latitude': headers.get('x-latitude'),
+            'longitude': headers.get('x-longitude'),
+            'system': headers.get('x-coordinate-system', CoordinateSystem.ELLIPSOID.value),
+        }
+    return RecognizeData.parse_obj(fields)
+
+
+def recognize_data_from_headers(headers: Headers, body: bytes) -> RecognizeData:
+    recognize_data = recognize_metadata_from_headers(headers)
+    try:
+        recognize_data.set_descriptor_array(decode_descriptor(body, recognize_data.descriptor_dtype))
+    except ValueError as exception:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exception))
+    return recognize_data
+
+
+async def parse_recognize_data(request: Request) -> RecognizeData:
+    """Accepts JSON body or raw little-endian descriptor bytes with metadata in X-* headers"""
+    body = await request.body()
+    try:
+        with stage('body_parse'):
+            if request.headers.get('content-type', '').startswith(OCTET_STREAM):
+                return recognize_data_from_headers(request.headers, body)
+            return RecognizeData.parse_raw(body)
+    except ValidationError as exception:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=exception.errors())
+
+
+async def release_projection(session: AsyncSession, release: Release) -> Optional[Tuple[str, Projection]]:
+    """Latest projection of the release as (collection name, projection), looked up at most once per TTL"""
+    if not USE_PROJECTIONS or release.name in LOCAL_INDEX_RELEASES:
+        return None
+    found, _ = RELEASE_PROJECTIONS.get_many([release.id])
+    if release.id in found:
+        return found[release.id]
+    projection = await async_select_release_projection(session, release.id)
+    if projection is not None:
+        projection = (projection.collection_name, projection_from_release_projection(projection))
+    RELEASE_PROJECTIONS.put(release.id, projection)
+    return projection
+
+
+async def release_vector_size(release: Release, projection: Optional[Tuple[str, Projection]]) -> int:
+    """
+    Size of full descriptors of the release, taken from the local index or the projection when there is one.
+    Otherwise the release collection is asked once, the size of a release does not change
+    """
+    if release.name in LOCAL_INDEX_RELEASES:
+        return GetLocalIndex(release.name).descriptors.shape[1]
+    if projection is not None:
+        return projection[1].input_size
+    vector_size = RELEASE_VECTOR_SIZES.get(release.id)
+    if vector_size is None:
+        vector_size = await async_vector_release_size(ASYNC_QDRANT_CLIENT, release.name)
+        RELEASE_VECTOR_SIZES.put(release.id, vector_size)
+    return vector_size
+
+
+async def check_descriptor_sizes(release: Release, projection: Optional[Tuple[str, Projection]],
+                                 descriptors: List[np.ndarray]):
+    vector_size = await release_vector_size(release, projection)
+    for descriptor in descriptors:
+        if len(descriptor) != vector_size:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                                detail=f'Descriptor of size {len(descriptor)} does not match release '
+                                       f'"{release.name}" of size {vector_size}')
+
+
+def predictor_for(release: Release, projection: Optional[Tuple[str, Projection]] = None) -> PredictorBase:
+    predictor_type = PredictByLocalIndex if release.name in LOCAL_INDEX_RELEASES else PREDICTOR
+    predictor = predictor_type(
+        qdrant_client=ASYNC_QDRANT_CLIENT,
+        release_name=release.name if projection is None else projection[0],
+        geo_radius=GEO_FILTER_RADIUS,
+        search_params=search_params(release.vector_index_config),
+    )
+    if projection is None:
+        return predictor
+    return PredictByProjection(predictor, projection[1], release.name, rerank_limit=PROJECTION_RERANK_LIMIT,
+                               distance=release.vector_index_config.distance)
+
+
+def load_local_indexes():
+    for release_name in LOCAL_INDEX_RELEASES:
+        local_index = GetLocalIndex(release_name)
+        logger.info(f"Local index of release {release_name} loaded with {len(local_index)} items")
+
+
+def recognition_log(request: Request, predictor: PredictorBase, prediction: Prediction, descriptor: List[float],
+                    coordinates: Optional[Point]) -> RecognitionLog:
+    return RecognitionLog(
+        request_id=uuid.UUID(hex=request.headers.get("x-request-id")),
+        timestamp=int(time.time()),
+        result_building_id=prediction.answer.building_id,
+        release_item_ids=[release_item.id for release_item in prediction.closest],
+        closest_building_ids=[release_item.building_id for release_item in prediction.closest],
+        release_name=predictor.release_name,
+        descriptor=descriptor,
+        descriptor_size=len(descriptor),
+        coordinates=coordinates,
+        model="MixVPR",
+        predictor=type(predictor).__name__,
+        debug_token=request.headers.get("x-debug-token"),
+    )
+
+
+class BuildingCacheInvalidateData(BaseModel):
+    building_ids: Optional[List[int]] = None
+
+
+class BuildingCacheWarmData(BaseModel):
+    release_name: str = None
+
+
+def check_admin_token(x_admin_token: Optional[str] = Header(default=None)):
+    """Admin routes are closed unless ADMIN_TOKEN is set"""
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin routes are disabled")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
+
+
+def warm_building_cache(release_name: str) -> int:
+    with GetSQLModelSession() as session:
+        warmed = BUILDING_CACHE.warm(session, release_name)
+    logger.info(f"Building cache warmed with {warmed} buildings of release {release_name}")
+    return warmed
+
+
+def prewarm_building_cache():
+    if environ.get('BUILDING_CACHE_PREWARM', 'false').lower() in ('1', 'true', 'yes'):
+        threading.Thread(target=warm_building_cache, args=(DEFAULT_RELEASE_NAME,), daemon=True).start()
+
+
+def loggable_request_body(headers: Headers, body: bytes) -> bytes:
+    """JSON bodies are logged as is, images and binary descriptors only by their size and hash"""
+    content_type = headers.get('content-type', '')
+    if not body or content_type.startswith(JSON_CONTENT_TYPE):
+        return body
+    return f'<{content_type or "unknown"}; {len(body)} bytes; sha256 {hashlib.sha256(body).hexdigest()}>'.encode()
+
+
 class RequestLogRoute(APIRoute):
     def get_route_handler(self) -> Callable:
         original_route_handler = super().get_route_handler()
 
         async def custom_route_handler(request: Request) -> Response:
-            with GetSQLModelSession() as session:
+            async with GetAsyncSQLModelSession() as async_session:
                 before = time.time_ns()
-                request.state.buildings_info_db = session
+                request.state.async_buildings_info_db = async_session
                 try:
                     response = await original_route_handler(request)
                 except HTTPException as http_exception:
@@ -50,35 +274,54 @@ class RequestLogRoute(APIRoute):
                         content={"error": http_exception.detail}
                     )
                     logger.error(http_exception)
+                except RequestValidationError as validation_error:
+                    response = JSONResponse(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        content={"error": jsonable_encoder(validation_error.errors())}
+                    )
                 except (Exception,) as exception:
                     response = JSONResponse(
                         status_code=500,
-                        content={"error": exception.details()}
+                        content={"error": str(exception)}
                     )
                     logger.error(exception)
 
                 response_time = (time.time_ns() - before) / 1e6
                 response.headers["X-Response-Time"] = str(response_time)
-
-                create_request(session=session,
-                               id=uuid.UUID(hex=request.headers.get("x-request-id")),
-                               timestamp=int(before // 1e9),
-                               ipv4=request.headers.get("host").replace("localhost", "127.0.0.1"),
-                               request_headers=dict(request.headers.items()),
-                               request_body=(await request.body()),
-                               request_url=str(request.url),
-                               http_method=getattr(HTTPMethod, request.method),
-                               user_agent=request.headers.get("user-agent"),
-                               response_headers=dict(response.headers.items()),
-                               response_body=response.body,
-                               status=response.status_code,
-                               response_time=response_time)
+                REQUEST_SECONDS.observe({'endpoint': self.path}, response_time / 1e3)
+                REQUESTS.inc({
+                    'endpoint': self.path,
+                    'release_name': getattr(request.state, 'release_name', ''),
+                    'status': str(response.status_code),
+                })
+
+                with stage('log_enqueue'):
+                    LOG_SINK.put(RequestLog(
+                        id=uuid.UUID(hex=request.headers.get("x-request-id")),
+                        timestamp=int(before // 1e9),
+                        ipv4=request.headers.get("host").replace("localhost", "127.0.0.1"),
+                        request_headers=dict(request.headers.items()),
+                        request_body=loggable_request_body(request.headers, await request.body()),
+                        request_url=str(request.url),
+                        http_method=getattr(HTTPMethod, request.method),
+                        user_agent=request.headers.get("user-agent"),
+                        response_headers=dict(response.headers.items()),
+                        response_body=response.body,
+                        status=response.status_code,
+                        response_time=response_time,
+                    ))
                 return response
 
         return custom_route_handler
 
 
 app = FastAPI()
+app.add_event_handler("startup", LOG_SINK.start)
+app.add_event_handler("startup", prewarm_building_cache)
+app.add_event_handler("startup", load_local_indexes)
+app.add_event_handler("shutdown", LOG_SINK.close)
+app.add_event_handler("shutdown", IMAGE_DESCRIPTOR_SERVICE.close)
+app.add_event_handler("shutdown", ASYNC_ENGINE.dispose)
 router = APIRouter(
     route_class=RequestLogRoute,
 )
@@ -96,47 +339,139 @@ def health_routed():
 
 
 @router.post("/recognize", response_model=BuildingReadWithGroup)
-def recognize(recognize_data: RecognizeData, request: Request):
-    session = request.state.buildings_info_db
+async def recognize(request: Request, recognize_data: RecognizeData = Depends(parse_recognize_data)):
+    session: AsyncSession = request.state.async_buildings_info_db
 
     release_name = recognize_data.release_name or DEFAULT_RELEASE_NAME
 
-    if not release_exists(session, release_name):
-        raise HTTPException(status_code=404, detail=f'Release "{release_name}" does not exists')
-
-    predictor = PredictByClosestDescriptor(qdrant_client=QDRANT_CLIENT, release_name=release_name)
-
-    coordinates = None if recognize_data.coordinates is None else recognize_data.coordinates.point(
-        CoordinateSystem.ELLIPSOID)
-    prediction = predictor.predict(session, recognize_data.descriptor)
-
-    create_recognition(session=session,
-                       request_id=uuid.UUID(hex=request.headers.get("x-request-id")),
-                       timestamp=int(time.time()),
-                       result_building_id=prediction.answer.building_id,
-                       release_items=prediction.closest,
-                       closest_size=len(prediction.closest),
-                       release_name=predictor.release_name,
-                       descriptor=recognize_data.descriptor,
-                       descriptor_size=4096,
-                       coordinates=coordinates,
-                       model="MixVPR",
-                       predictor=PredictByClosestDescriptor.__name__,
-                       debug_token=request.headers.get("x-debug-token"))
-
-    if not selected_geo_object_exists(session, Building, prediction.answer.building_id):
+    with stage('release_check'):
+        release = await async_select_release(session, release_name)
+        if release is None:
+            raise HTTPException(status_code=404, detail=f'Release "{release_name}" does not exists')
+        projection = await release_projection(session, release)
+        await check_descriptor_sizes(release, projection, [recognize_data.descriptor_array()])
+    request.state.release_name = release.name
+
+    predictor = predictor_for(release, projection)
+
+    coordinates = recognize_data.point()
+    descriptor = recognize_data.descriptor_array().tolist()
+    prediction = await predictor.async_predict(session, descriptor, coordinates)
+
+    with stage('log_enqueue'):
+        LOG_SINK.put(recognition_log(request, predictor, prediction, descriptor, coordinates))
+
+    with stage('building_load'):
+        buildings = await BUILDING_CACHE.async_load(session, [prediction.answer.building_id])
+    if prediction.answer.building_id not in buildings:
         raise Exception("Recognized building was not found in BuildingInfo database")
-    building: Building = select_geo_object_by_id(session, Building, prediction.answer.building_id)
 
-    if building.group.image_url is None:
-        building.group.image_url = prediction.answer.image_url
-    return building
+    with stage('serialization'):
+        content = buildings[prediction.answer.building_id].render(prediction.answer.image_url)
+    return Response(content=content, media_type="application/json")
+
+
+@router.post("/recognize/image", response_model=BuildingReadWithGroup)
+async def recognize_image(request: Request):
+    """Accepts JPEG or PNG body with the same X-* metadata headers as binary descriptor requests"""
+    if not IMAGE_RECOGNITION:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Image recognition is disabled, see IMAGE_RECOGNITION")
+    try:
+        recognize_data = recognize_metadata_from_headers(request.headers)
+    except ValidationError as exception:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=exception.errors())
+    try:
+        descriptor = await IMAGE_DESCRIPTOR_SERVICE.descriptor(await request.body())
+    except (UnidentifiedImageError, ValueError) as exception:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exception))
+    except ImportError as exception:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=f"Image recognition is not available: {exception}")
+    recognize_data.set_descriptor_array(descriptor)
+    return await recognize(request, recognize_data)
+
+
+@router.post("/recognize/batch", response_model=List[BuildingReadWithGroup])
+async def recognize_batch(recognize_batch_data: RecognizeBatchData, request: Request):
+    session: AsyncSession = request.state.async_buildings_info_db
+
+    release_name = recognize_batch_data.release_name or DEFAULT_RELEASE_NAME
+
+    with stage('release_check'):
+        release = await async_select_release(session, release_name)
+        if release is None:
+            raise HTTPException(status_code=404, detail=f'Release "{release_name}" does not exists')
+        projection = await release_projection(session, release)
+        await check_descriptor_sizes(release, projection,
+                                     [query.descriptor_array() for query in recognize_batch_data.queries])
+    request.state.release_name = release.name
+
+    predictor = predictor_for(release, projection)
+
+    queries = recognize_batch_data.queries
+    descriptors = [query.descriptor_array().tolist() for query in queries]
+    points = [query.point() for query in queries]
+    predictions = await predictor.async_predict_batch(session, descriptors, points)
+
+    BATCH_SIZE.observe({'endpoint': 'recognize_batch'}, len(queries))
+
+    with stage('log_enqueue'):
+        for point, descriptor, prediction in zip(points, descriptors, predictions):
+            LOG_SINK.put(recognition_log(request, predictor, prediction, descriptor, point))
+
+    with stage('building_load'):
+        buildings = await BUILDING_CACHE.async_load(session,
+                                                    [prediction.answer.building_id for prediction in predictions])
+    for prediction in predictions:
+        if prediction.answer.building_id not in buildings:
+            raise Exception("Recognized building was not found in BuildingInfo database")
+
+    with stage('serialization'):
+        content = "[" + ", ".join(
+            buildings[prediction.answer.building_id].render(prediction.answer.image_url)
+            for prediction in predictions
+        ) + "]"
+    return Response(content=content, media_type="application/json")
+
+
+@app.post("/cache/buildings/invalidate", dependencies=[Depends(check_admin_token)])
+def invalidate_building_cache(invalidate_data: BuildingCacheInvalidateData):
+    BUILDING_CACHE.invalidate(invalidate_data.building_ids)
+    return {"size": len(BUILDING_CACHE)}
+
+
+@app.post("/cache/buildings/warm", dependencies=[Depends(check_admin_token)])
+def warm_building_cache_route(warm_data: BuildingCacheWarmData):
+    return {"warmed": warm_building_cache(warm_data.release_name or DEFAULT_RELEASE_NAME)}
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    observe_cache('buildings', BUILDING_CACHE)
+    observe_cache('release_projections', RELEASE_PROJECTIONS)
+    observe_pool('sync', ENGINE)
+    observe_pool('async', ASYNC_ENGINE.sync_engine)
+    observe_thread_limiter()
+    observe_log_sink(LOG_SINK)
+    content, headers = render(REGISTRY, request.headers.getlist("accept"))
+    return Response(content=content, headers=headers)
+
+
+@app.get("/cache/buildings/stats")
+def building_cache_stats():
+    return {"size": len(BUILDING_CACHE), "hits": BUILDING_CACHE.hits, "misses": BUILDING_CACHE.misses}
 
 
 @router.get("/debug/{debug_token}", response_model=BuildingReadWithGroup)
 def debug(debug_token: str, request: Request):
-    session = request.state.buildings_info_db
-    recognition = last_recognition(session=request.state.buildings_info_db, debug_token=debug_token)
+    with GetSQLModelSession() as session:
+        return debug_response(session, debug_token, request)
+
+
+def debug_response(session: Session, debug_token: str, request: Request):
+    """The template is rendered here, while lazy relationships of the recognition can be loaded"""
+    recognition = last_recognition(session=session, debug_token=debug_token)
     if not recognition:
         raise HTTPException(status_code=404, detail="Debug token not found")
     recognition_request = get_request(session, recognition.request_id)
@@ -0,0 +1,64 @@
+import dataclasses
+import json
+from typing import Dict, List, Optional
+
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from libs.cache import LRUCache
+from models.geo import Building, BuildingReadWithGroup
+from services.geo import select_geo_objects_by_ids, building_read_options
+from services.release import select_release_building_ids
+
+
+@dataclasses.dataclass
+class BuildingResponse:
+    content: str
+    data: dict
+
+    @property
+    def group_image_url_missing(self) -> bool:
+        return self.data.get('group') is not None and self.data['group'].get('image_url') is None
+
+    def render(self, image_url: Optional[str]) -> str:
+        if not self.group_image_url_missing:
+            return self.content
+        return json.dumps({**self.data, 'group': {**self.data['group'], 'image_url': image_url}})
+
+
+def serialize_building(building: Building) -> BuildingResponse:
+    content = BuildingReadWithGroup.from_orm(building).json()
+    return BuildingResponse(content=content, data=json.loads(content))
+
+
+class BuildingResponseCache(LRUCache):
+    """
+    Serialized building responses of one server process. Invalidation reaches only the process that serves
+    the invalidate call, so it assumes a single uvicorn worker and replica, as in server/fastapi.Dockerfile.
+    With more workers or replicas other processes keep stale buildings until BUILDING_CACHE_TTL expires.
+    """
+
+    def fetch(self, session: Session, building_ids: List[int]) -> Dict[int, BuildingResponse]:
+        buildings = select_geo_objects_by_ids(session, Building, building_ids, options=building_read_options())
+        responses = {building_id: serialize_building(building) for building_id, building in buildings.items()}
+        self.put_many(responses)
+        return responses
+
+    def load(self, session: Session, building_ids: List[int]) -> Dict[int, BuildingResponse]:
+        responses, missing = self.get_many(building_ids)
+        if missing:
+            responses |= self.fetch(session, missing)
+        return responses
+
+    async def async_load(self, session: AsyncSession, building_ids: List[int]) -> Dict[int, BuildingResponse]:
+        responses, missing = self.get_many(building_ids)
+        if missing:
+            responses |= await session.run_sync(lambda sync_session: self.fetch(sync_session, missing))
+        return responses
+
+    def warm(self, session: Session, release_name: str, chunk_size: int = 1000) -> int:
+        building_ids = select_release_building_ids(session, release_name)[:self.max_size]
+        for start in range(0, len(building_ids), chunk_size):
+            self.fetch(session, building_ids[start:start + chunk_size])
+            session.expunge_all()
+        return len(building_ids)
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from io import BytesIO
+from os import environ
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from libs.batching import MicroBatcher
+from libs.coordinates import Coordinates, CoordinateSystem
+from libs.metrics import stage, BATCH_SIZE
+
+
+class ImageDescriptorService:
+    """
+    Computes descriptors of uploaded images. Decoding and cropping run in the default thread pool,
+    forward passes of concurrent requests are merged by MicroBatcher. Model is loaded on first use,
+    torch and image processing dependencies are imported lazily as they are not installed without dev group.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.01, device: str = 'cpu',
+                 threads: Optional[int] = None, engine: str = 'eager'):
+        self.device = device
+        self.engine = engine
+        self.threads = threads
+        self.batcher = MicroBatcher(self.process_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+        self._extractor = None
+        self._extractor_lock = threading.Lock()
+
+    @property
+    def extractor(self):
+        with self._extractor_lock:
+            if self._extractor is None:
+                import torch
+                from libs.features import MixVPR, OnnxMixVPR, TorchScriptMixVPR
+
+                if self.threads is not None:
+                    torch.set_num_threads(self.threads)
+                extractor_type = {'eager': MixVPR, 'onnx': OnnxMixVPR, 'torchscript': TorchScriptMixVPR}[self.engine]
+                self._extractor = extractor_type(batch_size=self.batcher.max_batch_size, device=self.device)
+            return self._extractor
+
+    def preprocess(self, content: bytes) -> 'NdarrayImage':
+        from libs.features import MixVPR, SquareCrop, Resizer
+        from models.image import NdarrayImage, Layer, ImageMeta, Direction
+
+        image = Image.open(BytesIO(content)).convert("RGB")
+        ndarray_image = NdarrayImage(
+            image=Layer(content=np.array(image)),
+            meta=ImageMeta(
+                primary_id='upload',
+                height=image.height,
+                width=image.width,
+                coordinates=Coordinates(0, 0, CoordinateSystem.ELLIPSOID),
+                direction=Direction(degree=0),
+            ),
+        )
+        resizer = Resizer(MixVPR.INPUT_IMAGE_WIDTH, MixVPR.INPUT_IMAGE_HEIGHT)
+        return next(resizer(SquareCrop()(ndarray_image)))
+
+    def process_batch(self, images: List['NdarrayImage']) -> List[np.ndarray]:
+        BATCH_SIZE.observe({'endpoint': 'recognize_image'}, len(images))
+        with stage('inference', engine=self.engine):
+            return list(self.extractor.descriptor(iter(images)))
+
+    async def descriptor(self, content: bytes) -> np.ndarray:
+        with stage('image_preprocess'):
+            image = await asyncio.to_thread(self.preprocess, content)
+        return await self.batcher.submit(image)
+
+    async def close(self):
+        await self.batcher.close()
+
+
+def GetImageDescriptorService() -> ImageDescriptorService:
+    return ImageDescriptorService(
+        max_batch_size=int(environ.get('IMAGE_BATCH_SIZE', 8)),
+        max_wait=float(environ.get('IMAGE_BATCH_MAX_WAIT', 0.01)),
+        device=environ.get('INFERENCE_DEVICE', 'cpu'),
+        threads=int(environ['INFERENCE_THREADS']) if 'INFERENCE_THREADS' in environ else None,
+        engine=environ.get('INFERENCE_ENGINE', 'eager'),
+    )
@@ -1,10 +1,12 @@
-from typing import Union
+from typing import Union, List, Dict
 
 from shapely import Point
+from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
 
 from models.base import BaseSQLModel
-from models.geo import GeoObject, MetroStation
+from models.geo import GeoObject, MetroStation, Building, BuildingGroup, MetroLine
+from models.language import TextContent
 
 
 def select_closest_geo_objects(session: Session, geo_object: Union[GeoObject, BaseSQLModel], limit: int):
@@ -39,3 +41,24 @@ def selected_geo_object_exists(session: Session, geo_object_type: type[GeoObject
 
 def select_geo_object_by_id(session: Session, geo_object_type: type[GeoObject, BaseSQLModel], geo_object_id: int):
     return session.get(geo_object_type, geo_object_id)
+
+
+def building_read_options():
+    """Loader options for everything BuildingReadWithGroup serializes"""
+    return [
+        selectinload(Building.group).selectinload(BuildingGroup.title).selectinload(TextContent.translations),
+        selectinload(Building.group).selectinload(BuildingGroup.description).selectinload(TextContent.translations),
+        selectinload(Building.address).selectinload(TextContent.translations),
+        selectinload(Building.metro_stations).selectinload(MetroStation.name).selectinload(TextContent.translations),
+        selectinload(Building.metro_stations).selectinload(MetroStation.line).selectinload(MetroLine.name)
+        .selectinload(TextContent.translations),
+    ]
+
+
+def select_geo_objects_by_ids(session: Session, geo_object_type: type[GeoObject, BaseSQLModel],
+                              geo_object_ids: List[int],
+                              options: list = None) -> Dict[int, Union[GeoObject, BaseSQLModel]]:
+    if not geo_object_ids:
+        return {}
+    statement = select(geo_object_type).where(geo_object_type.id.in_(set(geo_object_ids))).options(*(options or []))
+    return {geo_object.id: geo_object for geo_object in session.exec(statement).all()}
@@ -1,13 +1,53 @@
+import dataclasses
+import datetime
 import uuid
-from typing import List, Union
+from typing import List, Union, Optional
 
 from geoalchemy2.shape import from_shape
 from shapely import Point
+from sqlalchemy import insert, text
 from sqlmodel import Session, select
 
 from models import ReleaseItem
 from models.link import RecognitionReleaseItemLink
 from models.logs import HTTPMethod, Request, Recognition
+from services.common import CreationType
+
+
+@dataclasses.dataclass
+class RequestLog:
+    id: uuid.UUID
+    timestamp: int
+    ipv4: str
+    request_headers: dict
+    request_body: bytes
+    request_url: str
+    http_method: HTTPMethod
+    user_agent: str
+    response_headers: dict
+    response_body: bytes
+    status: int
+    response_time: float
+
+
+@dataclasses.dataclass
+class RecognitionLog:
+    request_id: uuid.UUID
+    timestamp: int
+    result_building_id: int
+    release_item_ids: List[int]
+    closest_building_ids: List[int]
+    release_name: str
+    descriptor: List[float]
+    descriptor_size: int
+    coordinates: Optional[Point]
+    model: str
+    predictor: str
+    debug_token: Optional[str]
+
+    @property
+    def closest_size(self) -> int:
+        return len(self.release_item_ids)
 
 
 def create_request(session: Session,
@@ -52,7 +92,8 @@ def create_recognition(session: Session,
                        coordinates: Union[Point, None],
                        model: str,
                        predictor: str,
-                       debug_token: str):
+                       debug_token: str,
+                       creation_type: CreationType = CreationType.COMMIT):
     recognition = Recognition(
         request_id=request_id,
         timestamp=timestamp,
@@ -76,7 +117,70 @@ def create_recognition(session: Session,
             priority=index,
         )
         session.add(link)
-    session.commit()
+    if creation_type == CreationType.COMMIT:
+        session.commit()
+    else:
+        session.flush()
+
+
+def create_requests(session: Session, request_logs: List[RequestLog]):
+    if not request_logs:
+        return
+    session.execute(insert(Request.__table__), [
+        dict(
+            id=request_log.id,
+            timestamp=datetime.datetime.utcfromtimestamp(request_log.timestamp),
+            ipv4=request_log.ipv4,
+            request_headers=request_log.request_headers,
+            request_body=request_log.request_body,
+            request_url=request_log.request_url,
+            http_method=request_log.http_method,
+            user_agent=request_log.user_agent,
+            response_headers=request_log.response_headers,
+            response_body=request_log.response_body,
+            status=request_log.status,
+            response_time=request_log.response_time,
+        ) for request_log in request_logs
+    ])
+
+
+def allocate_recognition_ids(session: Session, size: int) -> List[int]:
+    """Ids are taken from the sequence before insertion, order of RETURNING rows of a multi-row insert is not defined"""
+    statement = text("SELECT nextval(pg_get_serial_sequence('recognition', 'id')) FROM generate_series(1, :size)")
+    return [row[0] for row in session.execute(statement, {'size': size})]
+
+
+def create_recognitions(session: Session, recognition_logs: List[RecognitionLog]):
+    if not recognition_logs:
+        return
+    recognition_ids = allocate_recognition_ids(session, len(recognition_logs))
+    session.execute(insert(Recognition.__table__), [
+        dict(
+            id=recognition_id,
+            request_id=recognition_log.request_id,
+            timestamp=datetime.datetime.utcfromtimestamp(recognition_log.timestamp),
+            result_building_id=recognition_log.result_building_id,
+            closest_size=recognition_log.closest_size,
+            release_name=recognition_log.release_name,
+            descriptor=recognition_log.descriptor,
+            descriptor_size=recognition_log.descriptor_size,
+            coordinates=from_shape(recognition_log.coordinates) if recognition_log.coordinates is not None else None,
+            model=recognition_log.model,
+            predictor=recognition_log.predictor,
+            debug_token=recognition_log.debug_token,
+        ) for recognition_id, recognition_log in zip(recognition_ids, recognition_logs)
+    ])
+    links = [
+        dict(
+            recognition_id=recognition_id,
+            release_item_id=release_item_id,
+            priority=index,
+        )
+        for recognition_id, recognition_log in zip(recognition_ids, recognition_logs)
+        for index, release_item_id in enumerate(recognition_log.release_item_ids)
+    ]
+    if links:
+        session.execute(insert(RecognitionReleaseItemLink.__table__), links)
 
 
 def last_recognition(session: Session, debug_token: str) -> Recognition:
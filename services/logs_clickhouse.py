@@ -1,8 +1,42 @@
+import ipaddress
 from typing import List, Union
 
 from clickhouse_connect.driver.client import Client
 from shapely import Point
 
+from services.logs import RequestLog, RecognitionLog
+
+REQUEST_COLUMNS = {
+    'ID': 'UInt128',
+    'Timestamp': 'DateTime',
+    'IPv4': 'IPv4',
+    'RequestHeaders': 'Map(String, String)',
+    'RequestBody': 'String',
+    'RequestURL': 'String',
+    'HTTPMethod': "Enum8('GET' = 1, 'HEAD' = 2, 'POST' = 3, 'PUT' = 4, 'DELETE' = 5, 'CONNECT' = 6, "
+                  "'OPTIONS' = 7, 'TRACE' = 8, 'PATCH' = 9)",
+    'UserAgent': 'String',
+    'ResponseHeaders': 'Map(String, String)',
+    'ResponseBody': 'String',
+    'Status': 'UInt16',
+    'ResponseTime': 'Float64',
+}
+
+RECOGNITION_COLUMNS = {
+    'RequestID': 'UInt128',
+    'Timestamp': 'DateTime',
+    'ResultBuildingID': 'UInt64',
+    'ClosestBuildingIDs': 'Array(UInt64)',
+    'ClosestSize': 'UInt32',
+    'ReleaseName': 'String',
+    'Descriptor': 'Array(Float64)',
+    'DescriptorSize': 'UInt32',
+    'Coordinates': 'Point',
+    'Model': 'String',
+    'Predictor': 'String',
+    'ShowResult': 'Bool',
+}
+
 
 def create_request_log(client: Client,
                        id: int,
@@ -104,3 +138,59 @@ def create_recognition_log(client: Client,
                       'String',
                       'Bool'
                   ])
+
+
+def ipv4_or_unspecified(host: str) -> str:
+    address = host.rsplit(':', 1)[0] if host else ''
+    try:
+        return str(ipaddress.IPv4Address(address))
+    except ipaddress.AddressValueError:
+        return '0.0.0.0'
+
+
+def create_request_logs(client: Client, request_logs: List[RequestLog]):
+    if not request_logs:
+        return
+    client.insert('request',
+                  data=[
+                      [request_log.id.int for request_log in request_logs],
+                      [request_log.timestamp for request_log in request_logs],
+                      [ipv4_or_unspecified(request_log.ipv4) for request_log in request_logs],
+                      [request_log.request_headers for request_log in request_logs],
+                      [request_log.request_body for request_log in request_logs],
+                      [request_log.request_url for request_log in request_logs],
+                      [request_log.http_method.value for request_log in request_logs],
+                      [request_log.user_agent or '' for request_log in request_logs],
+                      [request_log.response_headers for request_log in request_logs],
+                      [request_log.response_body for request_log in request_logs],
+                      [request_log.status for request_log in request_logs],
+                      [request_log.response_time for request_log in request_logs],
+                  ],
+                  column_names=list(REQUEST_COLUMNS.keys()),
+                  column_type_names=list(REQUEST_COLUMNS.values()),
+                  column_oriented=True)
+
+
+def create_recognition_logs(client: Client, recognition_logs: List[RecognitionLog]):
+    if not recognition_logs:
+        return
+    client.insert('recognition',
+                  data=[
+                      [recognition_log.request_id.int for recognition_log in recognition_logs],
+                      [recognition_log.timestamp for recognition_log in recognition_logs],
+                      [recognition_log.result_building_id for recognition_log in recognition_logs],
+                      [recognition_log.closest_building_ids for recognition_log in recognition_logs],
+                      [recognition_log.closest_size for recognition_log in recognition_logs],
+                      [recognition_log.release_name for recognition_log in recognition_logs],
+                      [recognition_log.descriptor for recognition_log in recognition_logs],
+                      [recognition_log.descriptor_size for recognition_log in recognition_logs],
+                      [(0.0, 0.0) if recognition_log.coordinates is None else
+                       (recognition_log.coordinates.x, recognition_log.coordinates.y)
+                       for recognition_log in recognition_logs],
+                      [recognition_log.model for recognition_log in recognition_logs],
+                      [recognition_log.predictor for recognition_log in recognition_logs],
+                      [True for _ in recognition_logs],
+                  ],
+                  column_names=list(RECOGNITION_COLUMNS.keys()),
+                  column_type_names=list(RECOGNITION_COLUMNS.values()),
+                  column_oriented=True)
@@ -1,9 +1,50 @@
-from models.pano import PanoSource, PanoMeta
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, delete
 from sqlmodel import Session
 from sqlmodel import select
 
+from models.geo import Area
+from models.pano import PanoSource, PanoMeta, PanoManifest
+
 
 def get_pano_meta(session: Session, source_image_id: str, source: PanoSource):
     statement = select(PanoMeta).where(PanoMeta.source_image_id == source_image_id and PanoMeta.source == source)
     results = session.exec(statement).first()
     return results
+
+
+def select_pano_manifests(session: Session, source: PanoSource) -> Dict[str, PanoManifest]:
+    statement = select(PanoManifest).where(PanoManifest.source == source)
+    return {pano_manifest.pano_id: pano_manifest for pano_manifest in session.exec(statement).all()}
+
+
+def select_pano_manifest_fingerprints(session: Session, source: PanoSource) -> Dict[str, Optional[str]]:
+    statement = select(PanoManifest.pano_id, PanoManifest.fingerprint).where(PanoManifest.source == source)
+    return dict(session.exec(statement).all())
+
+
+def select_area_pano_ids(session: Session, source: PanoSource, area: Area) -> List[str]:
+    """Single spatial query, area geometry is in MAIN_COORDINATE_SYSTEM like manifest coordinates"""
+    statement = select(PanoManifest.pano_id) \
+        .where(PanoManifest.source == source) \
+        .where(func.ST_Contains(func.ST_GeomFromText(area.geometry_shape.wkt), PanoManifest.coordinates))
+    return session.exec(statement).all()
+
+
+def update_pano_manifest(session: Session, pano_manifest: PanoManifest, existing: Optional[PanoManifest] = None):
+    if existing is None:
+        session.add(pano_manifest)
+        return pano_manifest
+    for field in ('coordinates', 'direction', 'datetime', 'zooms', 'fingerprint'):
+        setattr(existing, field, getattr(pano_manifest, field))
+    existing.updated_at = datetime.utcnow()
+    session.add(existing)
+    return existing
+
+
+def delete_pano_manifests(session: Session, source: PanoSource, pano_ids: List[str]):
+    session.execute(delete(PanoManifest)
+                    .where(PanoManifest.source == source)
+                    .where(PanoManifest.pano_id.in_(pano_ids)))
@@ -1,85 +1,448 @@
-from typing import List
+import json
+import time
+from typing import List, Dict, Optional, Union
 
 from geoalchemy2.shape import from_shape, to_shape
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+import numpy as np
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.http.models import Distance, VectorParams, PointStruct, ScoredPoint, SearchRequest, Filter, \
+    FieldCondition, GeoRadius, GeoPoint, PayloadSchemaType, HnswConfigDiff, SearchParams, QuantizationSearchParams, \
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, ProductQuantization, ProductQuantizationConfig, \
+    CompressionRatio, QuantizationConfig, OptimizersConfigDiff, CollectionStatus, PointIdsList
+from shapely import Point
+from sqlalchemy import func, text, delete
+from sqlalchemy.orm import load_only
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from libs import pgcopy
 from libs.coordinates import Coordinates, CoordinateSystem
-from models.release import Release, ReleaseItem
+from libs.descriptors import DescriptorDType, encode_descriptor, decode_descriptor
+from libs.projection import Projection
+from models.release import Release, ReleaseItem, VectorIndexConfig, VectorQuantization, ReleaseProjection, \
+    ReleasePano, ReleasePanoStatus
 
 QDRANT_COORDINATES_SYSTEM = CoordinateSystem.ELLIPSOID
+QDRANT_PAYLOAD_FIELDS = ('building_id', 'image_url')
+QDRANT_LOCATIONS_FIELD = 'locations'
+# default of Qdrant, 0 disables building of the vector index
+QDRANT_INDEXING_THRESHOLD = 20000
 
 
-def create_release(session: Session, name: str) -> Release:
-    release = Release(name=name)
+def create_release(session: Session, name: str, index_config: VectorIndexConfig = None,
+                   base_release: Release = None, descriptor_dtype: Optional[DescriptorDType] = None) -> Release:
+    if index_config is None:
+        index_config = VectorIndexConfig()
+    release = Release(
+        name=name,
+        index_config=json.loads(index_config.json()),
+        base_release_id=None if base_release is None else base_release.id,
+        descriptor_dtype=descriptor_dtype,
+    )
     session.add(release)
     session.commit()
     return release
 
 
-def create_release_item(release: Release, descriptor: List[float], coordinates: Coordinates,
-                        building_id: int, image_url: str):
+def create_release_item(release: Release, descriptor: Union[np.ndarray, List[float]], coordinates: Coordinates,
+                        building_id: int, image_url: str, pano_id: str = None, item_id: int = None):
+    """Descriptor is stored as bytes of release descriptor dtype, or as a float array for releases without it"""
     release_item = ReleaseItem(
-        release=release,
+        id=item_id,
+        release_id=release.id,
         building_id=building_id,
+        pano_id=pano_id,
         image_url=image_url,
         location=from_shape(coordinates.point(QDRANT_COORDINATES_SYSTEM)),
-        descriptor=descriptor,
     )
+    set_release_item_descriptor(release_item, descriptor, release.descriptor_dtype)
     return release_item
 
 
-# def export_release_item(item: ReleaseItem, client: QdrantClient, release: Release):
-#     upsert_vector_release_item(
-#         client=client,
-#         collection_name=release.name,
-#         vector=item.descriptor,
-#         point=to_shape(item.location),
-#         building_id=item.building_id,
-#         image_url=item.image_url,
-#         release_item_id=item.id,
-#     )
+def set_release_item_descriptor(release_item: ReleaseItem, descriptor: Union[np.ndarray, List[float]],
+                                dtype: Optional[DescriptorDType]):
+    if dtype is None:
+        release_item.descriptor = np.asarray(descriptor, dtype=np.float64).tolist()
+    else:
+        release_item.descriptor_bytes = encode_descriptor(descriptor, DescriptorDType(dtype))
+
+
+def decode_release_item_descriptor(descriptor: Optional[List[float]], descriptor_bytes: Optional[bytes],
+                                   dtype: Optional[DescriptorDType]) -> np.ndarray:
+    if descriptor_bytes is not None:
+        return decode_descriptor(descriptor_bytes, DescriptorDType(dtype or DescriptorDType.FLOAT32))
+    return np.asarray(descriptor, dtype=np.float32)
+
+
+def release_item_descriptor(release_item: ReleaseItem, dtype: Optional[DescriptorDType]) -> np.ndarray:
+    return decode_release_item_descriptor(release_item.descriptor, release_item.descriptor_bytes, dtype)
+
+
+RELEASE_ITEM_COPY_COLUMNS = ('id', 'release_id', 'building_id', 'pano_id', 'image_url', 'location',
+                             'descriptor_bytes')
+# binary COPY needs exact column types: id is BIGINT, foreign keys are INTEGER
+RELEASE_ITEM_COPY_ENCODERS = (pgcopy.int8, pgcopy.int4, pgcopy.int4, pgcopy.text, pgcopy.text, pgcopy.raw,
+                              pgcopy.raw)
+
+
+def allocate_release_item_ids(session: Session, size: int) -> List[int]:
+    """Ids are taken from the sequence before insertion, so points can be exported before items are committed"""
+    if size == 0:
+        return []
+    statement = text("SELECT nextval(pg_get_serial_sequence('release_item', 'id')) FROM generate_series(1, :size)")
+    return [row[0] for row in session.execute(statement, {'size': size})]
+
+
+def insert_release_items(session: Session, release: Release, release_items: List[ReleaseItem]):
+    """
+    Items should have ids allocated with allocate_release_item_ids. They are streamed with binary COPY
+    and are not added to the session, items of releases without descriptor dtype are added and flushed
+    """
+    if release.descriptor_dtype is None:
+        session.add_all(release_items)
+        session.flush()
+        return
+    pgcopy.copy_rows(session, ReleaseItem.__tablename__, RELEASE_ITEM_COPY_COLUMNS, RELEASE_ITEM_COPY_ENCODERS, (
+        (item.id, item.release_id, item.building_id, item.pano_id, item.image_url, item.location.data,
+         item.descriptor_bytes) for item in release_items
+    ))
+
 
+def hnsw_config(index_config: VectorIndexConfig) -> Optional[HnswConfigDiff]:
+    if index_config.hnsw_m is None and index_config.hnsw_ef_construct is None and not index_config.on_disk:
+        return None
+    return HnswConfigDiff(m=index_config.hnsw_m, ef_construct=index_config.hnsw_ef_construct,
+                          on_disk=index_config.on_disk or None)
 
-# def export_release(client: QdrantClient, release: Release):
-# for item in tqdm(release.items, desc=f"Exporting release \"{release.name}\""):
-#     export_release_item(item, client, release)
+
+def quantization_config(index_config: VectorIndexConfig) -> Optional[QuantizationConfig]:
+    if index_config.quantization == VectorQuantization.SCALAR:
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(
+            type=ScalarType.INT8,
+            quantile=index_config.scalar_quantile,
+            always_ram=index_config.quantization_always_ram,
+        ))
+    if index_config.quantization == VectorQuantization.PRODUCT:
+        return ProductQuantization(product=ProductQuantizationConfig(
+            compression=CompressionRatio(index_config.product_compression),
+            always_ram=index_config.quantization_always_ram,
+        ))
+    return None
+
+
+def search_params(index_config: VectorIndexConfig) -> Optional[SearchParams]:
+    quantization = None
+    if index_config.quantization != VectorQuantization.NONE:
+        quantization = QuantizationSearchParams(rescore=index_config.rescore, oversampling=index_config.oversampling)
+    if index_config.search_ef is None and quantization is None:
+        return None
+    return SearchParams(hnsw_ef=index_config.search_ef, quantization=quantization)
 
 
 def create_vector_release(client: QdrantClient, collection_name: str, vector_size: int,
-                          distance: Distance = Distance.EUCLID):
+                          index_config: VectorIndexConfig = None):
+    if index_config is None:
+        index_config = VectorIndexConfig()
     client.create_collection(
         collection_name=collection_name,
-        vectors_config=VectorParams(size=vector_size, distance=distance),
+        vectors_config=VectorParams(size=vector_size, distance=Distance(index_config.distance.value),
+                                    on_disk=index_config.on_disk or None),
+        hnsw_config=hnsw_config(index_config),
+        quantization_config=quantization_config(index_config),
+    )
+    create_vector_release_geo_index(client, collection_name)
+
+
+async def async_vector_release_size(client: AsyncQdrantClient, collection_name: str) -> int:
+    collection = await client.get_collection(collection_name)
+    return collection.config.params.vectors.size
+
+
+def create_vector_release_geo_index(client: QdrantClient, collection_name: str):
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name=QDRANT_LOCATIONS_FIELD,
+        field_schema=PayloadSchemaType.GEO,
+    )
+
+
+def geo_radius_filter(point: Point, radius: float) -> Filter:
+    """Point should be in QDRANT_COORDINATES_SYSTEM, radius is in meters"""
+    return Filter(must=[
+        FieldCondition(
+            key=QDRANT_LOCATIONS_FIELD,
+            geo_radius=GeoRadius(center=GeoPoint(lat=point.x, lon=point.y), radius=radius),
+        )
+    ])
+
+
+def release_item_point(item_id: int, vector: List[float], location, building_id: int,
+                       image_url: str) -> PointStruct:
+    point = to_shape(location)
+    return PointStruct(
+        id=item_id,
+        vector=vector,
+        payload={
+            QDRANT_LOCATIONS_FIELD: [{"lat": point.x, "lon": point.y}],
+            "building_id": building_id,
+            "image_url": image_url
+        },
     )
 
 
-def export_release_items(client: QdrantClient, release: Release, release_items: List[ReleaseItem]):
+def export_release_items(client: QdrantClient, release: Release, release_items: List[ReleaseItem],
+                         collection_name: str = None, vectors: List[List[float]] = None, wait: bool = True):
+    """Vectors replace release item descriptors when specified, e.g. with projected descriptors"""
+    if vectors is None:
+        vectors = [release_item_descriptor(item, release.descriptor_dtype).tolist() for item in release_items]
     client.upsert(
-        collection_name=release.name,
-        wait=True,
+        collection_name=release.name if collection_name is None else collection_name,
+        wait=wait,
         points=[
-            PointStruct(
-                id=item.id,
-                vector=item.descriptor,
-                payload={
-                    "locations": [{"lat": to_shape(item.location).x, "lon": to_shape(item.location).y}],
-                    "building_id": item.building_id,
-                    "image_url": item.image_url
-                },
-            ) for item in release_items
+            release_item_point(item.id, vector, item.location, item.building_id, item.image_url)
+            for item, vector in zip(release_items, vectors)
         ]
     )
 
 
-def search_vector_release_item(client: QdrantClient, collection_name: str, vector: List[float], limit: int):
-    return client.search(
+def delete_vector_release_items(client: QdrantClient, collection_name: str, ids: List[int]):
+    client.delete(collection_name=collection_name, points_selector=PointIdsList(points=ids), wait=True)
+
+
+def set_vector_release_indexing(client: QdrantClient, collection_name: str, enabled: bool):
+    """Indexing is disabled during bulk loads, so the HNSW graph is built once after all points are uploaded"""
+    client.update_collection(
         collection_name=collection_name,
-        query_vector=vector,
-        limit=limit
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=QDRANT_INDEXING_THRESHOLD if enabled else 0),
     )
 
 
+def wait_vector_release(client: QdrantClient, collection_name: str, poll_interval: float = 1,
+                        timeout: Optional[float] = None) -> int:
+    """Waits until optimizers of the collection are finished, returns the exact points count"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while client.get_collection(collection_name).status != CollectionStatus.GREEN:
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f'Collection "{collection_name}" is not ready after {timeout} seconds')
+        time.sleep(poll_interval)
+    return client.count(collection_name=collection_name, exact=True).count
+
+
+def search_requests(vectors: List[List[float]], limit: int, with_payload: bool,
+                    query_filters: Optional[List[Optional[Filter]]],
+                    params: Optional[SearchParams] = None) -> List[SearchRequest]:
+    if query_filters is None:
+        query_filters = [None] * len(vectors)
+    return [
+        SearchRequest(vector=vector, filter=query_filter, params=params, limit=limit, with_payload=with_payload)
+        for vector, query_filter in zip(vectors, query_filters)
+    ]
+
+
+def search_vector_release_items(client: QdrantClient, collection_name: str, vectors: List[List[float]], limit: int,
+                                with_payload: bool = False, query_filters: Optional[List[Optional[Filter]]] = None,
+                                params: Optional[SearchParams] = None) -> List[List[ScoredPoint]]:
+    return client.search_batch(
+        collection_name=collection_name,
+        requests=search_requests(vectors, limit, with_payload, query_filters, params),
+    )
+
+
+async def async_search_vector_release_items(client: AsyncQdrantClient, collection_name: str,
+                                            vectors: List[List[float]], limit: int, with_payload: bool = False,
+                                            query_filters: Optional[List[Optional[Filter]]] = None,
+                                            params: Optional[SearchParams] = None) -> List[List[ScoredPoint]]:
+    return await client.search_batch(
+        collection_name=collection_name,
+        requests=search_requests(vectors, limit, with_payload, query_filters, params),
+    )
+
+
+def release_item_from_payload(scored_point: ScoredPoint) -> ReleaseItem:
+    return ReleaseItem(
+        id=scored_point.id,
+        building_id=scored_point.payload['building_id'],
+        image_url=scored_point.payload['image_url'],
+    )
+
+
+def payload_is_complete(scored_point: ScoredPoint) -> bool:
+    return scored_point.payload is not None and all(field in scored_point.payload for field in QDRANT_PAYLOAD_FIELDS)
+
+
+def select_release_items_by_ids_statement(ids: List[int]):
+    return select(ReleaseItem) \
+        .options(load_only(ReleaseItem.id, ReleaseItem.building_id, ReleaseItem.image_url)) \
+        .where(ReleaseItem.id.in_(ids))
+
+
+def select_release_items_by_ids(session: Session, ids: List[int]) -> Dict[int, ReleaseItem]:
+    if not ids:
+        return {}
+    release_items = session.exec(select_release_items_by_ids_statement(ids)).all()
+    return {release_item.id: release_item for release_item in release_items}
+
+
+async def async_select_release_items_by_ids(session: AsyncSession, ids: List[int]) -> Dict[int, ReleaseItem]:
+    if not ids:
+        return {}
+    release_items = (await session.exec(select_release_items_by_ids_statement(ids))).all()
+    return {release_item.id: release_item for release_item in release_items}
+
+
 def release_exists(session: Session, release_name: str):
-    return session.exec(select(Release.name == release_name)).first() is not None
+    return session.exec(select(Release.id).where(Release.name == release_name)).first() is not None
+
+
+def select_release(session: Session, release_name: str) -> Optional[Release]:
+    return session.exec(select(Release).where(Release.name == release_name)).first()
+
+
+async def async_select_release(session: AsyncSession, release_name: str) -> Optional[Release]:
+    return (await session.exec(select(Release).where(Release.name == release_name))).first()
+
+
+def create_release_pano(release_id: int, pano_id: str, fingerprint: str, status: ReleasePanoStatus) -> ReleasePano:
+    return ReleasePano(release_id=release_id, pano_id=pano_id, fingerprint=fingerprint, status=status)
+
+
+def delete_release_panos(session: Session, release_id: int, pano_ids: List[str]):
+    """Removes processed panos with their items, so a resumed build processes them again"""
+    session.execute(delete(ReleaseItem).where(ReleaseItem.release_id == release_id)
+                    .where(ReleaseItem.pano_id.in_(pano_ids)))
+    session.execute(delete(ReleasePano).where(ReleasePano.release_id == release_id)
+                    .where(ReleasePano.pano_id.in_(pano_ids)))
+
+
+def select_release_pano_fingerprints(session: Session, release_id: int) -> Dict[str, str]:
+    statement = select(ReleasePano.pano_id, ReleasePano.fingerprint).where(ReleasePano.release_id == release_id)
+    return dict(session.exec(statement).all())
+
+
+def select_unchanged_release_panos(session: Session, base_release_id: int,
+                                   fingerprints: Dict[str, str]) -> List[ReleasePano]:
+    """Panos of the base release whose objects have not changed since it was built"""
+    release_panos = session.exec(select(ReleasePano).where(ReleasePano.release_id == base_release_id)).all()
+    return [release_pano for release_pano in release_panos
+            if fingerprints.get(release_pano.pano_id) == release_pano.fingerprint]
+
+
+def copy_release_items(session: Session, release: Release, base_release: Release,
+                       pano_ids: List[str]) -> List[ReleaseItem]:
+    """
+    Copies items of base release panos into release, descriptors are reused without inference
+    and converted to the release descriptor dtype
+    """
+    statement = select(ReleaseItem) \
+        .where(ReleaseItem.release_id == base_release.id) \
+        .where(ReleaseItem.pano_id.in_(pano_ids))
+    base_items = session.exec(statement).all()
+    release_items = []
+    for item_id, base_item in zip(allocate_release_item_ids(session, len(base_items)), base_items):
+        release_item = ReleaseItem(
+            id=item_id,
+            release_id=release.id,
+            building_id=base_item.building_id,
+            pano_id=base_item.pano_id,
+            image_url=base_item.image_url,
+            location=base_item.location,
+        )
+        set_release_item_descriptor(release_item, release_item_descriptor(base_item, base_release.descriptor_dtype),
+                                    release.descriptor_dtype)
+        release_items.append(release_item)
+    insert_release_items(session, release, release_items)
+    return release_items
+
+
+def select_release_building_ids(session: Session, release_name: str) -> List[int]:
+    statement = select(ReleaseItem.building_id) \
+        .join(Release, Release.id == ReleaseItem.release_id) \
+        .where(Release.name == release_name) \
+        .distinct()
+    return session.exec(statement).all()
+
+
+def select_release_item_descriptors_statement(ids: List[int]):
+    return select(ReleaseItem.id, ReleaseItem.descriptor, ReleaseItem.descriptor_bytes, Release.descriptor_dtype) \
+        .join(Release, Release.id == ReleaseItem.release_id) \
+        .where(ReleaseItem.id.in_(ids))
+
+
+def select_release_item_descriptors(session: Session, ids: List[int]) -> Dict[int, np.ndarray]:
+    if not ids:
+        return {}
+    return {item_id: decode_release_item_descriptor(descriptor, descriptor_bytes, dtype)
+            for item_id, descriptor, descriptor_bytes, dtype in
+            session.exec(select_release_item_descriptors_statement(ids)).all()}
+
+
+async def async_select_release_item_descriptors(session: AsyncSession, ids: List[int]) -> Dict[int, np.ndarray]:
+    if not ids:
+        return {}
+    return {item_id: decode_release_item_descriptor(descriptor, descriptor_bytes, dtype)
+            for item_id, descriptor, descriptor_bytes, dtype in
+            (await session.exec(select_release_item_descriptors_statement(ids))).all()}
+
+
+def sample_release_descriptors(session: Session, release: Release, size: int) -> List[np.ndarray]:
+    statement = select(ReleaseItem.descriptor, ReleaseItem.descriptor_bytes) \
+        .where(ReleaseItem.release_id == release.id) \
+        .order_by(func.random()) \
+        .limit(size)
+    return [decode_release_item_descriptor(descriptor, descriptor_bytes, release.descriptor_dtype)
+            for descriptor, descriptor_bytes in session.exec(statement).all()]
+
+
+def projection_collection_name(release: Release, version: int, output_size: int) -> str:
+    return f"{release.name}_pca{output_size}_v{version}"
+
+
+def next_release_projection_version(session: Session, release: Release) -> int:
+    last_version = session.exec(
+        select(func.max(ReleaseProjection.version)).where(ReleaseProjection.release_id == release.id)
+    ).one()
+    return (last_version or 0) + 1
+
+
+def create_release_projection(session: Session, release: Release, version: int, projection: Projection,
+                              sample_size: int, recall: Dict[int, float]) -> ReleaseProjection:
+    release_projection = ReleaseProjection(
+        release_id=release.id,
+        version=version,
+        collection_name=projection_collection_name(release, version, projection.output_size),
+        input_size=projection.input_size,
+        output_size=projection.output_size,
+        whiten=projection.whiten,
+        sample_size=sample_size,
+        mean=projection.mean_bytes(),
+        components=projection.components_bytes(),
+        recall={str(k): value for k, value in recall.items()},
+    )
+    session.add(release_projection)
+    session.commit()
+    return release_projection
+
+
+def projection_from_release_projection(release_projection: ReleaseProjection) -> Projection:
+    return Projection.from_bytes(
+        mean=release_projection.mean,
+        components=release_projection.components,
+        input_size=release_projection.input_size,
+        output_size=release_projection.output_size,
+        whiten=release_projection.whiten,
+    )
+
+
+def select_release_projection_statement(release_id: int):
+    return select(ReleaseProjection) \
+        .where(ReleaseProjection.release_id == release_id) \
+        .order_by(ReleaseProjection.version.desc()) \
+        .limit(1)
+
+
+def select_release_projection(session: Session, release_id: int) -> Optional[ReleaseProjection]:
+    return session.exec(select_release_projection_statement(release_id)).first()
+
+
+async def async_select_release_projection(session: AsyncSession, release_id: int) -> Optional[ReleaseProjection]:
+    return (await session.exec(select_release_projection_statement(release_id))).first()
@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+import pytest
+
+from libs.local_index import LocalIndex, local_index_descriptor, local_index_norm, write_local_index_distance
+from models.release import VectorDistance
+
+# the first descriptor is the closest by cosine and dot product, the second one by L2
+DESCRIPTORS = np.array([[10, 0], [0.9, 0.5]], dtype=np.float32)
+QUERY = np.array([[1, 0.1]], dtype=np.float32)
+
+
+def write_local_index(directory, distance: VectorDistance):
+    descriptors = np.stack([local_index_descriptor(descriptor, distance) for descriptor in DESCRIPTORS])
+    np.save(directory / 'descriptors.npy', descriptors)
+    np.save(directory / 'norms.npy', np.array([local_index_norm(descriptor, distance) for descriptor in descriptors],
+                                              dtype=np.float32))
+    np.save(directory / 'ids.npy', np.array([1, 2], dtype=np.int64))
+    np.save(directory / 'building_ids.npy', np.array([10, 20], dtype=np.int64))
+    np.save(directory / 'locations.npy', np.zeros((2, 2), dtype=np.float64))
+    (directory / 'image_urls.json').write_text(json.dumps(['a', 'b']), encoding='utf8')
+    write_local_index_distance(str(directory), distance)
+
+
+@pytest.mark.parametrize('distance, expected', [
+    (VectorDistance.EUCLID, [2, 1]),
+    (VectorDistance.COSINE, [1, 2]),
+    (VectorDistance.DOT, [1, 2]),
+])
+def test_search_follows_release_distance(tmp_path, distance, expected):
+    write_local_index(tmp_path, distance)
+    local_index = LocalIndex(str(tmp_path), block_size=1)
+
+    assert local_index.ids[local_index.search(QUERY, 2)[0]].tolist() == expected
+
+
+def test_index_without_distance_is_not_loaded(tmp_path):
+    write_local_index(tmp_path, VectorDistance.EUCLID)
+    (tmp_path / 'index.json').unlink()
+
+    with pytest.raises(ValueError):
+        LocalIndex(str(tmp_path))
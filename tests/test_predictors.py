@@ -0,0 +1,69 @@
+import asyncio
+
+import numpy as np
+
+import libs.predictors as predictors
+from libs.predictors import PredictorBase, PredictByProjection, Prediction
+from libs.projection import Projection
+from models import ReleaseItem
+from models.release import VectorDistance
+
+DESCRIPTORS = {
+    1: np.array([0, 1, 0, 0], dtype=np.float32),
+    2: np.array([1, 0, 0, 0], dtype=np.float32),
+    3: np.array([0.9, 0.1, 0, 0], dtype=np.float32),
+}
+
+
+class StaticPredictor(PredictorBase):
+    """Returns candidates in the order of their ids, as an approximate projected search could"""
+
+    def predict_batch(self, session, vectors, points=None):
+        return [Prediction(closest=[ReleaseItem(id=item_id) for item_id in sorted(DESCRIPTORS)]) for _ in vectors]
+
+    async def async_predict_batch(self, session, vectors, points=None):
+        return self.predict_batch(session, vectors, points)
+
+
+def projection_predictor(distance: VectorDistance = VectorDistance.EUCLID) -> PredictByProjection:
+    projection = Projection(mean=np.zeros(4, dtype=np.float32), components=np.eye(2, 4, dtype=np.float32))
+    return PredictByProjection(StaticPredictor(None, 'release', limit=2), projection, 'release', rerank_limit=3,
+                               distance=distance)
+
+
+def test_rerank_orders_candidates_by_full_descriptors(monkeypatch):
+    requested = []
+
+    def select_descriptors(session, ids):
+        requested.append(sorted(ids))
+        return {item_id: DESCRIPTORS[item_id] for item_id in ids}
+
+    monkeypatch.setattr(predictors, 'select_release_item_descriptors', select_descriptors)
+    predictions = projection_predictor().predict_batch(None, [[1, 0, 0, 0]])
+
+    assert requested == [[1, 2, 3]]
+    assert [release_item.id for release_item in predictions[0].closest] == [2, 3]
+
+
+def test_async_rerank_orders_candidates_by_full_descriptors(monkeypatch):
+    async def select_descriptors(session, ids):
+        return {item_id: DESCRIPTORS[item_id] for item_id in ids}
+
+    monkeypatch.setattr(predictors, 'async_select_release_item_descriptors', select_descriptors)
+    predictions = asyncio.run(projection_predictor().async_predict_batch(None, [[0, 1, 0, 0]]))
+
+    assert [release_item.id for release_item in predictions[0].closest] == [1, 3]
+
+
+def test_rerank_follows_release_distance(monkeypatch):
+    # the first descriptor is the closest by cosine and dot product, the second one by L2
+    descriptors = {1: np.array([10, 0, 0, 0], dtype=np.float32), 2: np.array([0.9, 0.5, 0, 0], dtype=np.float32)}
+
+    def select_descriptors(session, ids):
+        return {item_id: descriptors[item_id] for item_id in ids if item_id in descriptors}
+
+    monkeypatch.setattr(predictors, 'select_release_item_descriptors', select_descriptors)
+    for distance, expected in ((VectorDistance.EUCLID, [2, 1]), (VectorDistance.COSINE, [1, 2]),
+                               (VectorDistance.DOT, [1, 2])):
+        predictions = projection_predictor(distance).predict_batch(None, [[1, 0.1, 0, 0]])
+        assert [release_item.id for release_item in predictions[0].closest] == expected
@@ -0,0 +1,26 @@
+from os import environ
+from typing import List
+
+import requests
+from loguru import logger
+
+from network.config import get_url
+from network.config import NetworkConfig
+
+
+def invalidate_building_cache(building_ids: List[int] = None, network_config: NetworkConfig = None) -> bool:
+    """
+    Drops cached building responses on the server, all of them when building_ids is None.
+    The cache is per process, only the worker that serves this call is invalidated, see BuildingResponseCache
+    """
+    headers = {}
+    if 'ADMIN_TOKEN' in environ:
+        headers['x-admin-token'] = environ['ADMIN_TOKEN']
+    try:
+        response = requests.post(url=get_url('cache/buildings/invalidate', network_config),
+                                 json={'building_ids': building_ids}, headers=headers, timeout=10)
+        response.raise_for_status()
+    except requests.RequestException as exception:
+        logger.warning(f"Building cache was not invalidated, cached responses expire by TTL: {exception}")
+        return False
+    return True
@@ -1,3 +1,4 @@
+import functools
 from typing import List
 
 import requests
@@ -5,19 +6,26 @@ import requests
 from PIL import Image
 
 from libs.coordinates import Coordinates, CoordinateSystem
+from libs.descriptors import DescriptorDType, DescriptorWireFormat, OCTET_STREAM, encode_descriptor, \
+    encode_descriptor_b64
 from libs.features import MixVPR, SquareCrop, Resizer
 from models.image import PathImage, LocalResource, ImageMeta, Direction, NdarrayImage
 from network.config import get_url
 from network.config import NetworkConfig
 
 
+@functools.lru_cache(maxsize=None)
+def get_descriptor_extractor() -> MixVPR:
+    return MixVPR()
+
+
 def from_local_image(path: str,
                      coordinates: Coordinates = Coordinates(0, 0, CoordinateSystem.ELLIPSOID),
                      direction: Direction = Direction(degree=0)) -> NdarrayImage:
     img = Image.open(path)
     w, h = img.size
 
-    descriptor_extractor = MixVPR()
+    descriptor_extractor = get_descriptor_extractor()
     square_cropper = SquareCrop()
     resizer = Resizer(descriptor_extractor.input_image_width(), descriptor_extractor.input_image_height())
 
@@ -39,23 +47,60 @@ def from_local_image(path: str,
 
 
 def send_recognize_request(image: NdarrayImage, network_config: NetworkConfig = None, release_name: str = None,
-                           debug_token: str = None):
+                           debug_token: str = None, wire_format: DescriptorWireFormat = DescriptorWireFormat.JSON,
+                           descriptor_dtype: DescriptorDType = DescriptorDType.FLOAT32):
+    headers = {}
+    if debug_token is not None:
+        headers['x-debug-token'] = debug_token
+
+    url = get_url('recognize', network_config)
+
+    if wire_format == DescriptorWireFormat.BINARY:
+        headers |= {
+            'content-type': OCTET_STREAM,
+            'x-descriptor-dtype': descriptor_dtype.value,
+            'x-latitude': str(image.meta.coordinates.latitude),
+            'x-longitude': str(image.meta.coordinates.longitude),
+            'x-coordinate-system': image.meta.coordinates.system.value,
+            'x-direction': str(image.meta.direction.degree),
+        }
+        if release_name is not None:
+            headers['x-release-name'] = release_name
+        return requests.post(url=url, data=encode_descriptor(image.meta.descriptor, descriptor_dtype), headers=headers)
+
     data = {
-        'descriptor': image.meta.descriptor.tolist(),
         'coordinates': {
             'latitude': image.meta.coordinates.latitude,
-            'longitude': image.meta.coordinates.latitude,
+            'longitude': image.meta.coordinates.longitude,
             'system': image.meta.coordinates.system.value,
         },
         'direction': image.meta.direction.degree,
     }
 
+    if wire_format == DescriptorWireFormat.BASE64:
+        data['descriptor_b64'] = encode_descriptor_b64(image.meta.descriptor, descriptor_dtype)
+        data['descriptor_dtype'] = descriptor_dtype.value
+    else:
+        data['descriptor'] = image.meta.descriptor.tolist()
+
     if release_name is not None:
         data['release_name'] = release_name
 
-    headers = {}
+    return requests.post(url=url, json=data, headers=headers)
+
+
+def send_recognize_image_request(path: str, network_config: NetworkConfig = None, release_name: str = None,
+                                 coordinates: Coordinates = None, debug_token: str = None):
+    headers = {'content-type': 'image/jpeg'}
     if debug_token is not None:
         headers['x-debug-token'] = debug_token
-
-    url = get_url('recognize', network_config)
-    return requests.post(url=url, json=data, headers=headers)
+    if release_name is not None:
+        headers['x-release-name'] = release_name
+    if coordinates is not None:
+        headers |= {
+            'x-latitude': str(coordinates.latitude),
+            'x-longitude': str(coordinates.longitude),
+            'x-coordinate-system': coordinates.system.value,
+        }
+    with open(path, 'rb') as image_file:
+        return requests.post(url=get_url('recognize/image', network_config), data=image_file.read(), headers=headers)
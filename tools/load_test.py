@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import base64
+import dataclasses
+import json
+import platform
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+from loguru import logger
+from sqlmodel import Session, select
+
+from models.logs import Request
+
+SKIPPED_HEADERS = {'host', 'content-length', 'connection', 'x-request-id', 'x-response-time', 'accept-encoding'}
+
+
+@dataclasses.dataclass
+class ReplayRequest:
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+    def to_json(self) -> dict:
+        return {
+            'method': self.method,
+            'path': self.path,
+            'headers': self.headers,
+            'body_b64': base64.b64encode(self.body).decode('ascii'),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ReplayRequest':
+        if 'body_b64' in data:
+            body = base64.b64decode(data['body_b64'])
+        elif isinstance(data.get('body'), (dict, list)):
+            body = json.dumps(data['body']).encode()
+        else:
+            body = (data.get('body') or '').encode()
+        return cls(method=data.get('method', 'POST'), path=data['path'], headers=data.get('headers', {}), body=body)
+
+
+@dataclasses.dataclass
+class Sample:
+    path: str
+    latency: float
+    status: Optional[int]
+    error: Optional[str] = None
+
+
+def replay_headers(headers: dict) -> Dict[str, str]:
+    return {name: value for name, value in headers.items() if name.lower() not in SKIPPED_HEADERS}
+
+
+def is_replayable(request: Request) -> bool:
+    """Only JSON bodies are logged in full, other bodies are replaced by their size and hash"""
+    headers = request.request_headers
+    content_type = next((value for name, value in headers.items() if name.lower() == 'content-type'), '')
+    return not request.request_body or content_type.startswith('application/json')
+
+
+def read_jsonl(path: str) -> List[ReplayRequest]:
+    with open(path, 'r', encoding='utf8') as input_file:
+        return [ReplayRequest.from_json(json.loads(line)) for line in input_file if line.strip()]
+
+
+def write_jsonl(requests: List[ReplayRequest], path: str):
+    with open(path, 'w', encoding='utf8') as output_file:
+        for request in requests:
+            output_file.write(json.dumps(request.to_json()) + '\n')
+
+
+def read_request_table(session: Session, path_prefix: str = '/recognize', limit: int = 10000) -> List[ReplayRequest]:
+    statement = select(Request) \
+        .where(Request.request_url.contains(path_prefix)) \
+        .where(Request.status == 200) \
+        .order_by(Request.timestamp.desc()) \
+        .limit(limit)
+    requests = []
+    for request in session.exec(statement).all():
+        if not is_replayable(request):
+            continue
+        body = request.request_body
+        requests.append(ReplayRequest(
+            method=request.http_method.value,
+            path=httpx.URL(request.request_url).path,
+            headers=replay_headers(request.request_headers),
+            body=body if isinstance(body, bytes) else body.encode(),
+        ))
+    return requests
+
+
+async def send(client: httpx.AsyncClient, request: ReplayRequest, scheduled: float) -> Sample:
+    """Latency is measured from scheduled start, so slow responses in open loop are not hidden by queueing"""
+    headers = request.headers | {'x-request-id': uuid.uuid4().hex}
+    try:
+        response = await client.request(request.method, request.path, headers=headers, content=request.body)
+        error = None if response.status_code < 400 else f'HTTP {response.status_code}'
+        return Sample(request.path, time.perf_counter() - scheduled, response.status_code, error)
+    except httpx.HTTPError as exception:
+        return Sample(request.path, time.perf_counter() - scheduled, None, type(exception).__name__)
+
+
+async def closed_loop(client: httpx.AsyncClient, requests: List[ReplayRequest], concurrency: int,
+                      total: int, duration: Optional[float]) -> List[Sample]:
+    samples = []
+    counter = iter(range(total))
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    async def worker():
+        for index in counter:
+            if deadline is not None and time.perf_counter() > deadline:
+                return
+            samples.append(await send(client, requests[index % len(requests)], time.perf_counter()))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+async def open_loop(client: httpx.AsyncClient, requests: List[ReplayRequest], rate: float,
+                    total: int, duration: Optional[float]) -> List[Sample]:
+    if duration is not None:
+        total = min(total, int(rate * duration))
+    start = time.perf_counter()
+    tasks = []
+    for index in range(total):
+        scheduled = start + index / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, requests[index % len(requests)], scheduled)))
+    return list(await asyncio.gather(*tasks))
+
+
+def summarize(samples: List[Sample], wall_time: float) -> dict:
+    latencies = np.array([sample.latency for sample in samples]) * 1e3
+    errors = [sample for sample in samples if sample.error is not None]
+    percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [None] * 3
+    return {
+        'requests': len(samples),
+        'wall_time_s': wall_time,
+        'throughput_rps': len(samples) / wall_time if wall_time else 0,
+        'error_rate': len(errors) / len(samples) if samples else 0,
+        'errors': dict(Counter(sample.error for sample in errors)),
+        'statuses': {str(status): count for status, count in Counter(sample.status for sample in samples).items()},
+        'latency_ms': {
+            'mean': float(latencies.mean()) if len(latencies) else None,
+            'p50': float(percentiles[0]) if len(latencies) else None,
+            'p95': float(percentiles[1]) if len(latencies) else None,
+            'p99': float(percentiles[2]) if len(latencies) else None,
+            'max': float(latencies.max()) if len(latencies) else None,
+        },
+    }
+
+
+async def run(requests: List[ReplayRequest], target: str, mode: str, concurrency: int, rate: float, total: int,
+              duration: Optional[float], timeout: float, warmup: int = 0) -> dict:
+    limits = httpx.Limits(max_connections=None if mode == 'open' else concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as client:
+        if warmup:
+            await closed_loop(client, requests, concurrency, warmup, None)
+        start = time.perf_counter()
+        if mode == 'open':
+            samples = await open_loop(client, requests, rate, total, duration)
+        else:
+            samples = await closed_loop(client, requests, concurrency, total, duration)
+        wall_time = time.perf_counter() - start
+    result = summarize(samples, wall_time)
+    result['by_path'] = {
+        path: summarize([sample for sample in samples if sample.path == path], wall_time)
+        for path in sorted({sample.path for sample in samples})
+    }
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays captured /recognize requests against a server")
+    parser.add_argument('--jsonl', help="captured requests, one JSON object per line, see ReplayRequest")
+    parser.add_argument('--from-table', action='store_true', help="read requests from the request table")
+    parser.add_argument('--path-prefix', default='/recognize')
+    parser.add_argument('--table-limit', type=int, default=10000)
+    parser.add_argument('--export', help="write loaded requests to JSONL and exit")
+    parser.add_argument('--target', default='http://localhost:8080')
+    parser.add_argument('--mode', choices=['open', 'closed'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=8, help="closed loop workers")
+    parser.add_argument('--rate', type=float, default=50, help="open loop requests per second")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=None, help="seconds, stops earlier than --requests")
+    parser.add_argument('--warmup', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--label', default=None)
+    parser.add_argument('--output', default='load_test_result.json')
+    arguments = parser.parse_args()
+
+    if arguments.from_table:
+        from db.postgres import GetSQLModelSession
+
+        with GetSQLModelSession() as db_session:
+            replay_requests = read_request_table(db_session, arguments.path_prefix, arguments.table_limit)
+    elif arguments.jsonl:
+        replay_requests = read_jsonl(arguments.jsonl)
+    else:
+        parser.error("either --jsonl or --from-table should be specified")
+    if not replay_requests:
+        parser.error("no requests to replay")
+
+    if arguments.export:
+        write_jsonl(replay_requests, arguments.export)
+        logger.info(f"{len(replay_requests)} requests exported to {arguments.export}")
+    else:
+        load_test_result = asyncio.run(run(
+            replay_requests, arguments.target, arguments.mode, arguments.concurrency, arguments.rate,
+            arguments.requests, arguments.duration, arguments.timeout, arguments.warmup,
+        ))
+        load_test_result['config'] = {
+            name: value for name, value in vars(arguments).items() if name not in ('export',)
+        } | {'replayed_requests': len(replay_requests), 'python': platform.python_version()}
+        with open(arguments.output, 'w', encoding='utf8') as result_file:
+            json.dump(load_test_result, result_file, indent=2)
+        logger.info(f"{load_test_result['requests']} requests, {load_test_result['throughput_rps']:.1f} rps, "
+                    f"p50 {load_test_result['latency_ms']['p50']} ms, p99 {load_test_result['latency_ms']['p99']} ms, "
+                    f"error rate {load_test_result['error_rate']:.2%}, result written to {arguments.output}")